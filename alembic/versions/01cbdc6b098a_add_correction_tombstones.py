@@ -0,0 +1,77 @@
+"""Add correction tombstones
+
+Revision ID: 01cbdc6b098a
+Revises: 64e1e3e2a488
+Create Date: 2026-10-18 18:41:27.905126
+
+"""
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "01cbdc6b098a"
+down_revision = "64e1e3e2a488"
+branch_labels = None
+depends_on = None
+
+MAX_TOMBSTONES = 1000
+RECORD_TOMBSTONES_FUNCTION = f"""
+CREATE OR REPLACE FUNCTION record_tombstones() RETURNS trigger AS $$
+BEGIN
+    INSERT INTO correction_tombstones (posting_id)
+    SELECT DISTINCT posting_id FROM old_rows
+    WHERE NOT EXISTS (SELECT FROM postings WHERE postings.id = old_rows.posting_id);
+    DELETE FROM correction_tombstones WHERE id <= (
+        SELECT id FROM correction_tombstones
+        ORDER BY id DESC OFFSET {MAX_TOMBSTONES} LIMIT 1
+    );
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql
+"""
+
+
+def upgrade():
+    op.create_table(
+        "correction_tombstones",
+        sa.Column(
+            "id",
+            sa.Integer(),
+            server_default=sa.text("nextval('corrections_id_seq')"),
+            nullable=False,
+        ),
+        sa.Column("posting_id", sa.Integer(), nullable=False),
+        sa.PrimaryKeyConstraint("id"),
+    )
+    op.execute(
+        "CREATE TRIGGER correction_tombstones_count_inserts "
+        "AFTER INSERT ON correction_tombstones REFERENCING NEW TABLE AS new_rows "
+        "FOR EACH STATEMENT EXECUTE FUNCTION count_rows()"
+    )
+    op.execute(
+        "CREATE TRIGGER correction_tombstones_count_deletes "
+        "AFTER DELETE ON correction_tombstones REFERENCING OLD TABLE AS old_rows "
+        "FOR EACH STATEMENT EXECUTE FUNCTION count_rows()"
+    )
+    op.execute(
+        "CREATE TRIGGER correction_tombstones_count_updates "
+        "AFTER UPDATE ON correction_tombstones "
+        "FOR EACH STATEMENT EXECUTE FUNCTION count_rows()"
+    )
+    op.execute(
+        "INSERT INTO row_counts (table_name, row_count) "
+        "VALUES ('correction_tombstones', 0)"
+    )
+    op.execute(RECORD_TOMBSTONES_FUNCTION)
+    op.execute(
+        "CREATE TRIGGER corrections_record_tombstones AFTER DELETE ON corrections "
+        "REFERENCING OLD TABLE AS old_rows "
+        "FOR EACH STATEMENT EXECUTE FUNCTION record_tombstones()"
+    )
+
+
+def downgrade():
+    op.execute("DROP TRIGGER corrections_record_tombstones ON corrections")
+    op.execute("DROP FUNCTION record_tombstones()")
+    op.execute("DELETE FROM row_counts WHERE table_name = 'correction_tombstones'")
+    op.drop_table("correction_tombstones")
@@ -0,0 +1,51 @@
+"""Add keyset pagination indexes
+
+Revision ID: 0f6c4f96c013
+Revises: b691ebcc3675
+Create Date: 2026-10-18 09:12:41.508215
+
+"""
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "0f6c4f96c013"
+down_revision = "b691ebcc3675"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_index(
+        "ix_postings_date_id",
+        "postings",
+        [sa.text("date DESC"), sa.text("id DESC")],
+    )
+    op.create_index(
+        "ix_postings_bike_date_id",
+        "postings",
+        ["bike", sa.text("date DESC"), sa.text("id DESC")],
+    )
+    op.create_index(
+        "ix_postings_frame_date_id",
+        "postings",
+        ["frame", sa.text("date DESC"), sa.text("id DESC")],
+    )
+    op.create_index(
+        "ix_postings_color_date_id",
+        "postings",
+        ["color", sa.text("date DESC"), sa.text("id DESC")],
+    )
+    op.create_index(
+        "ix_postings_bike_frame_color_date_id",
+        "postings",
+        ["bike", "frame", "color", sa.text("date DESC"), sa.text("id DESC")],
+    )
+
+
+def downgrade():
+    op.drop_index("ix_postings_bike_frame_color_date_id", table_name="postings")
+    op.drop_index("ix_postings_color_date_id", table_name="postings")
+    op.drop_index("ix_postings_frame_date_id", table_name="postings")
+    op.drop_index("ix_postings_bike_date_id", table_name="postings")
+    op.drop_index("ix_postings_date_id", table_name="postings")
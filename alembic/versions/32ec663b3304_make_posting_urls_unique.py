@@ -0,0 +1,47 @@
+"""Make posting urls unique
+
+Revision ID: 32ec663b3304
+Revises: 6990773a40e2
+Create Date: 2026-10-18 13:41:55.270318
+
+"""
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "32ec663b3304"
+down_revision = "6990773a40e2"
+branch_labels = None
+depends_on = None
+
+# Maps every posting to the newest posting sharing its url
+SURVIVORS = """
+SELECT id, first_value(id) OVER (
+    PARTITION BY url ORDER BY date DESC NULLS LAST, id DESC
+) AS survivor_id
+FROM postings
+WHERE url IS NOT NULL
+"""
+
+
+def upgrade():
+    # Keep corrections of collapsed duplicates by moving them to the survivor
+    op.execute(
+        f"""
+        UPDATE corrections SET posting_id = survivors.survivor_id
+        FROM ({SURVIVORS}) AS survivors
+        WHERE corrections.posting_id = survivors.id
+        AND survivors.id <> survivors.survivor_id
+        """
+    )
+    op.execute(
+        f"""
+        DELETE FROM postings USING ({SURVIVORS}) AS survivors
+        WHERE postings.id = survivors.id
+        AND survivors.id <> survivors.survivor_id
+        """
+    )
+    op.create_index("ix_postings_url", "postings", ["url"], unique=True)
+
+
+def downgrade():
+    op.drop_index("ix_postings_url", table_name="postings")
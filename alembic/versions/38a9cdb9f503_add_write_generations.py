@@ -0,0 +1,71 @@
+"""Add write generations
+
+Revision ID: 38a9cdb9f503
+Revises: 32ec663b3304
+Create Date: 2026-10-18 15:08:32.846117
+
+"""
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "38a9cdb9f503"
+down_revision = "32ec663b3304"
+branch_labels = None
+depends_on = None
+
+COUNT_ROWS_FUNCTION = """
+CREATE OR REPLACE FUNCTION count_rows() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        UPDATE row_counts SET
+            row_count = row_count + (SELECT count(*) FROM new_rows),
+            generation = generation + 1
+        WHERE table_name = TG_TABLE_NAME;
+    ELSIF TG_OP = 'DELETE' THEN
+        UPDATE row_counts SET
+            row_count = row_count - (SELECT count(*) FROM old_rows),
+            generation = generation + 1
+        WHERE table_name = TG_TABLE_NAME;
+    ELSE
+        UPDATE row_counts SET generation = generation + 1
+        WHERE table_name = TG_TABLE_NAME;
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql
+"""
+PREVIOUS_COUNT_ROWS_FUNCTION = """
+CREATE OR REPLACE FUNCTION count_rows() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        UPDATE row_counts SET row_count = row_count + (SELECT count(*) FROM new_rows)
+        WHERE table_name = TG_TABLE_NAME;
+    ELSE
+        UPDATE row_counts SET row_count = row_count - (SELECT count(*) FROM old_rows)
+        WHERE table_name = TG_TABLE_NAME;
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql
+"""
+
+
+def upgrade():
+    op.add_column(
+        "row_counts",
+        sa.Column("generation", sa.BigInteger(), server_default="0", nullable=False),
+    )
+    op.execute(COUNT_ROWS_FUNCTION)
+    for table in ("postings", "corrections"):
+        op.execute(
+            f"CREATE TRIGGER {table}_count_updates AFTER UPDATE ON {table} "
+            "FOR EACH STATEMENT EXECUTE FUNCTION count_rows()"
+        )
+
+
+def downgrade():
+    for table in ("postings", "corrections"):
+        op.execute(f"DROP TRIGGER {table}_count_updates ON {table}")
+    op.execute(PREVIOUS_COUNT_ROWS_FUNCTION)
+    op.drop_column("row_counts", "generation")
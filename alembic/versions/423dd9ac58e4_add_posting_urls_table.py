@@ -0,0 +1,107 @@
+"""Add posting urls table
+
+Revision ID: 423dd9ac58e4
+Revises: 7202f8015f75
+Create Date: 2026-10-18 23:58:12.604193
+
+"""
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "423dd9ac58e4"
+down_revision = "7202f8015f75"
+branch_labels = None
+depends_on = None
+
+MAINTAIN_POSTING_URLS_FUNCTION = """
+CREATE OR REPLACE FUNCTION maintain_posting_urls() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        INSERT INTO posting_urls (posting_id, url) SELECT id, url FROM new_rows;
+    ELSIF TG_OP = 'DELETE' THEN
+        -- Takes the place of a cascading foreign key
+        DELETE FROM corrections WHERE posting_id IN (SELECT id FROM old_rows);
+        DELETE FROM posting_urls WHERE posting_id IN (SELECT id FROM old_rows);
+    ELSE
+        UPDATE posting_urls SET posting_id = NEW.id, url = NEW.url
+        WHERE posting_id = OLD.id;
+        RETURN NEW;
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql
+"""
+# Maps every posting to the newest posting sharing its url
+SURVIVORS = """
+SELECT id, first_value(id) OVER (
+    PARTITION BY url ORDER BY date DESC, id DESC
+) AS survivor_id
+FROM postings
+WHERE url IS NOT NULL
+"""
+TRIGGERS = [
+    "CREATE TRIGGER postings_maintain_url_inserts AFTER INSERT ON postings "
+    "REFERENCING NEW TABLE AS new_rows "
+    "FOR EACH STATEMENT EXECUTE FUNCTION maintain_posting_urls()",
+    "CREATE TRIGGER postings_maintain_url_deletes AFTER DELETE ON postings "
+    "REFERENCING OLD TABLE AS old_rows "
+    "FOR EACH STATEMENT EXECUTE FUNCTION maintain_posting_urls()",
+    "CREATE TRIGGER postings_maintain_url_updates "
+    "BEFORE UPDATE OF id, url ON postings "
+    "FOR EACH ROW EXECUTE FUNCTION maintain_posting_urls()",
+]
+
+
+def upgrade():
+    op.execute("LOCK TABLE postings, corrections IN SHARE MODE")
+    _collapse_duplicates()
+    op.create_table(
+        "posting_urls",
+        sa.Column("posting_id", sa.Integer(), nullable=False),
+        sa.Column("url", sa.String(), nullable=True),
+        sa.PrimaryKeyConstraint("posting_id"),
+        sa.UniqueConstraint("url"),
+    )
+    op.execute(
+        "INSERT INTO posting_urls (posting_id, url) SELECT id, url FROM postings"
+    )
+    op.create_foreign_key(
+        "corrections_posting_id_fkey",
+        "corrections",
+        "posting_urls",
+        ["posting_id"],
+        ["posting_id"],
+    )
+    op.execute(MAINTAIN_POSTING_URLS_FUNCTION)
+    for trigger in TRIGGERS:
+        op.execute(trigger)
+
+
+def downgrade():
+    for operation in ("inserts", "deletes", "updates"):
+        op.execute(f"DROP TRIGGER postings_maintain_url_{operation} ON postings")
+    op.execute("DROP FUNCTION maintain_posting_urls()")
+    op.drop_constraint("corrections_posting_id_fkey", "corrections", type_="foreignkey")
+    op.drop_table("posting_urls")
+
+
+def _collapse_duplicates():
+    # Writers were meant to keep URLs unique. Duplicates that slipped through
+    # are collapsed as before, the triggers on corrections update the consensus
+    # of the survivors and record tombstones for the deleted postings.
+    op.execute(
+        f"CREATE TEMPORARY TABLE duplicates ON COMMIT DROP AS "
+        f"SELECT * FROM ({SURVIVORS}) AS survivors WHERE id <> survivor_id"
+    )
+    op.execute(
+        "INSERT INTO corrections (posting_id, bike, frame, color) "
+        "SELECT survivor_id, bike, frame, color FROM corrections "
+        "JOIN duplicates ON corrections.posting_id = duplicates.id "
+        "ORDER BY corrections.id"
+    )
+    op.execute("DELETE FROM postings WHERE id IN (SELECT id FROM duplicates)")
+    op.execute(
+        "DELETE FROM corrections "
+        "WHERE NOT EXISTS (SELECT FROM postings WHERE id = corrections.posting_id)"
+    )
@@ -0,0 +1,130 @@
+"""Dictionary encode labels
+
+Revision ID: 53e082715d61
+Revises: 8c539a8849d1
+Create Date: 2026-10-18 22:31:05.172846
+
+"""
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "53e082715d61"
+down_revision = "8c539a8849d1"
+branch_labels = None
+depends_on = None
+
+EMPTY_LABEL = 0
+INITIAL_LABELS = [
+    "bike",
+    "children",
+    "cargo",
+    "diamond",
+    "trapeze",
+    "swan_neck",
+    "low_entry",
+    "x",
+    "y",
+    "black",
+    "white",
+    "gray",
+    "blue",
+    "red",
+    "yellow",
+    "green",
+]
+LABEL_COLUMNS = {
+    "postings": [
+        "bike",
+        "frame",
+        "color",
+        "consensus_bike",
+        "consensus_frame",
+        "consensus_color",
+    ],
+    "corrections": ["bike", "frame", "color"],
+    "facet_counts": ["bike", "frame", "color"],
+}
+COUNT_FACETS_FUNCTION = """
+CREATE OR REPLACE FUNCTION count_facets() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP IN ('DELETE', 'UPDATE') THEN
+        UPDATE facet_counts SET posting_count = posting_count - removed.num
+        FROM (
+            SELECT coalesce(bike, {empty}) AS bike,
+                coalesce(frame, {empty}) AS frame,
+                coalesce(color, {empty}) AS color, count(*) AS num
+            FROM old_rows GROUP BY 1, 2, 3
+        ) AS removed
+        WHERE facet_counts.bike = removed.bike
+        AND facet_counts.frame = removed.frame
+        AND facet_counts.color = removed.color;
+        DELETE FROM facet_counts WHERE posting_count = 0;
+    END IF;
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        INSERT INTO facet_counts (bike, frame, color, posting_count)
+        SELECT coalesce(bike, {empty}), coalesce(frame, {empty}),
+            coalesce(color, {empty}), count(*)
+        FROM new_rows GROUP BY 1, 2, 3
+        ON CONFLICT (bike, frame, color) DO UPDATE
+        SET posting_count = facet_counts.posting_count + excluded.posting_count;
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql
+"""
+
+
+def upgrade():
+    op.execute("LOCK TABLE postings, corrections IN ACCESS EXCLUSIVE MODE")
+    op.create_table(
+        "labels",
+        sa.Column("id", sa.SmallInteger(), nullable=False),
+        sa.Column("name", sa.String(), nullable=False),
+        sa.PrimaryKeyConstraint("id"),
+        sa.UniqueConstraint("name"),
+    )
+    op.execute(f"INSERT INTO labels (id, name) VALUES ({EMPTY_LABEL}, '')")
+    op.execute(
+        "INSERT INTO labels (name) VALUES "
+        + ", ".join(f"('{name}')" for name in INITIAL_LABELS)
+    )
+    stored_labels = " UNION ".join(
+        f"SELECT {column} FROM {table}"
+        for table, columns in LABEL_COLUMNS.items()
+        for column in columns
+    )
+    op.execute(
+        f"INSERT INTO labels (name) SELECT name FROM ({stored_labels}) AS stored(name) "
+        "WHERE name IS NOT NULL ORDER BY name ON CONFLICT (name) DO NOTHING"
+    )
+    # USING does not take subqueries, but it takes functions running them
+    op.execute(
+        "CREATE FUNCTION pg_temp.label_code(label_name varchar) RETURNS smallint "
+        "AS 'SELECT id FROM labels WHERE name = label_name' LANGUAGE sql STABLE"
+    )
+    _convert_labels("smallint", "pg_temp.label_code")
+    op.execute(COUNT_FACETS_FUNCTION.format(empty=EMPTY_LABEL))
+
+
+def downgrade():
+    op.execute("LOCK TABLE postings, corrections IN ACCESS EXCLUSIVE MODE")
+    op.execute(
+        "CREATE FUNCTION pg_temp.label_name(label_code smallint) RETURNS varchar "
+        "AS 'SELECT name FROM labels WHERE id = label_code' LANGUAGE sql STABLE"
+    )
+    _convert_labels("varchar", "pg_temp.label_name")
+    op.execute(COUNT_FACETS_FUNCTION.format(empty="''"))
+    op.drop_table("labels")
+
+
+def _convert_labels(column_type: str, function: str):
+    # One statement per table, so that each table is only rewritten once
+    for table, columns in LABEL_COLUMNS.items():
+        op.execute(
+            f"ALTER TABLE {table} "
+            + ", ".join(
+                f"ALTER COLUMN {column} TYPE {column_type} USING {function}({column})"
+                for column in columns
+            )
+        )
@@ -0,0 +1,42 @@
+"""Count posting urls rows
+
+Revision ID: 5b0e9d3f7c21
+Revises: 423dd9ac58e4
+Create Date: 2026-10-18 23:59:21.915320
+
+"""
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "5b0e9d3f7c21"
+down_revision = "423dd9ac58e4"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.execute("LOCK TABLE posting_urls IN SHARE MODE")
+    op.execute(
+        "INSERT INTO row_counts (table_name, row_count) "
+        "SELECT 'posting_urls', count(*) FROM posting_urls"
+    )
+    op.execute(
+        "CREATE TRIGGER posting_urls_count_inserts AFTER INSERT ON posting_urls "
+        "REFERENCING NEW TABLE AS new_rows "
+        "FOR EACH STATEMENT EXECUTE FUNCTION count_rows()"
+    )
+    op.execute(
+        "CREATE TRIGGER posting_urls_count_deletes AFTER DELETE ON posting_urls "
+        "REFERENCING OLD TABLE AS old_rows "
+        "FOR EACH STATEMENT EXECUTE FUNCTION count_rows()"
+    )
+    op.execute(
+        "CREATE TRIGGER posting_urls_count_updates AFTER UPDATE ON posting_urls "
+        "FOR EACH STATEMENT EXECUTE FUNCTION count_rows()"
+    )
+
+
+def downgrade():
+    for operation in ("inserts", "deletes", "updates"):
+        op.execute(f"DROP TRIGGER posting_urls_count_{operation} ON posting_urls")
+    op.execute("DELETE FROM row_counts WHERE table_name = 'posting_urls'")
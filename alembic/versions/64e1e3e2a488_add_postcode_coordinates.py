@@ -0,0 +1,78 @@
+"""Add postcode coordinates
+
+Revision ID: 64e1e3e2a488
+Revises: b774655bfde7
+Create Date: 2026-10-18 18:02:41.318207
+
+"""
+import csv
+import pathlib
+
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "64e1e3e2a488"
+down_revision = "b774655bfde7"
+branch_labels = None
+depends_on = None
+
+POSTCODES_CSV = (
+    pathlib.Path(__file__).parents[2] / "backend" / "app" / "data" / "postcodes_de.csv"
+)
+
+
+def upgrade():
+    op.add_column("postings", sa.Column("postcode", sa.String(), nullable=True))
+    op.add_column("postings", sa.Column("lat", sa.Float(), nullable=True))
+    op.add_column("postings", sa.Column("lon", sa.Float(), nullable=True))
+    postcodes = op.create_table(
+        "postcodes",
+        sa.Column("postcode", sa.String(), nullable=False),
+        sa.Column("lat", sa.Float(), nullable=False),
+        sa.Column("lon", sa.Float(), nullable=False),
+        sa.PrimaryKeyConstraint("postcode"),
+    )
+    op.execute(
+        "CREATE TRIGGER postcodes_count_inserts AFTER INSERT ON postcodes "
+        "REFERENCING NEW TABLE AS new_rows "
+        "FOR EACH STATEMENT EXECUTE FUNCTION count_rows()"
+    )
+    op.execute(
+        "CREATE TRIGGER postcodes_count_deletes AFTER DELETE ON postcodes "
+        "REFERENCING OLD TABLE AS old_rows "
+        "FOR EACH STATEMENT EXECUTE FUNCTION count_rows()"
+    )
+    op.execute(
+        "CREATE TRIGGER postcodes_count_updates AFTER UPDATE ON postcodes "
+        "FOR EACH STATEMENT EXECUTE FUNCTION count_rows()"
+    )
+    op.execute("INSERT INTO row_counts (table_name, row_count) VALUES ('postcodes', 0)")
+
+    with open(POSTCODES_CSV, newline="") as f:
+        rows = [
+            {"postcode": r["postcode"], "lat": float(r["lat"]), "lon": float(r["lon"])}
+            for r in csv.DictReader(f)
+        ]
+    # A single statement, so that the row count trigger fires once
+    op.execute(postcodes.insert().values(rows))
+
+    op.execute(
+        "UPDATE postings SET postcode = substring(location from '\\m(\\d{5})\\M')"
+    )
+    op.execute(
+        "UPDATE postings SET lat = postcodes.lat, lon = postcodes.lon "
+        "FROM postcodes WHERE postings.postcode = postcodes.postcode"
+    )
+    op.execute(
+        "CREATE INDEX ix_postings_coordinates ON postings USING gist (point(lon, lat))"
+    )
+
+
+def downgrade():
+    op.drop_index("ix_postings_coordinates", table_name="postings")
+    op.execute("DELETE FROM row_counts WHERE table_name = 'postcodes'")
+    op.drop_table("postcodes")
+    op.drop_column("postings", "lon")
+    op.drop_column("postings", "lat")
+    op.drop_column("postings", "postcode")
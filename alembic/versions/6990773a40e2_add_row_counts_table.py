@@ -0,0 +1,65 @@
+"""Add row counts table
+
+Revision ID: 6990773a40e2
+Revises: 8069dad4508e
+Create Date: 2026-10-18 11:26:09.733120
+
+"""
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "6990773a40e2"
+down_revision = "8069dad4508e"
+branch_labels = None
+depends_on = None
+
+COUNT_ROWS_FUNCTION = """
+CREATE OR REPLACE FUNCTION count_rows() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        UPDATE row_counts SET row_count = row_count + (SELECT count(*) FROM new_rows)
+        WHERE table_name = TG_TABLE_NAME;
+    ELSE
+        UPDATE row_counts SET row_count = row_count - (SELECT count(*) FROM old_rows)
+        WHERE table_name = TG_TABLE_NAME;
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql
+"""
+
+
+def upgrade():
+    op.create_table(
+        "row_counts",
+        sa.Column("table_name", sa.String(), nullable=False),
+        sa.Column("row_count", sa.BigInteger(), nullable=False),
+        sa.PrimaryKeyConstraint("table_name"),
+    )
+    op.execute(COUNT_ROWS_FUNCTION)
+    # Block writers until the triggers are in place and the counts are seeded
+    op.execute("LOCK TABLE postings, corrections IN SHARE ROW EXCLUSIVE MODE")
+    for table in ("postings", "corrections"):
+        op.execute(
+            f"CREATE TRIGGER {table}_count_inserts AFTER INSERT ON {table} "
+            "REFERENCING NEW TABLE AS new_rows "
+            "FOR EACH STATEMENT EXECUTE FUNCTION count_rows()"
+        )
+        op.execute(
+            f"CREATE TRIGGER {table}_count_deletes AFTER DELETE ON {table} "
+            "REFERENCING OLD TABLE AS old_rows "
+            "FOR EACH STATEMENT EXECUTE FUNCTION count_rows()"
+        )
+        op.execute(
+            "INSERT INTO row_counts (table_name, row_count) "
+            f"SELECT '{table}', count(*) FROM {table}"
+        )
+
+
+def downgrade():
+    for table in ("postings", "corrections"):
+        op.execute(f"DROP TRIGGER {table}_count_deletes ON {table}")
+        op.execute(f"DROP TRIGGER {table}_count_inserts ON {table}")
+    op.execute("DROP FUNCTION count_rows()")
+    op.drop_table("row_counts")
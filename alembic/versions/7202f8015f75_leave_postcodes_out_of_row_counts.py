@@ -0,0 +1,41 @@
+"""Leave postcodes out of row counts
+
+Revision ID: 7202f8015f75
+Revises: 53e082715d61
+Create Date: 2026-10-18 23:52:40.318064
+
+"""
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "7202f8015f75"
+down_revision = "53e082715d61"
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    for operation in ("inserts", "deletes", "updates"):
+        op.execute(f"DROP TRIGGER postcodes_count_{operation} ON postcodes")
+    op.execute("DELETE FROM row_counts WHERE table_name = 'postcodes'")
+
+
+def downgrade():
+    op.execute(
+        "INSERT INTO row_counts (table_name, row_count) "
+        "SELECT 'postcodes', count(*) FROM postcodes"
+    )
+    op.execute(
+        "CREATE TRIGGER postcodes_count_inserts AFTER INSERT ON postcodes "
+        "REFERENCING NEW TABLE AS new_rows "
+        "FOR EACH STATEMENT EXECUTE FUNCTION count_rows()"
+    )
+    op.execute(
+        "CREATE TRIGGER postcodes_count_deletes AFTER DELETE ON postcodes "
+        "REFERENCING OLD TABLE AS old_rows "
+        "FOR EACH STATEMENT EXECUTE FUNCTION count_rows()"
+    )
+    op.execute(
+        "CREATE TRIGGER postcodes_count_updates AFTER UPDATE ON postcodes "
+        "FOR EACH STATEMENT EXECUTE FUNCTION count_rows()"
+    )
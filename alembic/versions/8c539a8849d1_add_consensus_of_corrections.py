@@ -0,0 +1,105 @@
+"""Add consensus of corrections
+
+Revision ID: 8c539a8849d1
+Revises: e61f908c9a24
+Create Date: 2026-10-18 21:07:44.512903
+
+"""
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "8c539a8849d1"
+down_revision = "e61f908c9a24"
+branch_labels = None
+depends_on = None
+
+ASPECTS = ("bike", "frame", "color")
+UPDATE_CONSENSUS = """
+UPDATE postings SET
+    consensus_bike = bike.label, consensus_bike_votes = bike.votes,
+    consensus_frame = frame.label, consensus_frame_votes = frame.votes,
+    consensus_color = color.label, consensus_color_votes = color.votes,
+    num_corrections = total.votes
+FROM {changed} AS changed_posting(id)
+LEFT JOIN LATERAL (
+    SELECT bike AS label, count(*) AS votes FROM corrections
+    WHERE posting_id = changed_posting.id
+    GROUP BY bike ORDER BY count(*) DESC, max(id) DESC LIMIT 1
+) AS bike ON true
+LEFT JOIN LATERAL (
+    SELECT frame AS label, count(*) AS votes FROM corrections
+    WHERE posting_id = changed_posting.id
+    GROUP BY frame ORDER BY count(*) DESC, max(id) DESC LIMIT 1
+) AS frame ON true
+LEFT JOIN LATERAL (
+    SELECT color AS label, count(*) AS votes FROM corrections
+    WHERE posting_id = changed_posting.id
+    GROUP BY color ORDER BY count(*) DESC, max(id) DESC LIMIT 1
+) AS color ON true
+CROSS JOIN LATERAL (
+    SELECT count(*) AS votes FROM corrections
+    WHERE posting_id = changed_posting.id
+) AS total
+WHERE postings.id = changed_posting.id
+"""
+UPDATE_CONSENSUS_FUNCTION = f"""
+CREATE OR REPLACE FUNCTION update_consensus() RETURNS trigger AS $$
+DECLARE
+    changed integer[];
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        changed := ARRAY(SELECT DISTINCT posting_id FROM new_rows);
+    ELSE
+        changed := ARRAY(SELECT DISTINCT posting_id FROM old_rows);
+    END IF;
+    {UPDATE_CONSENSUS.format(changed="unnest(changed)")};
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql
+"""
+
+
+def upgrade():
+    for aspect in ASPECTS:
+        op.add_column("postings", sa.Column(f"consensus_{aspect}", sa.String()))
+        op.add_column("postings", sa.Column(f"consensus_{aspect}_votes", sa.Integer()))
+    op.add_column(
+        "postings",
+        sa.Column("num_corrections", sa.Integer(), nullable=False, server_default="0"),
+    )
+    # Corrections added while migrating would miss the consensus otherwise
+    op.execute("LOCK TABLE corrections IN SHARE MODE")
+    op.execute(
+        UPDATE_CONSENSUS.format(changed="(SELECT DISTINCT posting_id FROM corrections)")
+    )
+    op.execute(UPDATE_CONSENSUS_FUNCTION)
+    op.execute(
+        "CREATE TRIGGER corrections_update_consensus_inserts "
+        "AFTER INSERT ON corrections REFERENCING NEW TABLE AS new_rows "
+        "FOR EACH STATEMENT EXECUTE FUNCTION update_consensus()"
+    )
+    op.execute(
+        "CREATE TRIGGER corrections_update_consensus_deletes "
+        "AFTER DELETE ON corrections REFERENCING OLD TABLE AS old_rows "
+        "FOR EACH STATEMENT EXECUTE FUNCTION update_consensus()"
+    )
+    for aspect in ASPECTS:
+        op.create_index(
+            f"ix_postings_consensus_{aspect}_date_id",
+            "postings",
+            [f"consensus_{aspect}", sa.text("date DESC"), sa.text("id DESC")],
+            postgresql_where=sa.text(f"consensus_{aspect} IS NOT NULL"),
+        )
+
+
+def downgrade():
+    for aspect in ASPECTS:
+        op.drop_index(f"ix_postings_consensus_{aspect}_date_id", table_name="postings")
+    op.execute("DROP TRIGGER corrections_update_consensus_deletes ON corrections")
+    op.execute("DROP TRIGGER corrections_update_consensus_inserts ON corrections")
+    op.execute("DROP FUNCTION update_consensus()")
+    op.drop_column("postings", "num_corrections")
+    for aspect in ASPECTS:
+        op.drop_column("postings", f"consensus_{aspect}_votes")
+        op.drop_column("postings", f"consensus_{aspect}")
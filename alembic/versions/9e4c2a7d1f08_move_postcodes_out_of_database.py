@@ -0,0 +1,68 @@
+"""Move postcodes out of database
+
+Revision ID: 9e4c2a7d1f08
+Revises: 5b0e9d3f7c21
+Create Date: 2026-10-18 23:59:48.204713
+
+"""
+import csv
+import pathlib
+
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "9e4c2a7d1f08"
+down_revision = "5b0e9d3f7c21"
+branch_labels = None
+depends_on = None
+
+POSTCODES_CSV = (
+    pathlib.Path(__file__).parents[2] / "backend" / "app" / "data" / "postcodes_de.csv"
+)
+COUNTED_TABLES = ("labels", "facet_counts")
+
+
+def upgrade():
+    # Postcodes are looked up from the CSV on ingest now
+    op.drop_table("postcodes")
+    op.execute(f"LOCK TABLE {', '.join(COUNTED_TABLES)} IN SHARE MODE")
+    for table in COUNTED_TABLES:
+        op.execute(
+            f"INSERT INTO row_counts (table_name, row_count) "
+            f"SELECT '{table}', count(*) FROM {table}"
+        )
+        op.execute(
+            f"CREATE TRIGGER {table}_count_inserts AFTER INSERT ON {table} "
+            f"REFERENCING NEW TABLE AS new_rows "
+            f"FOR EACH STATEMENT EXECUTE FUNCTION count_rows()"
+        )
+        op.execute(
+            f"CREATE TRIGGER {table}_count_deletes AFTER DELETE ON {table} "
+            f"REFERENCING OLD TABLE AS old_rows "
+            f"FOR EACH STATEMENT EXECUTE FUNCTION count_rows()"
+        )
+        op.execute(
+            f"CREATE TRIGGER {table}_count_updates AFTER UPDATE ON {table} "
+            f"FOR EACH STATEMENT EXECUTE FUNCTION count_rows()"
+        )
+
+
+def downgrade():
+    for table in COUNTED_TABLES:
+        for operation in ("inserts", "deletes", "updates"):
+            op.execute(f"DROP TRIGGER {table}_count_{operation} ON {table}")
+        op.execute(f"DELETE FROM row_counts WHERE table_name = '{table}'")
+    postcodes = op.create_table(
+        "postcodes",
+        sa.Column("postcode", sa.String(), nullable=False),
+        sa.Column("lat", sa.Float(), nullable=False),
+        sa.Column("lon", sa.Float(), nullable=False),
+        sa.PrimaryKeyConstraint("postcode"),
+    )
+    with open(POSTCODES_CSV, newline="") as f:
+        rows = [
+            {"postcode": r["postcode"], "lat": float(r["lat"]), "lon": float(r["lon"])}
+            for r in csv.DictReader(f)
+        ]
+    op.execute(postcodes.insert().values(rows))
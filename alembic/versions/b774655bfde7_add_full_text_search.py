@@ -0,0 +1,68 @@
+"""Add full text search
+
+Revision ID: b774655bfde7
+Revises: ef01686f9bcc
+Create Date: 2026-10-18 17:35:12.604488
+
+"""
+import sqlalchemy as sa
+from alembic import op
+from sqlalchemy.dialects import postgresql
+
+# revision identifiers, used by Alembic.
+revision = "b774655bfde7"
+down_revision = "ef01686f9bcc"
+branch_labels = None
+depends_on = None
+
+BACKFILL_BATCH_SIZE = 5000
+SEARCH_VECTOR = (
+    "setweight(to_tsvector('german', coalesce({row}title, '')), 'A') "
+    "|| setweight(to_tsvector('german', coalesce({row}location, '')), 'B')"
+)
+UPDATE_SEARCH_VECTOR_FUNCTION = f"""
+CREATE OR REPLACE FUNCTION update_search_vector() RETURNS trigger AS $$
+BEGIN
+    NEW.search_vector := {SEARCH_VECTOR.format(row="NEW.")};
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql
+"""
+
+
+def upgrade():
+    # A nullable column without default is added without rewriting the table
+    op.add_column(
+        "postings",
+        sa.Column("search_vector", postgresql.TSVECTOR(), nullable=True),
+    )
+    op.execute(UPDATE_SEARCH_VECTOR_FUNCTION)
+    op.execute(
+        "CREATE TRIGGER postings_update_search_vector "
+        "BEFORE INSERT OR UPDATE OF title, location ON postings "
+        "FOR EACH ROW EXECUTE FUNCTION update_search_vector()"
+    )
+    # Backfill in short transactions so that each batch only locks its own rows
+    with op.get_context().autocommit_block():
+        max_id = op.get_bind().execute(sa.text("SELECT max(id) FROM postings"))
+        max_id = max_id.scalar() or 0
+        for start in range(0, max_id + 1, BACKFILL_BATCH_SIZE):
+            op.execute(
+                f"UPDATE postings SET search_vector = {SEARCH_VECTOR.format(row='')} "
+                f"WHERE id >= {start} AND id < {start + BACKFILL_BATCH_SIZE} "
+                "AND search_vector IS NULL"
+            )
+        op.create_index(
+            "ix_postings_search_vector",
+            "postings",
+            ["search_vector"],
+            postgresql_using="gin",
+            postgresql_concurrently=True,
+        )
+
+
+def downgrade():
+    op.drop_index("ix_postings_search_vector", table_name="postings")
+    op.execute("DROP TRIGGER postings_update_search_vector ON postings")
+    op.execute("DROP FUNCTION update_search_vector()")
+    op.drop_column("postings", "search_vector")
@@ -0,0 +1,197 @@
+"""Partition postings by week
+
+Revision ID: e61f908c9a24
+Revises: 01cbdc6b098a
+Create Date: 2026-10-18 19:52:03.418275
+
+"""
+import sqlalchemy as sa
+from alembic import op
+from sqlalchemy.dialects import postgresql
+
+# revision identifiers, used by Alembic.
+revision = "e61f908c9a24"
+down_revision = "01cbdc6b098a"
+branch_labels = None
+depends_on = None
+
+COLUMNS = (
+    "id, title, url, image_url, location, query, loc_query, date, bike, frame, "
+    "color, search_vector, postcode, lat, lon"
+)
+CREATE_PARTITIONS_FUNCTION = """
+CREATE OR REPLACE FUNCTION create_postings_partitions(
+    first_date timestamp, last_date timestamp
+) RETURNS integer AS $$
+DECLARE
+    week timestamp := date_trunc('week', first_date);
+    partition_name text;
+    num_created integer := 0;
+BEGIN
+    -- Concurrent callers would otherwise race to create the same partition
+    PERFORM pg_advisory_xact_lock(hashtext('create_postings_partitions'));
+    WHILE week <= last_date LOOP
+        partition_name := 'postings_' || to_char(week, 'IYYY"w"IW');
+        IF to_regclass(partition_name) IS NULL THEN
+            EXECUTE 'CREATE TABLE ' || quote_ident(partition_name)
+                || ' PARTITION OF postings FOR VALUES FROM ('
+                || quote_literal(week) || ') TO ('
+                || quote_literal(week + interval '1 week') || ')';
+            num_created := num_created + 1;
+        END IF;
+        week := week + interval '1 week';
+    END LOOP;
+    RETURN num_created;
+END;
+$$ LANGUAGE plpgsql
+"""
+TRIGGERS = [
+    "CREATE TRIGGER postings_update_search_vector "
+    "BEFORE INSERT OR UPDATE OF title, location ON postings "
+    "FOR EACH ROW EXECUTE FUNCTION update_search_vector()",
+    "CREATE TRIGGER postings_count_inserts AFTER INSERT ON postings "
+    "REFERENCING NEW TABLE AS new_rows "
+    "FOR EACH STATEMENT EXECUTE FUNCTION count_rows()",
+    "CREATE TRIGGER postings_count_deletes AFTER DELETE ON postings "
+    "REFERENCING OLD TABLE AS old_rows "
+    "FOR EACH STATEMENT EXECUTE FUNCTION count_rows()",
+    "CREATE TRIGGER postings_count_updates AFTER UPDATE ON postings "
+    "FOR EACH STATEMENT EXECUTE FUNCTION count_rows()",
+    "CREATE TRIGGER postings_count_facet_inserts AFTER INSERT ON postings "
+    "REFERENCING NEW TABLE AS new_rows "
+    "FOR EACH STATEMENT EXECUTE FUNCTION count_facets()",
+    "CREATE TRIGGER postings_count_facet_deletes AFTER DELETE ON postings "
+    "REFERENCING OLD TABLE AS old_rows "
+    "FOR EACH STATEMENT EXECUTE FUNCTION count_facets()",
+    "CREATE TRIGGER postings_count_facet_updates AFTER UPDATE ON postings "
+    "REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows "
+    "FOR EACH STATEMENT EXECUTE FUNCTION count_facets()",
+]
+INDEXES = [
+    "ix_postings_url",
+    "ix_postings_date_id",
+    "ix_postings_bike_date_id",
+    "ix_postings_frame_date_id",
+    "ix_postings_color_date_id",
+    "ix_postings_bike_frame_color_date_id",
+    "ix_postings_search_vector",
+    "ix_postings_coordinates",
+]
+
+
+def upgrade():
+    # Unique constraints of a partitioned table have to include the date, so
+    # corrections lose their foreign key and URLs their unique index
+    op.execute("LOCK TABLE postings, corrections IN ACCESS EXCLUSIVE MODE")
+    op.drop_constraint("corrections_posting_id_fkey", "corrections", type_="foreignkey")
+    _set_aside_postings("postings_unpartitioned")
+    _create_postings(partitioned=True)
+    op.execute(CREATE_PARTITIONS_FUNCTION)
+    op.execute(
+        "SELECT create_postings_partitions("
+        "coalesce(min(date), localtimestamp), "
+        "greatest(max(date), localtimestamp + interval '2 weeks')) "
+        "FROM postings_unpartitioned"
+    )
+    # Postings without date could not be placed in any partition. The
+    # counting triggers are only created afterwards, the counts stay valid.
+    op.execute(
+        f"INSERT INTO postings ({COLUMNS}) "
+        f"SELECT {COLUMNS.replace('date', 'coalesce(date, localtimestamp)')} "
+        "FROM postings_unpartitioned"
+    )
+    op.drop_table("postings_unpartitioned")
+    _create_indexes(unique_url=False)
+    for trigger in TRIGGERS:
+        op.execute(trigger)
+
+
+def downgrade():
+    op.execute("LOCK TABLE postings, corrections IN ACCESS EXCLUSIVE MODE")
+    _set_aside_postings("postings_partitioned")
+    _create_postings(partitioned=False)
+    op.execute(
+        f"INSERT INTO postings ({COLUMNS}) "
+        f"SELECT {COLUMNS} FROM postings_partitioned"
+    )
+    op.drop_table("postings_partitioned")
+    op.execute("DROP FUNCTION create_postings_partitions(timestamp, timestamp)")
+    _create_indexes(unique_url=True)
+    for trigger in TRIGGERS:
+        op.execute(trigger)
+    op.execute(
+        "DELETE FROM corrections WHERE posting_id NOT IN (SELECT id FROM postings)"
+    )
+    op.create_foreign_key(
+        "corrections_posting_id_fkey",
+        "corrections",
+        "postings",
+        ["posting_id"],
+        ["id"],
+        ondelete="CASCADE",
+    )
+
+
+def _set_aside_postings(new_name: str):
+    # Frees the names of the table, its key, sequence ownership and indexes
+    op.rename_table("postings", new_name)
+    op.execute(
+        f"ALTER TABLE {new_name} RENAME CONSTRAINT postings_pkey TO {new_name}_pkey"
+    )
+    op.execute("ALTER SEQUENCE postings_id_seq OWNED BY NONE")
+    for index in INDEXES:
+        op.drop_index(index, table_name=new_name)
+
+
+def _create_postings(partitioned: bool):
+    kwargs = {"postgresql_partition_by": "RANGE (date)"} if partitioned else {}
+    op.create_table(
+        "postings",
+        sa.Column(
+            "id",
+            sa.Integer(),
+            server_default=sa.text("nextval('postings_id_seq')"),
+            nullable=False,
+        ),
+        sa.Column("title", sa.String(), nullable=True),
+        sa.Column("url", sa.String(), nullable=True),
+        sa.Column("image_url", sa.String(), nullable=True),
+        sa.Column("location", sa.String(), nullable=True),
+        sa.Column("query", sa.String(), nullable=True),
+        sa.Column("loc_query", sa.String(), nullable=True),
+        sa.Column("date", sa.DateTime(), nullable=not partitioned),
+        sa.Column("bike", sa.String(), nullable=True),
+        sa.Column("frame", sa.String(), nullable=True),
+        sa.Column("color", sa.String(), nullable=True),
+        sa.Column("search_vector", postgresql.TSVECTOR(), nullable=True),
+        sa.Column("postcode", sa.String(), nullable=True),
+        sa.Column("lat", sa.Float(), nullable=True),
+        sa.Column("lon", sa.Float(), nullable=True),
+        sa.PrimaryKeyConstraint(*(["id", "date"] if partitioned else ["id"])),
+        **kwargs,
+    )
+    op.execute("ALTER SEQUENCE postings_id_seq OWNED BY postings.id")
+
+
+def _create_indexes(unique_url: bool):
+    op.create_index("ix_postings_url", "postings", ["url"], unique=unique_url)
+    op.create_index(
+        "ix_postings_date_id",
+        "postings",
+        [sa.text("date DESC"), sa.text("id DESC")],
+    )
+    for columns in (["bike"], ["frame"], ["color"], ["bike", "frame", "color"]):
+        op.create_index(
+            f"ix_postings_{'_'.join(columns)}_date_id",
+            "postings",
+            [*columns, sa.text("date DESC"), sa.text("id DESC")],
+        )
+    op.create_index(
+        "ix_postings_search_vector",
+        "postings",
+        ["search_vector"],
+        postgresql_using="gin",
+    )
+    op.execute(
+        "CREATE INDEX ix_postings_coordinates ON postings USING gist (point(lon, lat))"
+    )
@@ -0,0 +1,84 @@
+"""Add facet counts table
+
+Revision ID: ef01686f9bcc
+Revises: 38a9cdb9f503
+Create Date: 2026-10-18 16:22:47.391604
+
+"""
+import sqlalchemy as sa
+from alembic import op
+
+# revision identifiers, used by Alembic.
+revision = "ef01686f9bcc"
+down_revision = "38a9cdb9f503"
+branch_labels = None
+depends_on = None
+
+COUNT_FACETS_FUNCTION = """
+CREATE OR REPLACE FUNCTION count_facets() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP IN ('DELETE', 'UPDATE') THEN
+        UPDATE facet_counts SET posting_count = posting_count - removed.num
+        FROM (
+            SELECT coalesce(bike, '') AS bike, coalesce(frame, '') AS frame,
+                coalesce(color, '') AS color, count(*) AS num
+            FROM old_rows GROUP BY 1, 2, 3
+        ) AS removed
+        WHERE facet_counts.bike = removed.bike
+        AND facet_counts.frame = removed.frame
+        AND facet_counts.color = removed.color;
+        DELETE FROM facet_counts WHERE posting_count = 0;
+    END IF;
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        INSERT INTO facet_counts (bike, frame, color, posting_count)
+        SELECT coalesce(bike, ''), coalesce(frame, ''), coalesce(color, ''), count(*)
+        FROM new_rows GROUP BY 1, 2, 3
+        ON CONFLICT (bike, frame, color) DO UPDATE
+        SET posting_count = facet_counts.posting_count + excluded.posting_count;
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql
+"""
+
+
+def upgrade():
+    op.create_table(
+        "facet_counts",
+        sa.Column("bike", sa.String(), nullable=False),
+        sa.Column("frame", sa.String(), nullable=False),
+        sa.Column("color", sa.String(), nullable=False),
+        sa.Column("posting_count", sa.Integer(), nullable=False),
+        sa.PrimaryKeyConstraint("bike", "frame", "color"),
+    )
+    op.execute(COUNT_FACETS_FUNCTION)
+    # Block writers until the triggers are in place and the counts are seeded
+    op.execute("LOCK TABLE postings IN SHARE ROW EXCLUSIVE MODE")
+    op.execute(
+        "CREATE TRIGGER postings_count_facet_inserts AFTER INSERT ON postings "
+        "REFERENCING NEW TABLE AS new_rows "
+        "FOR EACH STATEMENT EXECUTE FUNCTION count_facets()"
+    )
+    op.execute(
+        "CREATE TRIGGER postings_count_facet_deletes AFTER DELETE ON postings "
+        "REFERENCING OLD TABLE AS old_rows "
+        "FOR EACH STATEMENT EXECUTE FUNCTION count_facets()"
+    )
+    op.execute(
+        "CREATE TRIGGER postings_count_facet_updates AFTER UPDATE ON postings "
+        "REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows "
+        "FOR EACH STATEMENT EXECUTE FUNCTION count_facets()"
+    )
+    op.execute(
+        "INSERT INTO facet_counts (bike, frame, color, posting_count) "
+        "SELECT coalesce(bike, ''), coalesce(frame, ''), coalesce(color, ''), "
+        "count(*) FROM postings GROUP BY 1, 2, 3"
+    )
+
+
+def downgrade():
+    op.execute("DROP TRIGGER postings_count_facet_updates ON postings")
+    op.execute("DROP TRIGGER postings_count_facet_deletes ON postings")
+    op.execute("DROP TRIGGER postings_count_facet_inserts ON postings")
+    op.execute("DROP FUNCTION count_facets()")
+    op.drop_table("facet_counts")
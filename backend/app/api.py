@@ -1,26 +1,90 @@
+import asyncio
+import contextlib
+import hashlib
 import os
-from typing import Optional
+from typing import AsyncIterator, Literal, Optional
 
-from fastapi import Depends, FastAPI, HTTPException
+from fastapi import (
+    Cookie,
+    Depends,
+    FastAPI,
+    Header,
+    HTTPException,
+    Query,
+    Request,
+    Response,
+)
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import PlainTextResponse, StreamingResponse
 from fastapi.security.api_key import APIKey
-from starlette.status import HTTP_500_INTERNAL_SERVER_ERROR, HTTP_201_CREATED
+from pydantic import ValidationError
+from starlette.status import (
+    HTTP_500_INTERNAL_SERVER_ERROR,
+    HTTP_503_SERVICE_UNAVAILABLE,
+    HTTP_201_CREATED,
+    HTTP_304_NOT_MODIFIED,
+    HTTP_400_BAD_REQUEST,
+    HTTP_422_UNPROCESSABLE_ENTITY,
+)
 
-from backend.app import models
-from backend.app.security import get_api_key, get_admin_key
+from backend.app import metrics, models
+from backend.app.cache import CachedResponse, ResponseCache
+from backend.app.janitor import EvictionJanitor
+from backend.app.security import (
+    COOKIE_DOMAIN,
+    get_api_key,
+    get_admin_key,
+    sign_read_after,
+    verify_read_after,
+)
 from backend.app.validation import (
-    Posting,
+    CacheStats,
+    Facets,
     PostingList,
+    IncomingPosting,
     IncomingPostingList,
+    IngestReport,
     IncomingCorrection,
+    IncomingCorrectionList,
+    CorrectionReport,
     CorrectedPostingList,
+    CorrectionFeed,
     flatten,
+    dump_posting_list,
+    dump_posting_events,
+    dump_corrected_posting_list,
+    dump_correction_feed,
+    dump_export_csv,
+    dump_export_ndjson,
+    encode_cursor,
+    decode_cursor,
 )
 
 TITLE = "Find-My-Bike API"
 VERSION = "0.1.0"
+BULK_CHUNK_SIZE = 5000
+EXPORT_CHUNK_SIZE = 1000
+EXPORT_MEDIA_TYPES = {"ndjson": "application/x-ndjson", "csv": "text/csv"}
+READ_AFTER_NAME = "read_after"
+READ_AFTER_MAX_AGE = 60
+LIVE_MAX_CLIENTS = int(os.getenv("LIVE_MAX_CLIENTS", 100))  # Per worker process
+LIVE_KEEPALIVE = 15  # Seconds between comments that keep idle connections open
+
+posting_cache = ResponseCache(
+    max_bytes=int(os.getenv("POSTING_CACHE_BYTES", 16 * 1024 * 1024)),
+    ttl=float(os.getenv("POSTING_CACHE_TTL", 60)),
+)
+janitor = EvictionJanitor(
+    interval=float(os.getenv("EVICTION_INTERVAL", 5)),
+    chunk_size=int(os.getenv("EVICTION_CHUNK_SIZE", 500)),
+)
+metrics.eviction_backlog.set_function(lambda: janitor.backlog)
+metrics.eviction_lag.set_function(janitor.lag)
+metrics.live_clients.set_function(lambda: len(models.new_postings))
+metrics_dumper: Optional[asyncio.Task] = None
 
 app = FastAPI()
+app.add_middleware(metrics.MetricsMiddleware)
 
 origins = [
     "http://localhost:3000",
@@ -37,65 +101,495 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    # The frontend sends the token back on its reads that follow a correction
+    expose_headers=["Read-After"],
 )
 
 
 @app.on_event("startup")
 async def startup() -> None:
+    global metrics_dumper
     await models.connect()
+    await models.warm_up()
+    janitor.start()
+    models.start_listening()
+    if metrics.METRICS_DIR is not None:
+        metrics_dumper = asyncio.create_task(
+            metrics.dump_periodically(metrics.METRICS_DIR)
+        )
 
 
 @app.on_event("shutdown")
 async def shutdown() -> None:
+    if metrics_dumper is not None:
+        metrics_dumper.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await metrics_dumper
+    await models.stop_listening()
+    await janitor.stop()
     await models.disconnect()
 
 
+async def read_your_writes(
+    read_after_header: Optional[str] = Header(None, alias="Read-After"),
+    read_after_cookie: Optional[str] = Cookie(None, alias=READ_AFTER_NAME),
+):
+    # Reads that follow a write of the same client must not be answered by a
+    # replica that has not replayed that write yet
+    read_after = read_after_header or read_after_cookie
+    if read_after is None:
+        return
+    try:
+        lsn = verify_read_after(read_after)
+    except ValueError as e:
+        raise HTTPException(status_code=HTTP_400_BAD_REQUEST, detail=str(e))
+    await models.read_after(lsn)
+
+
 @app.get("/", tags=["root"])
 async def root() -> dict[str, str]:
     return {"message": "This is the Find-My-Bike API"}
 
 
-@app.get("/posting", tags=["postings"], response_model=PostingList)
+@app.get(
+    "/posting",
+    tags=["postings"],
+    response_model=PostingList,
+    dependencies=[Depends(read_your_writes)],
+)
 async def get_postings(
     bike: Optional[str] = None,
     frame: Optional[str] = None,
     color: Optional[str] = None,
     skip: Optional[int] = 0,
     limit: Optional[int] = 10,
+    cursor: Optional[str] = None,
+    q: Optional[str] = None,
+    order: Literal["date", "rank"] = "date",
+    lat: Optional[float] = Query(None, ge=-90, le=90),
+    lon: Optional[float] = Query(None, ge=-180, le=180),
+    radius_km: Optional[float] = Query(None, gt=0, le=1000),
+    consensus_bike: Optional[str] = None,
+    consensus_frame: Optional[str] = None,
+    consensus_color: Optional[str] = None,
+    if_none_match: Optional[str] = Header(None),
     api_key: APIKey = Depends(get_api_key),
-) -> PostingList:
-    postings = await models.query_postings(bike, color, frame, limit, skip)
-    postings = [Posting(**{**p, "prediction": {**p}}) for p in postings]
+) -> Response:
+    if q is not None and not q.strip():
+        q = None
+    if order == "rank" and q is None:
+        raise HTTPException(
+            status_code=HTTP_400_BAD_REQUEST,
+            detail="Ordering by rank needs a search query",
+        )
+    if len({lat is None, lon is None, radius_km is None}) > 1:
+        raise HTTPException(
+            status_code=HTTP_400_BAD_REQUEST,
+            detail="Radius search needs lat, lon and radius_km",
+        )
+    params = (
+        bike,
+        frame,
+        color,
+        skip,
+        limit,
+        cursor,
+        q,
+        order,
+        lat,
+        lon,
+        radius_km,
+        consensus_bike,
+        consensus_frame,
+        consensus_color,
+    )
+    # Clients reading their own writes may need the primary, which is ahead of
+    # the replica, so they share entries with the other readers of the primary
+    cache_key = (*params, models.read_from_primary.get())
+    # Read where the rows would be read from, so that every worker and replica
+    # validates entries against the state it would answer with. Hits cost this
+    # point read, but not the listing query. Entries are stored under the
+    # generation read together with their rows.
+    generation = await models.get_write_generation(models.postings)
+    cached = posting_cache.get(cache_key, generation)
+    if cached is not None:
+        etag = cached.etag
+    else:
+        etag = _make_etag(generation, *params)
+    if _etag_matches(if_none_match, etag):
+        return Response(status_code=HTTP_304_NOT_MODIFIED, headers={"ETag": etag})
+    if cached is None:
+        body, generation = await _query_postings(*params)
+        cached = CachedResponse(body, _make_etag(generation, *params))
+        posting_cache.put(cache_key, generation, cached)
+
+    return Response(
+        content=cached.body,
+        media_type="application/json",
+        headers={"ETag": cached.etag},
+    )
 
-    return PostingList(data=postings)
 
+async def _query_postings(
+    bike,
+    frame,
+    color,
+    skip,
+    limit,
+    cursor,
+    q,
+    order,
+    lat,
+    lon,
+    radius_km,
+    consensus_bike,
+    consensus_frame,
+    consensus_color,
+) -> tuple[bytes, int]:
+    if cursor is not None:
+        try:
+            cursor = decode_cursor(cursor)
+        except ValueError as e:
+            raise HTTPException(status_code=HTTP_400_BAD_REQUEST, detail=str(e))
+        if isinstance(cursor[0], float) != (order == "rank"):
+            raise HTTPException(
+                status_code=HTTP_400_BAD_REQUEST,
+                detail=f"Cursor does not belong to ordering by {order}",
+            )
+    postings, generation = await models.query_postings_with_generation(
+        bike,
+        color,
+        frame,
+        limit,
+        skip,
+        cursor,
+        q,
+        order,
+        lat,
+        lon,
+        radius_km,
+        consensus_bike,
+        consensus_frame,
+        consensus_color,
+    )
+    if postings and len(postings) == limit:
+        next_cursor = encode_cursor(postings[-1]["sort_key"], postings[-1]["id"])
+    else:
+        next_cursor = None
+    with metrics.serialization_duration.labels("/posting").time():
+        body = dump_posting_list(postings, next_cursor)
 
-@app.post("/posting", tags=["postings"], status_code=HTTP_201_CREATED)
+    return body, generation
+
+
+@app.post(
+    "/posting",
+    tags=["postings"],
+    status_code=HTTP_201_CREATED,
+    response_model=IngestReport,
+)
 async def add_postings(
     in_postings: IncomingPostingList, api_key: APIKey = Depends(get_admin_key)
-) -> None:
+) -> IngestReport:
     processed_postings = [
         flatten(post, nested="prediction") for post in in_postings.data
     ]
-    await models.add_postings(processed_postings)
+    try:
+        report = await models.add_postings(processed_postings)
+    except ValueError as e:
+        raise HTTPException(status_code=HTTP_422_UNPROCESSABLE_ENTITY, detail=str(e))
+    janitor.wake()
+
+    return report
 
 
-@app.get("/correction", tags=["corrections"], response_model=CorrectedPostingList)
-async def get_corrections(api_key: APIKey = Depends(get_admin_key)):
-    corrections = await models.get_corrections()
+@app.post(
+    "/posting/bulk",
+    tags=["postings"],
+    status_code=HTTP_201_CREATED,
+    response_model=IngestReport,
+)
+async def bulk_add_postings(
+    request: Request, api_key: APIKey = Depends(get_admin_key)
+) -> IngestReport:
+    # Postings arrive as NDJSON and are copied in chunks to bound memory usage
+    report = IngestReport()
+    chunk = []
+    async for line_number, line in _iter_lines(request.stream()):
+        try:
+            posting = IncomingPosting.parse_raw(line)
+        except ValidationError as e:
+            raise HTTPException(
+                status_code=HTTP_422_UNPROCESSABLE_ENTITY,
+                detail=f"Invalid posting on line {line_number} "
+                f"after {report.inserted} postings were inserted: {e}",
+            )
+        chunk.append(flatten(posting, nested="prediction"))
+        if len(chunk) == BULK_CHUNK_SIZE:
+            await _ingest_chunk(chunk, report)
+            chunk = []
+    if chunk:
+        await _ingest_chunk(chunk, report)
+
+    return report
+
+
+async def _ingest_chunk(chunk: list[dict], report: IngestReport) -> None:
+    try:
+        chunk_report = await models.bulk_add_postings(chunk)
+    except ValueError as e:
+        raise HTTPException(
+            status_code=HTTP_422_UNPROCESSABLE_ENTITY,
+            detail=f"Invalid chunk after {report.inserted} postings were inserted: {e}",
+        )
+    report.inserted += chunk_report.inserted
+    report.updated += chunk_report.updated
+    report.evicted += chunk_report.evicted
+    janitor.wake()
+
+
+async def _iter_lines(stream: AsyncIterator[bytes]) -> AsyncIterator[tuple[int, bytes]]:
+    line_number = 0
+    buffer = b""
+    async for data in stream:
+        buffer += data
+        *lines, buffer = buffer.split(b"\n")
+        for line in lines:
+            line_number += 1
+            if line.strip():
+                yield line_number, line
+    if buffer.strip():
+        yield line_number + 1, buffer
+
+
+@app.get("/posting/live", tags=["postings"])
+async def get_live_postings(
+    bike: Optional[str] = None,
+    frame: Optional[str] = None,
+    color: Optional[str] = None,
+    api_key: APIKey = Depends(get_api_key),
+) -> StreamingResponse:
+    # Pushes postings as they are inserted, as server-sent events
+    if len(models.new_postings) >= LIVE_MAX_CLIENTS:
+        raise HTTPException(
+            status_code=HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Too many clients on the live feed",
+            headers={"Retry-After": str(LIVE_KEEPALIVE)},
+        )
+    names = {"bike": bike, "frame": frame, "color": color}
+    filters = {aspect: name for aspect, name in names.items() if name is not None}
 
-    return CorrectedPostingList(data=corrections)
+    return StreamingResponse(
+        _stream_live_postings(filters),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+async def _stream_live_postings(filters: dict[str, str]) -> AsyncIterator[bytes]:
+    # Subscribes only once the response started, so that it always unsubscribes
+    subscription = models.new_postings.subscribe(
+        lambda posting: all(posting[a] == name for a, name in filters.items())
+    )
+    # The pending read outlives keepalives, so no posting is lost to a timeout
+    next_postings = None
+    try:
+        while True:
+            if next_postings is None:
+                next_postings = asyncio.ensure_future(subscription.get())
+            done, _ = await asyncio.wait({next_postings}, timeout=LIVE_KEEPALIVE)
+            if not done:
+                yield b": keepalive\n\n"
+                continue
+            postings = next_postings.result()
+            next_postings = None
+            if postings is None:
+                # Fell behind, the client reconnects and reloads the listing
+                yield b"event: cut_off\ndata: {}\n\n"
+                return
+            yield dump_posting_events(postings)
+    finally:
+        if next_postings is not None:
+            next_postings.cancel()
+        models.new_postings.unsubscribe(subscription)
+
+
+@app.get(
+    "/posting/facets",
+    tags=["postings"],
+    response_model=Facets,
+    dependencies=[Depends(read_your_writes)],
+)
+async def get_facets(
+    bike: Optional[str] = None,
+    frame: Optional[str] = None,
+    color: Optional[str] = None,
+    api_key: APIKey = Depends(get_api_key),
+) -> Facets:
+    facets = await models.get_facets(bike, color, frame)
+
+    return Facets(**facets)
+
+
+@app.get("/posting/cache", tags=["postings"], response_model=CacheStats)
+async def get_posting_cache_stats(
+    api_key: APIKey = Depends(get_admin_key),
+) -> CacheStats:
+    return CacheStats(**posting_cache.stats())
+
+
+@app.get("/metrics", tags=["metrics"], response_class=PlainTextResponse)
+async def get_metrics(api_key: APIKey = Depends(get_admin_key)) -> PlainTextResponse:
+    if metrics.METRICS_DIR is not None:
+        rendered = metrics.render_all_workers(metrics.METRICS_DIR)
+    else:
+        rendered = metrics.render()
+    return PlainTextResponse(rendered, media_type="text/plain; version=0.0.4")
+
+
+@app.get(
+    "/correction",
+    tags=["corrections"],
+    response_model=CorrectedPostingList,
+    dependencies=[Depends(read_your_writes)],
+)
+async def get_corrections(
+    if_none_match: Optional[str] = Header(None),
+    api_key: APIKey = Depends(get_admin_key),
+):
+    generation = await models.get_write_generation(models.postings, models.corrections)
+    etag = _make_etag(generation)
+    if _etag_matches(if_none_match, etag):
+        return Response(status_code=HTTP_304_NOT_MODIFIED, headers={"ETag": etag})
+    corrections = await models.query_corrections()
+    with metrics.serialization_duration.labels("/correction").time():
+        body = dump_corrected_posting_list(corrections)
+
+    return Response(
+        content=body,
+        media_type="application/json",
+        headers={"ETag": etag},
+    )
+
+
+@app.get(
+    "/correction/feed",
+    tags=["corrections"],
+    response_model=CorrectionFeed,
+    dependencies=[Depends(read_your_writes)],
+)
+async def get_correction_feed(
+    since: int = Query(0, ge=0),
+    limit: int = Query(1000, gt=0, le=10000),
+    api_key: APIKey = Depends(get_admin_key),
+):
+    corrected_postings, deleted, watermark, stale = await models.query_correction_feed(
+        since, limit
+    )
+    with metrics.serialization_duration.labels("/correction/feed").time():
+        body = dump_correction_feed(corrected_postings, deleted, watermark, stale)
+
+    return Response(content=body, media_type="application/json")
+
+
+@app.get(
+    "/correction/export", tags=["corrections"], dependencies=[Depends(read_your_writes)]
+)
+async def export_corrections(
+    format: Literal["ndjson", "csv"] = "ndjson",
+    api_key: APIKey = Depends(get_admin_key),
+):
+    return StreamingResponse(
+        _stream_export(format), media_type=EXPORT_MEDIA_TYPES[format]
+    )
+
+
+async def _stream_export(format: str) -> AsyncIterator[bytes]:
+    # Each chunk is only read from the cursor after the previous one was sent
+    if format == "csv":
+        yield dump_export_csv([], header=True)
+    dump = dump_export_csv if format == "csv" else dump_export_ndjson
+    chunk = []
+    async for record in models.iter_corrections():
+        chunk.append(record)
+        if len(chunk) == EXPORT_CHUNK_SIZE:
+            yield dump(chunk)
+            chunk = []
+    if chunk:
+        yield dump(chunk)
 
 
 @app.post("/correction", tags=["corrections"], status_code=HTTP_201_CREATED)
 async def add_correction(
-    correction: IncomingCorrection, api_key: APIKey = Depends(get_api_key)
+    correction: IncomingCorrection,
+    response: Response,
+    api_key: APIKey = Depends(get_api_key),
 ):
     processed_correction = flatten(correction, nested="correction")
     try:
-        await models.add_corrections(processed_correction)
+        lsn = await models.add_corrections(processed_correction)
+    except ValueError as e:
+        raise HTTPException(status_code=HTTP_422_UNPROCESSABLE_ENTITY, detail=str(e))
     except RuntimeError:
         raise HTTPException(
             status_code=HTTP_500_INTERNAL_SERVER_ERROR,
             detail=f"Posting ID not found",
         )
+    janitor.wake()
+    _set_read_after(response, lsn)
+
+
+@app.post(
+    "/correction/batch",
+    tags=["corrections"],
+    status_code=HTTP_201_CREATED,
+    response_model=CorrectionReport,
+)
+async def add_correction_batch(
+    in_corrections: IncomingCorrectionList,
+    response: Response,
+    api_key: APIKey = Depends(get_api_key),
+) -> CorrectionReport:
+    processed_corrections = [
+        flatten(correction, nested="correction") for correction in in_corrections.data
+    ]
+    try:
+        unknown, lsn = await models.add_correction_batch(processed_corrections)
+    except ValueError as e:
+        raise HTTPException(status_code=HTTP_422_UNPROCESSABLE_ENTITY, detail=str(e))
+    janitor.wake()
+    _set_read_after(response, lsn)
+    inserted = sum(c["posting_id"] not in unknown for c in processed_corrections)
+
+    return CorrectionReport(inserted=inserted, unknown=unknown)
+
+
+def _set_read_after(response: Response, lsn: int) -> None:
+    if lsn:
+        token = sign_read_after(lsn)
+        response.headers["Read-After"] = token
+        response.set_cookie(
+            READ_AFTER_NAME,
+            value=token,
+            domain=COOKIE_DOMAIN,
+            httponly=True,
+            max_age=READ_AFTER_MAX_AGE,
+            expires=READ_AFTER_MAX_AGE,
+        )
+
+
+def _make_etag(generation: int, *params) -> str:
+    digest = hashlib.blake2b(repr((VERSION, params)).encode(), digest_size=8)
+
+    return f'W/"{generation}-{digest.hexdigest()}"'
+
+
+def _etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    if if_none_match is None:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    # If-None-Match uses weak comparison, so the W/ prefix does not matter
+    candidates = {tag.strip().removeprefix("W/") for tag in if_none_match.split(",")}
+
+    return etag.removeprefix("W/") in candidates
@@ -0,0 +1,62 @@
+import asyncio
+from typing import Any, Callable, Iterable, Optional
+
+
+class Subscription:
+    # Items wait in a bounded queue until the subscriber reads them. One that
+    # falls behind by a full queue is cut off instead of holding up publishers.
+    def __init__(self, accept: Callable[[Any], bool], max_size: int):
+        self.accept = accept
+        self.cut_off = False
+        self._queue: asyncio.Queue = asyncio.Queue(max_size)
+
+    def offer(self, item: Any) -> bool:
+        # Returns False if the subscriber was cut off by this item
+        if self.cut_off or not self.accept(item):
+            return True
+        try:
+            self._queue.put_nowait(item)
+        except asyncio.QueueFull:
+            self.cut_off = True
+            return False
+        return True
+
+    async def get(self) -> Optional[list]:
+        # Waits for the next items and returns all that are queued, or None
+        # once the subscriber was cut off
+        if self.cut_off:
+            return None
+        items = [await self._queue.get()]
+        while not self._queue.empty():
+            items.append(self._queue.get_nowait())
+        return items
+
+
+class Broadcaster:
+    # Fans items out to the subscribers of this process without ever waiting
+    # for one of them
+    def __init__(self, max_queue_size: int, counter=None):
+        self.max_queue_size = max_queue_size
+        self.counter = counter  # Incremented for every subscriber cut off
+        self._subscriptions: set[Subscription] = set()
+
+    def __len__(self) -> int:
+        return len(self._subscriptions)
+
+    def subscribe(self, accept: Callable[[Any], bool] = lambda item: True):
+        subscription = Subscription(accept, self.max_queue_size)
+        self._subscriptions.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription) -> None:
+        self._subscriptions.discard(subscription)
+
+    def publish(self, items: Iterable[Any]) -> None:
+        items = list(items)
+        for subscription in list(self._subscriptions):
+            for item in items:
+                if not subscription.offer(item):
+                    self.unsubscribe(subscription)
+                    if self.counter is not None:
+                        self.counter.inc()
+                    break
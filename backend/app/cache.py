@@ -0,0 +1,105 @@
+import asyncio
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Hashable, NamedTuple, Optional
+
+
+class CachedResponse(NamedTuple):
+    body: bytes
+    etag: str
+
+
+class _Entry(NamedTuple):
+    generation: int
+    expires_at: float
+    response: CachedResponse
+
+
+class ResponseCache:
+    def __init__(self, max_bytes: int, ttl: float):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries: OrderedDict[Hashable, _Entry] = OrderedDict()
+
+    def get(self, key: Hashable, generation: int) -> Optional[CachedResponse]:
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        if entry.generation < generation or entry.expires_at < time.monotonic():
+            # Written since caching or expired, the entry can never hit again
+            self._evict(key)
+            self.misses += 1
+            return None
+        if entry.generation > generation:
+            # The caller reads from a server that is behind, the entry stays
+            # for the callers that are not
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+
+        return entry.response
+
+    def put(self, key: Hashable, generation: int, response: CachedResponse) -> None:
+        if len(response.body) > self.max_bytes:
+            return
+        if key in self._entries:
+            if self._entries[key].generation > generation:
+                return
+            self._remove(key)
+        expires_at = time.monotonic() + self.ttl
+        self._entries[key] = _Entry(generation, expires_at, response)
+        self.size += len(response.body)
+        while self.size > self.max_bytes:
+            self._evict(next(iter(self._entries)))
+
+    def clear(self) -> None:
+        self._entries.clear()
+        self.size = 0
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "entries": len(self._entries),
+            "size": self.size,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+    def _evict(self, key: Hashable) -> None:
+        self._remove(key)
+        self.evictions += 1
+
+    def _remove(self, key: Hashable) -> None:
+        self.size -= len(self._entries.pop(key).response.body)
+
+
+class SingleFlight:
+    # Concurrent calls with the same key share one execution of the function,
+    # including the exception it raises
+    def __init__(self, counter=None):
+        self.counter = counter  # Incremented for every call that joins another
+        self._futures: dict[Hashable, asyncio.Future] = {}
+
+    async def do(self, key: Hashable, function: Callable[[], Awaitable[Any]]) -> Any:
+        future = self._futures.get(key)
+        if future is None:
+            future = asyncio.ensure_future(function())
+            self._futures[key] = future
+            future.add_done_callback(lambda f: self._done(key, f))
+        elif self.counter is not None:
+            self.counter.inc()
+        # A cancelled caller must not cancel the call the others wait for
+        return await asyncio.shield(future)
+
+    def _done(self, key: Hashable, future: asyncio.Future) -> None:
+        if self._futures.get(key) is future:
+            del self._futures[key]
+        if not future.cancelled():
+            future.exception()  # Retrieved, even if every caller was cancelled
@@ -0,0 +1,76 @@
+import asyncio
+import contextlib
+import logging
+import time
+from datetime import datetime
+from typing import Optional
+
+from backend.app import models
+
+logger = logging.getLogger(__name__)
+
+
+class EvictionJanitor:
+    # Evicts old postings in the background so that writes do not have to, and
+    # creates the partitions of the coming weeks before postings arrive for them.
+    # With several worker processes, the one holding the janitor lock does.
+    def __init__(self, interval: float, chunk_size: int):
+        self.interval = interval
+        self.chunk_size = chunk_size
+        self.backlog = 0
+        self.behind_since: Optional[float] = None
+        self._wakeup: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self) -> None:
+        self._wakeup = asyncio.Event()
+        self._task = models.start_background_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self._task
+            self._task = self._wakeup = None
+
+    def wake(self) -> None:
+        # Called after writes, so that eviction does not wait for the interval
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    def lag(self) -> float:
+        if self.behind_since is None:
+            return 0.0
+        return time.monotonic() - self.behind_since
+
+    async def evict(self) -> int:
+        num_evicted = 0
+        while True:
+            evicted, self.backlog = await models.evict_over_high_water(self.chunk_size)
+            num_evicted += evicted
+            if not self.backlog:
+                self.behind_since = None
+                return num_evicted
+            if self.behind_since is None:
+                self.behind_since = time.monotonic()
+            if not evicted:
+                # The table was locked, try again after the interval
+                return num_evicted
+            # Each chunk is its own transaction, let waiting writers go first
+            await asyncio.sleep(0)
+
+    async def _run(self) -> None:
+        while True:
+            self._wakeup.clear()
+            try:
+                async with models.janitor_lock() as acquired:
+                    if acquired:
+                        now = datetime.now()
+                        await models.create_postings_partitions(
+                            now, now + models.PARTITIONS_AHEAD
+                        )
+                        await self.evict()
+            except Exception:
+                logger.exception("Evicting old postings failed")
+            with contextlib.suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(self._wakeup.wait(), self.interval)
@@ -0,0 +1,413 @@
+import abc
+import asyncio
+import bisect
+import contextlib
+import functools
+import json
+import os
+import pathlib
+import time
+from typing import Callable, Iterable, Optional, Sequence
+
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+# With several worker processes, each one dumps its samples into this directory
+# and a scrape of any of them merges the dumps of all
+METRICS_DIR = os.getenv("METRICS_DIR")
+DUMP_INTERVAL = float(os.getenv("METRICS_DUMP_INTERVAL", 5))
+# Gauges of workers that have not dumped for this long are left out
+GAUGE_MAX_AGE = 3 * DUMP_INTERVAL
+
+
+class _Metric(abc.ABC):
+    kind = ""
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Sequence[str] = (),
+        registry: Optional[list] = None,
+    ):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children = {}
+        (REGISTRY if registry is None else registry).append(self)
+
+    def labels(self, *labelvalues: str):
+        child = self._children.get(labelvalues)
+        if child is None:
+            child = self._children[labelvalues] = self._new_child()
+        return child
+
+    def render(self) -> list[str]:
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.kind}",
+        ]
+        for labelvalues, child in sorted(self._children.items()):
+            lines.extend(self._render_child(labelvalues, child))
+        return lines
+
+    def dump(self) -> list:
+        samples = []
+        for labelvalues, child in self._children.items():
+            sample = self._dump_child(child)
+            if sample is not None:
+                samples.append([list(labelvalues), sample])
+        return samples
+
+    def merge(self, dumps: dict[str, dict]) -> "_Metric":
+        # A copy of the metric holding the samples of all workers' dumps
+        merged = self._empty_copy()
+        for worker, dump in dumps.items():
+            for labelvalues, sample in dump.get(self.name, ()):
+                merged._merge_sample(worker, tuple(labelvalues), sample)
+        return merged
+
+    @abc.abstractmethod
+    def _new_child(self):
+        ...
+
+    @abc.abstractmethod
+    def _render_child(self, labelvalues: tuple[str, ...], child) -> Iterable[str]:
+        ...
+
+    @abc.abstractmethod
+    def _dump_child(self, child):
+        ...
+
+    @abc.abstractmethod
+    def _empty_copy(self) -> "_Metric":
+        ...
+
+    @abc.abstractmethod
+    def _merge_sample(self, worker: str, labelvalues: tuple[str, ...], sample):
+        ...
+
+    def _format_labels(self, labelvalues, extra: str = "") -> str:
+        pairs = [f'{n}="{_escape(v)}"' for n, v in zip(self.labelnames, labelvalues)]
+        if extra:
+            pairs.append(extra)
+        return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class _CounterChild:
+    def __init__(self):
+        self.value = 0.0
+
+    def inc(self, amount: float = 1) -> None:
+        self.value += amount
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, amount: float = 1) -> None:
+        self.labels().inc(amount)
+
+    def _new_child(self):
+        return _CounterChild()
+
+    def _render_child(self, labelvalues, child):
+        yield f"{self.name}{self._format_labels(labelvalues)} {child.value}"
+
+    def _dump_child(self, child):
+        return child.value
+
+    def _empty_copy(self):
+        return Counter(self.name, self.documentation, self.labelnames, registry=[])
+
+    def _merge_sample(self, worker, labelvalues, sample):
+        # Counts of all workers add up
+        self.labels(*labelvalues).inc(sample)
+
+
+class _GaugeChild:
+    def __init__(self):
+        self.value = 0.0
+        self.function: Optional[Callable[[], Optional[float]]] = None
+
+    def set(self, value: float) -> None:
+        self.value = value
+
+    def inc(self, amount: float = 1) -> None:
+        self.value += amount
+
+    def dec(self, amount: float = 1) -> None:
+        self.value -= amount
+
+    def get(self) -> Optional[float]:
+        return self.function() if self.function is not None else self.value
+
+
+class Gauge(_Metric):
+    # Gauges are either set directly or read from a callback when rendering,
+    # which costs nothing between scrapes
+    kind = "gauge"
+
+    def set(self, value: float) -> None:
+        self.labels().set(value)
+
+    def set_function(
+        self, function: Callable[[], Optional[float]], *labelvalues: str
+    ) -> None:
+        self.labels(*labelvalues).function = function
+
+    def _new_child(self):
+        return _GaugeChild()
+
+    def _render_child(self, labelvalues, child):
+        value = child.get()
+        if value is not None:
+            yield f"{self.name}{self._format_labels(labelvalues)} {value}"
+
+    def _dump_child(self, child):
+        return child.get()
+
+    def _empty_copy(self):
+        return Gauge(
+            self.name, self.documentation, (*self.labelnames, "worker"), registry=[]
+        )
+
+    def _merge_sample(self, worker, labelvalues, sample):
+        # Values of different workers do not add up in general, e.g. the
+        # janitor's backlog, so each worker reports its own
+        self.labels(*labelvalues, worker).set(sample)
+
+
+class _HistogramChild:
+    def __init__(self, buckets: Sequence[float]):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    @contextlib.contextmanager
+    def time(self):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start)
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Sequence[str] = (),
+        buckets: Sequence[float] = DEFAULT_BUCKETS,
+        registry: Optional[list] = None,
+    ):
+        super().__init__(name, documentation, labelnames, registry)
+        self.buckets = tuple(buckets)
+
+    def time(self, *labelvalues: str):
+        # Decorates a coroutine function and observes how long each call takes
+        child = self.labels(*labelvalues)
+
+        def decorator(function):
+            @functools.wraps(function)
+            async def wrapper(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return await function(*args, **kwargs)
+                finally:
+                    child.observe(time.perf_counter() - start)
+
+            return wrapper
+
+        return decorator
+
+    def _new_child(self):
+        return _HistogramChild(self.buckets)
+
+    def _render_child(self, labelvalues, child):
+        cumulative = 0
+        for bound, count in zip((*self.buckets, "+Inf"), child.counts):
+            cumulative += count
+            labels = self._format_labels(labelvalues, f'le="{bound}"')
+            yield f"{self.name}_bucket{labels} {cumulative}"
+        labels = self._format_labels(labelvalues)
+        yield f"{self.name}_sum{labels} {child.sum}"
+        yield f"{self.name}_count{labels} {cumulative}"
+
+    def _dump_child(self, child):
+        return [child.counts, child.sum]
+
+    def _empty_copy(self):
+        return Histogram(
+            self.name,
+            self.documentation,
+            self.labelnames,
+            buckets=self.buckets,
+            registry=[],
+        )
+
+    def _merge_sample(self, worker, labelvalues, sample):
+        counts, total = sample
+        child = self.labels(*labelvalues)
+        child.counts = [a + b for a, b in zip(child.counts, counts)]
+        child.sum += total
+
+
+REGISTRY: list[_Metric] = []
+
+
+def render(registry: Optional[list] = None) -> str:
+    registry = REGISTRY if registry is None else registry
+    return "\n".join(line for metric in registry for line in metric.render()) + "\n"
+
+
+def render_all_workers(directory: str, registry: Optional[list] = None) -> str:
+    # Counters and histograms are summed over the dumps of all workers, also
+    # ones that exited, so that totals never go down. Gauges get a worker label.
+    registry = REGISTRY if registry is None else registry
+    write_dump(directory, registry)
+    dumps, recent_dumps = {}, {}
+    for path in pathlib.Path(directory).glob("*.json"):
+        try:
+            dumped = json.loads(path.read_text())
+        except (OSError, ValueError):
+            continue  # Removed or replaced in the meantime
+        dumps[path.stem] = dumped["samples"]
+        if time.time() - dumped["time"] <= GAUGE_MAX_AGE and not dumped["final"]:
+            recent_dumps[path.stem] = dumped["samples"]
+    merged = [
+        metric.merge(recent_dumps if isinstance(metric, Gauge) else dumps)
+        for metric in registry
+    ]
+    return render(merged)
+
+
+def write_dump(directory: str, registry: Optional[list] = None, final=False) -> None:
+    # Replaced in one step, so that readers never see a partial dump
+    registry = REGISTRY if registry is None else registry
+    dumped = {
+        "time": time.time(),
+        "final": final,
+        "samples": {metric.name: metric.dump() for metric in registry},
+    }
+    path = pathlib.Path(directory) / f"{os.getpid()}.json"
+    temporary_path = path.with_suffix(".tmp")
+    temporary_path.write_text(json.dumps(dumped))
+    os.replace(temporary_path, path)
+
+
+async def dump_periodically(directory: str) -> None:
+    try:
+        while True:
+            write_dump(directory)
+            await asyncio.sleep(DUMP_INTERVAL)
+    finally:
+        # Counts of the worker still count after it exited, its gauges not
+        write_dump(directory, final=True)
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+http_request_duration = Histogram(
+    "http_request_duration_seconds",
+    "Time until the last byte of the response was sent",
+    ["method", "route", "status"],
+)
+db_query_duration = Histogram(
+    "db_query_duration_seconds",
+    "Duration of named data layer operations, including waits for a connection",
+    ["query"],
+)
+serialization_duration = Histogram(
+    "serialization_duration_seconds",
+    "Time spent turning query results into response bodies",
+    ["route"],
+)
+rows_written = Counter(
+    "db_rows_written_total",
+    "Rows written by the data layer",
+    ["table", "operation"],
+)
+api_key_requests = Counter(
+    "api_key_requests_total",
+    "Requests per API key, allowed or rejected by its rate limit",
+    ["key", "outcome"],
+)
+coalesced_calls = Counter(
+    "db_coalesced_calls_total",
+    "Calls that shared the result of an identical call already in flight",
+    ["query"],
+)
+live_clients_cut_off = Counter(
+    "live_clients_cut_off_total",
+    "Live feed clients disconnected because they fell too far behind",
+)
+live_clients = Gauge("live_clients", "Clients connected to the live feed")
+pool_connections_in_use = Gauge(
+    "db_pool_connections_in_use",
+    "Connections currently checked out of the pool",
+    ["pool"],
+)
+pool_connections_idle = Gauge(
+    "db_pool_connections_idle", "Open connections waiting in the pool", ["pool"]
+)
+pool_connections_max = Gauge(
+    "db_pool_connections_max",
+    "Connections the pool may open, callers wait for one once all are in use",
+    ["pool"],
+)
+eviction_backlog = Gauge(
+    "db_eviction_backlog_rows",
+    "Rows above the eviction high-water mark at the janitor's last check",
+)
+eviction_lag = Gauge(
+    "db_eviction_lag_seconds",
+    "Time the janitor has been failing to get below the high-water mark",
+)
+
+
+class MetricsMiddleware:
+    # Plain ASGI so that streamed responses are timed until their last chunk
+    # without buffering them
+    def __init__(self, app: ASGIApp):
+        self.app = app
+        self._routes = None
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        start = time.perf_counter()
+        status = 500
+
+        async def send_wrapper(message: Message) -> None:
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            route = self._route_of(scope)
+            http_request_duration.labels(scope["method"], route, str(status)).observe(
+                time.perf_counter() - start
+            )
+
+    def _route_of(self, scope: Scope) -> str:
+        # Label by path template instead of the raw path to bound cardinality
+        if self._routes is None:
+            self._routes = {
+                getattr(r, "endpoint", None): r.path for r in scope["app"].routes
+            }
+        return self._routes.get(scope.get("endpoint"), "unmatched")
@@ -1,142 +1,1666 @@
+import asyncio
+import contextlib
+import csv
+import functools
+import json
+import logging
+import math
 import os
+import pathlib
+import secrets
+import time
+from contextvars import Context, ContextVar
+from datetime import datetime, timedelta
 from typing import Optional
 
+import asyncpg
 import databases
 import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.dialects.postgresql import TSVECTOR, aggregate_order_by, insert
 
-from backend.app.validation import CorrectedPosting
+from backend.app import metrics
+from backend.app.broadcast import Broadcaster
+from backend.app.cache import SingleFlight
+from backend.app.validation import (
+    CorrectedPosting,
+    IngestReport,
+    Prediction,
+    parse_consensus,
+    parse_postcode,
+)
 
 database: Optional[databases.Database] = None  # Populated by connect()
+# The replica if READ_DATABASE_URL is set, otherwise the same as database
+read_database: Optional[databases.Database] = None
+# Whether the reads of the current request go to the primary, set by
+# read_after() from the token handed out after the caller's last write
+read_from_primary: ContextVar[bool] = ContextVar("read_from_primary", default=False)
+_replica_lsn = 0  # Newest replay position seen on the replica
+_postings_flight = SingleFlight(metrics.coalesced_calls.labels("query_postings"))
+_corrections_flight = SingleFlight(metrics.coalesced_calls.labels("query_corrections"))
+# Postings inserted by any worker process, as they are published to the live feed
+new_postings = Broadcaster(
+    int(os.getenv("LIVE_QUEUE_SIZE", 1000)), metrics.live_clients_cut_off
+)
+_listener: Optional[asyncio.Task] = None
+logger = logging.getLogger(__name__)
+
+INSERT_CHUNK_SIZE = 1000  # Keeps multi-row inserts below asyncpg's argument limit
+EARTH_RADIUS_KM = 6371.0
+EXPORT_PREFETCH = 1000  # Rows fetched per round trip when streaming an export
+ROWS_PER_POSTING = 2  # Its row in postings and its url in posting_urls
+MAX_TOMBSTONES = 1000  # Older tombstones are pruned, their readers need a reload
+NEW_POSTINGS_CHANNEL = "new_postings"
+NOTIFY_CHUNK_SIZE = 500  # Keeps notification payloads below their 8000 byte limit
+LISTEN_CHECK_INTERVAL = 30  # Seconds without notifications before probing
+LISTEN_RETRY_DELAYS = (1, 30)  # Seconds before resubscribing, doubled up to max
+WORKER_ID = secrets.token_hex(8)  # Tells own notifications from other workers'
+LABEL_RELOAD_INTERVAL = 10  # Seconds between reloads for unknown filter labels
+
+# Labels are stored as codes into the labels table. The dictionary is only
+# ever appended to, so cached entries stay valid and a missing one is reloaded.
+label_codes: dict[str, int] = {}
+label_names: dict[int, str] = {}
+_labels_loaded_at = -math.inf
 
 
 async def connect():
     url = os.environ["DATABASE_URL"]
-    min_size = int(os.environ["MIN_DATABASE_CONNECTIONS"])
-    max_size = max(10, min_size)
+    min_size, max_size = _pool_sizes(int(os.environ["MIN_DATABASE_CONNECTIONS"]))
 
-    global database
+    global database, read_database, _replica_lsn
     database = databases.Database(url, min_size=min_size, max_size=max_size)
     await database.connect()
+    if "READ_DATABASE_URL" in os.environ:
+        read_min_size, read_max_size = _pool_sizes(
+            int(os.getenv("READ_MIN_DATABASE_CONNECTIONS", min_size)), prefix="READ_"
+        )
+        read_database = databases.Database(
+            os.environ["READ_DATABASE_URL"],
+            min_size=read_min_size,
+            max_size=read_max_size,
+        )
+        await read_database.connect()
+    else:
+        read_database = database
+    _replica_lsn = 0
+    # The codes may belong to another database, they are loaded on first use
+    global label_codes, label_names, _labels_loaded_at
+    label_codes, label_names = {}, {}
+    _labels_loaded_at = -math.inf
+
+
+def _pool_sizes(min_size: int, prefix: str = "") -> tuple[int, int]:
+    max_size = int(os.getenv(f"{prefix}MAX_DATABASE_CONNECTIONS", max(10, min_size)))
+    if "DATABASE_CONNECTION_BUDGET" in os.environ:
+        # Every worker process has its own pools, so each gets an equal share
+        # of the connections the server allows us
+        workers = int(os.getenv("WEB_CONCURRENCY", 1))
+        share = int(os.environ["DATABASE_CONNECTION_BUDGET"]) // workers
+        if share < 1:
+            raise RuntimeError(
+                f"Connection budget too small for {workers} worker processes"
+            )
+        max_size = min(max_size, share)
+        min_size = min(min_size, max_size)
+
+    return min_size, max_size
+
+
+async def warm_up():
+    # Check out every connection the pool keeps open and load the catalog and
+    # type information of the hot tables into it before the worker takes traffic
+    for pool_database in {database, read_database}:
+        pool = _asyncpg_pool(pool_database)
+        connections = [await pool.acquire() for _ in range(pool.get_min_size())]
+        try:
+            for connection in connections:
+                for table in (postings, corrections, row_counts):
+                    await connection.fetch(f"SELECT * FROM {table.name} LIMIT 0")
+        finally:
+            for connection in connections:
+                await pool.release(connection)
+    _postcode_coordinates()
 
 
 async def disconnect():
-    global database
+    global database, read_database
     if isinstance(database, databases.Database):
+        if read_database is not database:
+            await read_database.disconnect()
         await database.disconnect()
-        database = None
+        database = read_database = None
     else:
         raise RuntimeError("Database was not connected")
 
 
+def start_listening():
+    # Postings inserted by other worker processes are published to the live
+    # feed when their notification arrives. The listener keeps one pooled
+    # connection, so that it stays within the connection budget.
+    global _listener
+    if _asyncpg_pool(database).get_max_size() < 2:
+        logger.warning("Pool too small to listen for postings of other workers")
+        return
+    _listener = start_background_task(_listen_for_new_postings())
+
+
+async def stop_listening():
+    global _listener
+    if _listener is not None:
+        listener, _listener = _listener, None
+        listener.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await listener
+
+
+def start_background_task(coro) -> asyncio.Task:
+    # A task inherits the connection bound to the context of its creator, e.g.
+    # the one used for warming up. Background tasks start in an empty context
+    # to check out a connection of their own.
+    return Context().run(asyncio.create_task, coro)
+
+
+async def _listen_for_new_postings():
+    # Subscribes again when the connection is lost, e.g. when the database
+    # restarts. Notifications sent in between are missed.
+    delay, max_delay = LISTEN_RETRY_DELAYS
+    while True:
+        try:
+            await _listen_until_disconnected()
+            delay = LISTEN_RETRY_DELAYS[0]
+            logger.warning("Lost the connection listening for postings")
+        except Exception:
+            logger.exception("Listening for postings of other workers failed")
+        if _listener is not asyncio.current_task():
+            # Cleaning up a lost connection can fail in place of a cancellation
+            return
+        await asyncio.sleep(delay)
+        delay = min(2 * delay, max_delay)
+
+
+async def _listen_until_disconnected():
+    notifications = asyncio.Queue()
+
+    def on_notification(connection, pid, channel, payload):
+        notifications.put_nowait(json.loads(payload))
+
+    def on_termination(connection):
+        notifications.put_nowait(None)
+
+    async with database.connection() as connection:
+        raw_connection = connection.raw_connection
+        raw_connection.add_termination_listener(on_termination)
+        await raw_connection.add_listener(NEW_POSTINGS_CHANNEL, on_notification)
+        try:
+            while True:
+                # Not wait_for(), which can swallow a cancellation arriving
+                # together with a result
+                getter = asyncio.ensure_future(notifications.get())
+                try:
+                    await asyncio.wait({getter}, timeout=LISTEN_CHECK_INTERVAL)
+                finally:
+                    getter.cancel()
+                if not getter.done():
+                    # A connection dropped without notice is only noticed on use
+                    await raw_connection.fetchval(
+                        "SELECT 1", timeout=LISTEN_CHECK_INTERVAL
+                    )
+                    continue
+                messages = [getter.result()]
+                while not notifications.empty():
+                    messages.append(notifications.get_nowait())
+                # Own postings were published right after inserting them
+                posting_ids = [
+                    posting_id
+                    for message in messages
+                    if message is not None and message["worker"] != WORKER_ID
+                    for posting_id in message["ids"]
+                ]
+                try:
+                    await _publish_new_postings(posting_ids)
+                except Exception:
+                    logger.exception("Publishing postings of other workers failed")
+                if None in messages:
+                    return
+        finally:
+            # A lost connection was released already, its listeners with it
+            with contextlib.suppress(
+                asyncpg.exceptions.InterfaceError,
+                asyncpg.exceptions.InternalClientError,
+                asyncpg.exceptions.PostgresConnectionError,
+            ):
+                raw_connection.remove_termination_listener(on_termination)
+                await raw_connection.remove_listener(
+                    NEW_POSTINGS_CHANNEL, on_notification
+                )
+
+
+async def read_after(lsn: int) -> bool:
+    # Sends the reads of the current request to the primary if the replica has
+    # not replayed the caller's last write at lsn yet, and returns whether it did
+    primary = (
+        read_database is not database
+        and _replica_lsn < lsn
+        and await _replay_lsn() < lsn
+    )
+    read_from_primary.set(primary)
+
+    return primary
+
+
+def _reader() -> databases.Database:
+    return database if read_from_primary.get() else read_database
+
+
+async def _replay_lsn() -> int:
+    global _replica_lsn
+    lsn = await read_database.fetch_val("SELECT pg_last_wal_replay_lsn()::text")
+    # A server that is not a standby has no replay position and is never behind
+    _replica_lsn = _parse_lsn(lsn) if lsn is not None else 2**64
+
+    return _replica_lsn
+
+
+async def _write_lsn() -> int:
+    # Position after the caller's commit, only needed when reads can lag behind
+    if read_database is database:
+        return 0
+    lsn = await database.fetch_val("SELECT pg_current_wal_lsn()::text")
+
+    return _parse_lsn(lsn)
+
+
+def _parse_lsn(lsn: str) -> int:
+    high, low = lsn.split("/")
+    return (int(high, 16) << 32) + int(low, 16)
+
+
+def _asyncpg_pool(pool_database):
+    # databases does not expose its asyncpg pool
+    return getattr(getattr(pool_database, "_backend", None), "_pool", None)
+
+
+def pool_stats(pool_database) -> Optional[dict[str, int]]:
+    pool = _asyncpg_pool(pool_database)
+    if pool is None:
+        return None
+    idle = pool.get_idle_size()
+    return {
+        "in_use": pool.get_size() - idle,
+        "idle": idle,
+        # asyncpg does not expose how many callers wait for a connection, they
+        # do once in_use reaches max
+        "max": pool.get_max_size(),
+    }
+
+
+def _pool_stat(stat: str, replica: bool = False) -> Optional[int]:
+    if replica and read_database is database:
+        return None
+    stats = pool_stats(read_database if replica else database)
+
+    return stats[stat] if stats is not None else None
+
+
+for _gauge, _stat in (
+    (metrics.pool_connections_in_use, "in_use"),
+    (metrics.pool_connections_idle, "idle"),
+    (metrics.pool_connections_max, "max"),
+):
+    _gauge.set_function(functools.partial(_pool_stat, _stat), "primary")
+    _gauge.set_function(functools.partial(_pool_stat, _stat, replica=True), "replica")
+
+
 metadata = sa.MetaData()
 
+LABEL_ASPECTS = ("bike", "frame", "color")
+EMPTY_LABEL = 0  # Code of the empty label, missing labels are counted as it
+# Vocabulary of the current classifier, labels of new versions are added on ingest
+INITIAL_LABELS = [
+    "bike",
+    "children",
+    "cargo",
+    "diamond",
+    "trapeze",
+    "swan_neck",
+    "low_entry",
+    "x",
+    "y",
+    "black",
+    "white",
+    "gray",
+    "blue",
+    "red",
+    "yellow",
+    "green",
+]
+
+labels = sa.Table(
+    "labels",
+    metadata,
+    sa.Column("id", sa.SmallInteger, primary_key=True),
+    sa.Column("name", sa.String, nullable=False, unique=True),
+)
+
+sa.event.listen(
+    labels,
+    "after_create",
+    sa.DDL(
+        f"INSERT INTO labels (id, name) VALUES ({EMPTY_LABEL}, '');"
+        "INSERT INTO labels (name) VALUES "
+        + ", ".join(f"('{name}')" for name in INITIAL_LABELS)
+    ),
+)
+
 postings = sa.Table(
     "postings",
     metadata,
-    sa.Column("id", sa.Integer, primary_key=True),
+    sa.Column("id", sa.Integer, primary_key=True, autoincrement=True),
     sa.Column("title", sa.String),
     sa.Column("url", sa.String),
     sa.Column("image_url", sa.String),
     sa.Column("location", sa.String),
     sa.Column("query", sa.String),
     sa.Column("loc_query", sa.String),
-    sa.Column("date", sa.DateTime),
-    sa.Column("bike", sa.String),
-    sa.Column("frame", sa.String),
-    sa.Column("color", sa.String),
+    sa.Column("date", sa.DateTime, primary_key=True),
+    sa.Column("bike", sa.SmallInteger),  # Label codes, see labels
+    sa.Column("frame", sa.SmallInteger),
+    sa.Column("color", sa.SmallInteger),
+    sa.Column("search_vector", TSVECTOR),  # Maintained by a trigger
+    sa.Column("postcode", sa.String),  # Parsed from location on ingest
+    sa.Column("lat", sa.Float),
+    sa.Column("lon", sa.Float),
+    # Majority label of the corrections per aspect and how many corrections
+    # voted for it, maintained by a trigger on corrections
+    sa.Column("consensus_bike", sa.SmallInteger),
+    sa.Column("consensus_bike_votes", sa.Integer),
+    sa.Column("consensus_frame", sa.SmallInteger),
+    sa.Column("consensus_frame_votes", sa.Integer),
+    sa.Column("consensus_color", sa.SmallInteger),
+    sa.Column("consensus_color_votes", sa.Integer),
+    sa.Column("num_corrections", sa.Integer, nullable=False, server_default="0"),
+    # Weekly partitions, see create_postings_partitions(). Unique constraints
+    # have to include the date, so URLs are unique in posting_urls instead.
+    postgresql_partition_by="RANGE (date)",
+)
+# Columns of a posting as seen by the API, i.e. without derived columns
+posting_columns = [
+    postings.c[name]
+    for name in (
+        "id",
+        "title",
+        "url",
+        "image_url",
+        "location",
+        "query",
+        "loc_query",
+        "date",
+        "bike",
+        "frame",
+        "color",
+    )
+]
+consensus_columns = [
+    postings.c[name]
+    for name in (
+        "consensus_bike",
+        "consensus_bike_votes",
+        "consensus_frame",
+        "consensus_frame_votes",
+        "consensus_color",
+        "consensus_color_votes",
+        "num_corrections",
+    )
+]
+sa.Index("ix_postings_url", postings.c.url)
+sa.Index("ix_postings_date_id", postings.c.date.desc(), postings.c.id.desc())
+sa.Index(
+    "ix_postings_bike_date_id",
+    postings.c.bike,
+    postings.c.date.desc(),
+    postings.c.id.desc(),
+)
+sa.Index(
+    "ix_postings_frame_date_id",
+    postings.c.frame,
+    postings.c.date.desc(),
+    postings.c.id.desc(),
+)
+sa.Index(
+    "ix_postings_color_date_id",
+    postings.c.color,
+    postings.c.date.desc(),
+    postings.c.id.desc(),
 )
+sa.Index(
+    "ix_postings_bike_frame_color_date_id",
+    postings.c.bike,
+    postings.c.frame,
+    postings.c.color,
+    postings.c.date.desc(),
+    postings.c.id.desc(),
+)
+# Only the few corrected postings are indexed by their consensus
+for _aspect in LABEL_ASPECTS:
+    sa.Index(
+        f"ix_postings_consensus_{_aspect}_date_id",
+        postings.c[f"consensus_{_aspect}"],
+        postings.c.date.desc(),
+        postings.c.id.desc(),
+        postgresql_where=postings.c[f"consensus_{_aspect}"].isnot(None),
+    )
+sa.Index("ix_postings_search_vector", postings.c.search_vector, postgresql_using="gin")
+sa.Index(
+    "ix_postings_coordinates",
+    sa.func.point(postings.c.lon, postings.c.lat),
+    postgresql_using="gist",
+)
+
+SEARCH_CONFIG = "german"
+UPDATE_SEARCH_VECTOR_FUNCTION = f"""
+CREATE OR REPLACE FUNCTION update_search_vector() RETURNS trigger AS $$
+BEGIN
+    NEW.search_vector :=
+        setweight(to_tsvector('{SEARCH_CONFIG}', coalesce(NEW.title, '')), 'A')
+        || setweight(to_tsvector('{SEARCH_CONFIG}', coalesce(NEW.location, '')), 'B');
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql
+"""
+UPDATE_SEARCH_VECTOR_TRIGGER = """
+CREATE TRIGGER postings_update_search_vector
+BEFORE INSERT OR UPDATE OF title, location ON postings
+FOR EACH ROW EXECUTE FUNCTION update_search_vector()
+"""
+
+sa.event.listen(metadata, "before_create", sa.DDL(UPDATE_SEARCH_VECTOR_FUNCTION))
+sa.event.listen(
+    metadata, "after_drop", sa.DDL("DROP FUNCTION IF EXISTS update_search_vector()")
+)
+sa.event.listen(postings, "after_create", sa.DDL(UPDATE_SEARCH_VECTOR_TRIGGER))
+
+PARTITIONS_AHEAD = timedelta(weeks=2)
+# Postings dated outside of this window around now are rejected on ingest
+MAX_POSTING_AGE = timedelta(weeks=52)
+MAX_POSTING_LEAD = timedelta(weeks=8)
+CREATE_PARTITIONS_FUNCTION = """
+CREATE OR REPLACE FUNCTION create_postings_partitions(
+    first_date timestamp, last_date timestamp
+) RETURNS integer AS $$
+DECLARE
+    week timestamp := date_trunc('week', first_date);
+    partition_name text;
+    num_created integer := 0;
+BEGIN
+    -- Concurrent callers would otherwise race to create the same partition
+    PERFORM pg_advisory_xact_lock(hashtext('create_postings_partitions'));
+    WHILE week <= last_date LOOP
+        partition_name := 'postings_' || to_char(week, 'IYYY"w"IW');
+        IF to_regclass(partition_name) IS NULL THEN
+            EXECUTE 'CREATE TABLE ' || quote_ident(partition_name)
+                || ' PARTITION OF postings FOR VALUES FROM ('
+                || quote_literal(week) || ') TO ('
+                || quote_literal(week + interval '1 week') || ')';
+            num_created := num_created + 1;
+        END IF;
+        week := week + interval '1 week';
+    END LOOP;
+    RETURN num_created;
+END;
+$$ LANGUAGE plpgsql
+"""
+# Partitions are listed oldest first, the names sort like the weeks they hold
+POSTINGS_PARTITIONS_QUERY = """
+SELECT relname FROM pg_inherits JOIN pg_class ON pg_class.oid = inhrelid
+WHERE inhparent = 'postings'::regclass ORDER BY relname
+"""
+
+DROP_LOCK_TIMEOUT = "500ms"
+JANITOR_LOCK = "eviction_janitor"  # Advisory lock key, hashed like the one above
+
+sa.event.listen(metadata, "before_create", sa.DDL(CREATE_PARTITIONS_FUNCTION))
+sa.event.listen(
+    metadata,
+    "after_drop",
+    sa.DDL("DROP FUNCTION IF EXISTS create_postings_partitions(timestamp, timestamp)"),
+)
+sa.event.listen(
+    postings,
+    "after_create",
+    sa.DDL(
+        "SELECT create_postings_partitions("
+        "localtimestamp - interval '8 weeks', localtimestamp + interval '4 weeks')"
+    ),
+)
+
+# The unique URLs of postings, which a partitioned table cannot have, kept in
+# sync by triggers on postings. Corrections reference it in place of postings.
+# Its rows count against the row limit, so every posting takes two rows.
+posting_urls = sa.Table(
+    "posting_urls",
+    metadata,
+    sa.Column("posting_id", sa.Integer, primary_key=True),
+    sa.Column("url", sa.String, unique=True),
+)
+
+# Rows moved between partitions by an update do not fire the statement
+# triggers for inserts and deletes, but the row trigger for updates
+MAINTAIN_POSTING_URLS_FUNCTION = """
+CREATE OR REPLACE FUNCTION maintain_posting_urls() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        INSERT INTO posting_urls (posting_id, url) SELECT id, url FROM new_rows;
+    ELSIF TG_OP = 'DELETE' THEN
+        -- Takes the place of a cascading foreign key
+        DELETE FROM corrections WHERE posting_id IN (SELECT id FROM old_rows);
+        DELETE FROM posting_urls WHERE posting_id IN (SELECT id FROM old_rows);
+    ELSE
+        UPDATE posting_urls SET posting_id = NEW.id, url = NEW.url
+        WHERE posting_id = OLD.id;
+        RETURN NEW;
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql
+"""
+MAINTAIN_POSTING_URLS_TRIGGERS = """
+CREATE TRIGGER postings_maintain_url_inserts AFTER INSERT ON postings
+REFERENCING NEW TABLE AS new_rows
+FOR EACH STATEMENT EXECUTE FUNCTION maintain_posting_urls();
+CREATE TRIGGER postings_maintain_url_deletes AFTER DELETE ON postings
+REFERENCING OLD TABLE AS old_rows
+FOR EACH STATEMENT EXECUTE FUNCTION maintain_posting_urls();
+CREATE TRIGGER postings_maintain_url_updates BEFORE UPDATE OF id, url ON postings
+FOR EACH ROW EXECUTE FUNCTION maintain_posting_urls()
+"""
+
+sa.event.listen(metadata, "before_create", sa.DDL(MAINTAIN_POSTING_URLS_FUNCTION))
+sa.event.listen(
+    metadata, "after_drop", sa.DDL("DROP FUNCTION IF EXISTS maintain_posting_urls()")
+)
+sa.event.listen(postings, "after_create", sa.DDL(MAINTAIN_POSTING_URLS_TRIGGERS))
+
+# Coordinates of German postcodes, looked up in the process on ingest. Its 8k
+# rows would take most of the row budget in the database.
+POSTCODES_CSV = pathlib.Path(__file__).parent / "data" / "postcodes_de.csv"
+
+
+@functools.lru_cache(maxsize=None)
+def _postcode_coordinates() -> dict[str, tuple[float, float]]:
+    with open(POSTCODES_CSV, newline="") as f:
+        return {
+            r["postcode"]: (float(r["lat"]), float(r["lon"])) for r in csv.DictReader(f)
+        }
+
 
 corrections = sa.Table(
     "corrections",
     metadata,
     sa.Column("id", sa.Integer, primary_key=True),
     sa.Column(
-        "posting_id", sa.ForeignKey("postings.id", ondelete="CASCADE"), nullable=False
+        "posting_id",
+        sa.Integer,
+        sa.ForeignKey("posting_urls.posting_id"),
+        nullable=False,
+        index=True,
+    ),
+    sa.Column("bike", sa.SmallInteger),
+    sa.Column("frame", sa.SmallInteger),
+    sa.Column("color", sa.SmallInteger),
+)
+# Recounts the votes of the changed postings only. Ties go to the label of the
+# newest correction, postings without corrections are reset.
+UPDATE_CONSENSUS = """
+UPDATE postings SET
+    consensus_bike = bike.label, consensus_bike_votes = bike.votes,
+    consensus_frame = frame.label, consensus_frame_votes = frame.votes,
+    consensus_color = color.label, consensus_color_votes = color.votes,
+    num_corrections = total.votes
+FROM {changed} AS changed_posting(id)
+LEFT JOIN LATERAL (
+    SELECT bike AS label, count(*) AS votes FROM corrections
+    WHERE posting_id = changed_posting.id
+    GROUP BY bike ORDER BY count(*) DESC, max(id) DESC LIMIT 1
+) AS bike ON true
+LEFT JOIN LATERAL (
+    SELECT frame AS label, count(*) AS votes FROM corrections
+    WHERE posting_id = changed_posting.id
+    GROUP BY frame ORDER BY count(*) DESC, max(id) DESC LIMIT 1
+) AS frame ON true
+LEFT JOIN LATERAL (
+    SELECT color AS label, count(*) AS votes FROM corrections
+    WHERE posting_id = changed_posting.id
+    GROUP BY color ORDER BY count(*) DESC, max(id) DESC LIMIT 1
+) AS color ON true
+CROSS JOIN LATERAL (
+    SELECT count(*) AS votes FROM corrections
+    WHERE posting_id = changed_posting.id
+) AS total
+WHERE postings.id = changed_posting.id
+"""
+UPDATE_CONSENSUS_FUNCTION = f"""
+CREATE OR REPLACE FUNCTION update_consensus() RETURNS trigger AS $$
+DECLARE
+    changed integer[];
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        changed := ARRAY(SELECT DISTINCT posting_id FROM new_rows);
+    ELSE
+        changed := ARRAY(SELECT DISTINCT posting_id FROM old_rows);
+    END IF;
+    {UPDATE_CONSENSUS.format(changed="unnest(changed)")};
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql
+"""
+UPDATE_CONSENSUS_TRIGGERS = """
+CREATE TRIGGER corrections_update_consensus_inserts AFTER INSERT ON corrections
+REFERENCING NEW TABLE AS new_rows
+FOR EACH STATEMENT EXECUTE FUNCTION update_consensus();
+CREATE TRIGGER corrections_update_consensus_deletes AFTER DELETE ON corrections
+REFERENCING OLD TABLE AS old_rows
+FOR EACH STATEMENT EXECUTE FUNCTION update_consensus()
+"""
+
+sa.event.listen(metadata, "before_create", sa.DDL(UPDATE_CONSENSUS_FUNCTION))
+sa.event.listen(
+    metadata, "after_drop", sa.DDL("DROP FUNCTION IF EXISTS update_consensus()")
+)
+sa.event.listen(corrections, "after_create", sa.DDL(UPDATE_CONSENSUS_TRIGGERS))
+
+# Row counts of all tables, maintained by the triggers below so that checking
+# the row budget does not need to scan them. Besides the two rows per posting
+# and the corrections, the budget holds the label dictionary and a facet count
+# per label combination, so somewhat less than half of ROW_LIMIT is left for
+# postings. The
+# generation is incremented by every statement writing to the table.
+row_counts = sa.Table(
+    "row_counts",
+    metadata,
+    sa.Column("table_name", sa.String, primary_key=True),
+    sa.Column("row_count", sa.BigInteger, nullable=False),
+    sa.Column("generation", sa.BigInteger, nullable=False, server_default="0"),
+)
+
+COUNT_ROWS_FUNCTION = """
+CREATE OR REPLACE FUNCTION count_rows() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP = 'INSERT' THEN
+        UPDATE row_counts SET
+            row_count = row_count + (SELECT count(*) FROM new_rows),
+            generation = generation + 1
+        WHERE table_name = TG_TABLE_NAME;
+    ELSIF TG_OP = 'DELETE' THEN
+        UPDATE row_counts SET
+            row_count = row_count - (SELECT count(*) FROM old_rows),
+            generation = generation + 1
+        WHERE table_name = TG_TABLE_NAME;
+    ELSE
+        UPDATE row_counts SET generation = generation + 1
+        WHERE table_name = TG_TABLE_NAME;
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql
+"""
+COUNT_INSERTS_TRIGGER = """
+CREATE TRIGGER %(table)s_count_inserts AFTER INSERT ON %(table)s
+REFERENCING NEW TABLE AS new_rows
+FOR EACH STATEMENT EXECUTE FUNCTION count_rows()
+"""
+COUNT_DELETES_TRIGGER = """
+CREATE TRIGGER %(table)s_count_deletes AFTER DELETE ON %(table)s
+REFERENCING OLD TABLE AS old_rows
+FOR EACH STATEMENT EXECUTE FUNCTION count_rows()
+"""
+COUNT_UPDATES_TRIGGER = """
+CREATE TRIGGER %(table)s_count_updates AFTER UPDATE ON %(table)s
+FOR EACH STATEMENT EXECUTE FUNCTION count_rows()
+"""
+
+sa.event.listen(
+    row_counts,
+    "after_create",
+    sa.DDL(
+        "INSERT INTO row_counts (table_name, row_count) "
+        "VALUES ('postings', 0), ('posting_urls', 0), ('corrections', 0), "
+        "('correction_tombstones', 0), ('facet_counts', 0);"
+        # Filled with the initial labels before the triggers were created
+        "INSERT INTO row_counts (table_name, row_count) "
+        "SELECT 'labels', count(*) FROM labels"
+    ),
+)
+row_counts.add_is_dependent_on(labels)
+sa.event.listen(metadata, "before_create", sa.DDL(COUNT_ROWS_FUNCTION))
+sa.event.listen(metadata, "after_drop", sa.DDL("DROP FUNCTION IF EXISTS count_rows()"))
+for _table in (labels, postings, posting_urls, corrections):
+    sa.event.listen(_table, "after_create", sa.DDL(COUNT_INSERTS_TRIGGER))
+    sa.event.listen(_table, "after_create", sa.DDL(COUNT_DELETES_TRIGGER))
+    sa.event.listen(_table, "after_create", sa.DDL(COUNT_UPDATES_TRIGGER))
+
+# Number of postings per label combination, maintained by triggers on postings.
+# Missing labels are counted as the empty label.
+facet_counts = sa.Table(
+    "facet_counts",
+    metadata,
+    sa.Column("bike", sa.SmallInteger, primary_key=True),
+    sa.Column("frame", sa.SmallInteger, primary_key=True),
+    sa.Column("color", sa.SmallInteger, primary_key=True),
+    sa.Column("posting_count", sa.Integer, nullable=False),
+)
+
+COUNT_FACETS_FUNCTION = f"""
+CREATE OR REPLACE FUNCTION count_facets() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP IN ('DELETE', 'UPDATE') THEN
+        UPDATE facet_counts SET posting_count = posting_count - removed.num
+        FROM (
+            SELECT coalesce(bike, {EMPTY_LABEL}) AS bike,
+                coalesce(frame, {EMPTY_LABEL}) AS frame,
+                coalesce(color, {EMPTY_LABEL}) AS color, count(*) AS num
+            FROM old_rows GROUP BY 1, 2, 3
+        ) AS removed
+        WHERE facet_counts.bike = removed.bike
+        AND facet_counts.frame = removed.frame
+        AND facet_counts.color = removed.color;
+        DELETE FROM facet_counts WHERE posting_count = 0;
+    END IF;
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        INSERT INTO facet_counts (bike, frame, color, posting_count)
+        SELECT coalesce(bike, {EMPTY_LABEL}), coalesce(frame, {EMPTY_LABEL}),
+            coalesce(color, {EMPTY_LABEL}), count(*)
+        FROM new_rows GROUP BY 1, 2, 3
+        ON CONFLICT (bike, frame, color) DO UPDATE
+        SET posting_count = facet_counts.posting_count + excluded.posting_count;
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql
+"""
+COUNT_FACETS_TRIGGERS = """
+CREATE TRIGGER postings_count_facet_inserts AFTER INSERT ON postings
+REFERENCING NEW TABLE AS new_rows
+FOR EACH STATEMENT EXECUTE FUNCTION count_facets();
+CREATE TRIGGER postings_count_facet_deletes AFTER DELETE ON postings
+REFERENCING OLD TABLE AS old_rows
+FOR EACH STATEMENT EXECUTE FUNCTION count_facets();
+CREATE TRIGGER postings_count_facet_updates AFTER UPDATE ON postings
+REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+FOR EACH STATEMENT EXECUTE FUNCTION count_facets()
+"""
+
+sa.event.listen(metadata, "before_create", sa.DDL(COUNT_FACETS_FUNCTION))
+sa.event.listen(
+    metadata, "after_drop", sa.DDL("DROP FUNCTION IF EXISTS count_facets()")
+)
+sa.event.listen(postings, "after_create", sa.DDL(COUNT_FACETS_TRIGGERS))
+for _trigger in (COUNT_INSERTS_TRIGGER, COUNT_DELETES_TRIGGER, COUNT_UPDATES_TRIGGER):
+    sa.event.listen(facet_counts, "after_create", sa.DDL(_trigger))
+# What count_facets() does for deleted rows, for a detached partition
+SUBTRACT_FACETS = f"""
+UPDATE facet_counts SET posting_count = posting_count - removed.num
+FROM (
+    SELECT coalesce(bike, {EMPTY_LABEL}) AS bike,
+        coalesce(frame, {EMPTY_LABEL}) AS frame,
+        coalesce(color, {EMPTY_LABEL}) AS color, count(*) AS num
+    FROM "{{partition}}" GROUP BY 1, 2, 3
+) AS removed
+WHERE facet_counts.bike = removed.bike
+AND facet_counts.frame = removed.frame
+AND facet_counts.color = removed.color
+"""
+
+
+# Postings whose corrections were deleted with them, e.g. by eviction. The ids
+# share the sequence of corrections, so that one watermark orders both.
+correction_tombstones = sa.Table(
+    "correction_tombstones",
+    metadata,
+    sa.Column(
+        "id",
+        sa.Integer,
+        primary_key=True,
+        server_default=sa.text("nextval('corrections_id_seq')"),
     ),
-    sa.Column("bike", sa.String),
-    sa.Column("frame", sa.String),
-    sa.Column("color", sa.String),
+    sa.Column("posting_id", sa.Integer, nullable=False),
 )
+correction_tombstones.add_is_dependent_on(corrections)
+
+RECORD_TOMBSTONES_FUNCTION = f"""
+CREATE OR REPLACE FUNCTION record_tombstones() RETURNS trigger AS $$
+BEGIN
+    INSERT INTO correction_tombstones (posting_id)
+    SELECT DISTINCT posting_id FROM old_rows
+    WHERE NOT EXISTS (SELECT FROM postings WHERE postings.id = old_rows.posting_id);
+    DELETE FROM correction_tombstones WHERE id <= (
+        SELECT id FROM correction_tombstones
+        ORDER BY id DESC OFFSET {MAX_TOMBSTONES} LIMIT 1
+    );
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql
+"""
+RECORD_TOMBSTONES_TRIGGER = """
+CREATE TRIGGER corrections_record_tombstones AFTER DELETE ON corrections
+REFERENCING OLD TABLE AS old_rows
+FOR EACH STATEMENT EXECUTE FUNCTION record_tombstones()
+"""
+
+sa.event.listen(metadata, "before_create", sa.DDL(RECORD_TOMBSTONES_FUNCTION))
+sa.event.listen(
+    metadata, "after_drop", sa.DDL("DROP FUNCTION IF EXISTS record_tombstones()")
+)
+sa.event.listen(
+    correction_tombstones, "after_create", sa.DDL(RECORD_TOMBSTONES_TRIGGER)
+)
+for _trigger in (COUNT_INSERTS_TRIGGER, COUNT_DELETES_TRIGGER, COUNT_UPDATES_TRIGGER):
+    sa.event.listen(correction_tombstones, "after_create", sa.DDL(_trigger))
+
+
+CONSENSUS_LABELS = tuple(f"consensus_{aspect}" for aspect in LABEL_ASPECTS)
+CORRECTED_LABELS = tuple(f"corrected_{aspect}" for aspect in LABEL_ASPECTS)
+
+
+async def load_labels():
+    global label_codes, label_names, _labels_loaded_at
+    _labels_loaded_at = time.monotonic()
+    fetched_labels = await database.fetch_all(sa.select(labels.c.id, labels.c.name))
+    label_codes = {r["name"]: r["id"] for r in fetched_labels}
+    label_names = {r["id"]: r["name"] for r in fetched_labels}
+
+
+async def _label_code(name: str) -> Optional[int]:
+    # Filter values come from clients, so unknown ones reload the dictionary at
+    # most once per interval. None means that no posting has the label.
+    if (
+        name not in label_codes
+        and time.monotonic() - _labels_loaded_at >= LABEL_RELOAD_INTERVAL
+    ):
+        await load_labels()
+    return label_codes.get(name)
+
+
+async def _encode_labels(rows: list[dict], register: bool = False) -> list[dict]:
+    # Unknown labels are added to the dictionary if register is set and raise
+    # a ValueError otherwise
+    names = {r[aspect] for r in rows for aspect in LABEL_ASPECTS} - {None}
+    unknown_names = names - label_codes.keys()
+    if unknown_names:
+        if register:
+            await database.execute(
+                insert(labels)
+                .values([{"name": name} for name in sorted(unknown_names)])
+                .on_conflict_do_nothing()
+            )
+        await load_labels()
+        unknown_names = names - label_codes.keys()
+        if unknown_names:
+            raise ValueError(f"Unknown labels {sorted(unknown_names)}")
+
+    return [
+        {**r, **{aspect: label_codes.get(r[aspect]) for aspect in LABEL_ASPECTS}}
+        for r in rows
+    ]
+
+
+async def _decode_labels(
+    records, columns=LABEL_ASPECTS, array_columns=()
+) -> list[dict]:
+    # Takes plain asyncpg records, they are cheaper to copy than the wrapped ones
+    rows = [dict(r) for r in records]
+    codes = {r[c] for r in rows for c in columns}
+    codes.update(code for r in rows for c in array_columns for code in r[c])
+    if not codes - {None} <= label_names.keys():
+        await load_labels()
+    for row in rows:
+        for column in columns:
+            row[column] = label_names.get(row[column])
+        for column in array_columns:
+            row[column] = [label_names.get(code) for code in row[column]]
+
+    return rows
+
+
+@metrics.db_query_duration.time("clear_old_postings")
+async def clear_old_postings(num: int, connection=None) -> int:
+    connection = connection or database
+    oldest_postings = sa.select(postings.c.id).order_by(postings.c.date).limit(num)
+    deleted_postings = (
+        postings.delete(postings.c.id.in_(oldest_postings))
+        .returning(postings.c.id)
+        .cte("deleted_postings")
+    )
+    # Their corrections are deleted by a trigger
+    num_deleted = await connection.execute(
+        sa.select(sa.func.count()).select_from(deleted_postings)
+    )
+
+    return num_deleted
+
+
+@contextlib.asynccontextmanager
+async def janitor_lock():
+    # Yields whether this process got to run the janitor. Every worker process
+    # starts one, but only one at a time evicts and creates partitions. The
+    # janitor's statements share the connection holding the lock, as the
+    # connection is bound to its task.
+    async with database.connection() as connection:
+        acquired = await connection.fetch_val(
+            sa.select(sa.func.pg_try_advisory_lock(sa.func.hashtext(JANITOR_LOCK)))
+        )
+        try:
+            yield acquired
+        finally:
+            if acquired:
+                await connection.fetch_val(
+                    sa.select(
+                        sa.func.pg_advisory_unlock(sa.func.hashtext(JANITOR_LOCK))
+                    )
+                )
 
 
-async def clear_old_postings(num: int):
-    oldest_postings = (
-        sa.select(postings.c.id).order_by(postings.c.date).limit(num).subquery()
+async def create_postings_partitions(first_date: datetime, last_date: datetime):
+    await database.execute(
+        sa.select(sa.func.create_postings_partitions(first_date, last_date))
     )
-    await database.execute(postings.delete(postings.c.id.in_(oldest_postings)))
 
 
-async def query_postings(bike, color, frame, limit, skip):
+async def drop_oldest_postings_partition() -> Optional[int]:
+    # Retention by dropping a whole week of postings instead of deleting rows.
+    # The current week is never dropped, None tells the caller to delete rows.
+    current_partition = datetime.now().strftime("postings_%Gw%V")
+    partitions = [
+        r["relname"] for r in await database.fetch_all(POSTINGS_PARTITIONS_QUERY)
+    ]
+    if not partitions or partitions[0] >= current_partition:
+        return None
+    partition = partitions[0]
+    async with database.connection() as connection, connection.transaction():
+        # Writers lock row_counts before postings, so do the same, and give up
+        # quickly on the exclusive lock instead of queueing readers behind it
+        await _lock_row_counts(connection)
+        await connection.execute(f"SET LOCAL lock_timeout = '{DROP_LOCK_TIMEOUT}'")
+        await connection.execute(f"LOCK TABLE {postings.name} IN ACCESS EXCLUSIVE MODE")
+        num_dropped = await connection.fetch_val(f'SELECT count(*) FROM "{partition}"')
+        await connection.execute(
+            f'ALTER TABLE {postings.name} DETACH PARTITION "{partition}"'
+        )
+        # The postings are gone now, so tombstones are recorded for them. Like
+        # the counts below, this is what the triggers do for deleted rows.
+        await connection.execute(
+            f'DELETE FROM corrections WHERE posting_id IN (SELECT id FROM "{partition}")'
+        )
+        await connection.execute(
+            f"DELETE FROM posting_urls "
+            f'WHERE posting_id IN (SELECT id FROM "{partition}")'
+        )
+        await connection.execute(
+            row_counts.update()
+            .where(row_counts.c.table_name == postings.name)
+            .values(
+                row_count=row_counts.c.row_count - num_dropped,
+                generation=row_counts.c.generation + 1,
+            )
+        )
+        await connection.execute(SUBTRACT_FACETS.format(partition=partition))
+        await connection.execute("DELETE FROM facet_counts WHERE posting_count = 0")
+        await connection.execute(f'DROP TABLE "{partition}"')
+
+    return num_dropped
+
+
+async def query_postings(*args, **kwargs) -> list[dict]:
+    postings_found, _ = await query_postings_with_generation(*args, **kwargs)
+
+    return postings_found
+
+
+@metrics.db_query_duration.time("query_postings")
+async def query_postings_with_generation(
+    bike,
+    color,
+    frame,
+    limit,
+    skip,
+    cursor=None,
+    q=None,
+    order="date",
+    lat=None,
+    lon=None,
+    radius_km=None,
+    consensus_bike=None,
+    consensus_frame=None,
+    consensus_color=None,
+) -> tuple[list[dict], int]:
+    # Returns the postings together with the write generation of the snapshot
+    # they were read from, which is exact for whichever server answered.
+    # Identical listings requested at the same time, e.g. after a link was
+    # shared, run one query. The caller's read-after position decides where.
+    args = (
+        bike,
+        color,
+        frame,
+        limit,
+        skip,
+        cursor,
+        q,
+        order,
+        lat,
+        lon,
+        radius_km,
+        consensus_bike,
+        consensus_frame,
+        consensus_color,
+    )
+    return await _postings_flight.do(
+        (*args, read_from_primary.get()), functools.partial(_query_postings, *args)
+    )
+
+
+async def _query_postings(
+    bike,
+    color,
+    frame,
+    limit,
+    skip,
+    cursor,
+    q,
+    order,
+    lat,
+    lon,
+    radius_km,
+    consensus_bike,
+    consensus_frame,
+    consensus_color,
+):
     where_clauses = []
-    if bike is not None:
-        where_clauses.append(postings.c.bike == bike)
-    if frame is not None:
-        where_clauses.append(postings.c.frame == frame)
-    if color is not None:
-        where_clauses.append(postings.c.color == color)
-    query = (
-        postings.select()
+    label_filters = {
+        postings.c.bike: bike,
+        postings.c.frame: frame,
+        postings.c.color: color,
+        postings.c.consensus_bike: consensus_bike,
+        postings.c.consensus_frame: consensus_frame,
+        postings.c.consensus_color: consensus_color,
+    }
+    for column, name in label_filters.items():
+        if name is not None:
+            code = await _label_code(name)
+            if code is None:
+                return [], await get_write_generation(postings)
+            where_clauses.append(column == code)
+    if radius_km is not None:
+        where_clauses.extend(_within_radius(lat, lon, radius_km))
+    sort_key = postings.c.date
+    if q is not None:
+        search_query = sa.func.websearch_to_tsquery(SEARCH_CONFIG, q)
+        where_clauses.append(postings.c.search_vector.op("@@")(search_query))
+        if order == "rank":
+            sort_key = sa.func.ts_rank(postings.c.search_vector, search_query)
+    if cursor is not None:
+        # Keyset pagination: continue strictly after the last (sort key, id) seen
+        where_clauses.append(sa.tuple_(sort_key, postings.c.id) < cursor)
+        if sort_key is postings.c.date:
+            # Prunes the partitions newer than the cursor, which the row
+            # comparison above does not
+            where_clauses.append(postings.c.date <= cursor[0])
+    listing = (
+        sa.select(*posting_columns, *consensus_columns, sort_key.label("sort_key"))
         .where(*where_clauses)
-        .order_by(postings.c.date.desc())
+        .order_by(sort_key.desc(), postings.c.id.desc())
         .offset(skip)
         .limit(limit)
+        .subquery("listing")
+    )
+    # One statement sees one snapshot, so the generation describes exactly
+    # these rows. The outer join keeps it when no posting matches.
+    snapshot = _write_generation_query(postings).subquery("snapshot")
+    query = (
+        sa.select(snapshot.c.generation, *listing.c)
+        .select_from(snapshot.outerjoin(listing, sa.true()))
+        .order_by(listing.c.sort_key.desc(), listing.c.id.desc())
+    )
+    reader = _reader()
+    fetched_postings = await reader.fetch_all(query)
+    postings_found = await _decode_labels(
+        [r._mapping for r in fetched_postings if r["id"] is not None],
+        LABEL_ASPECTS + CONSENSUS_LABELS,
     )
-    fetched_postings = await database.fetch_all(query)
 
-    return fetched_postings
+    return postings_found, fetched_postings[0]["generation"]
 
 
-async def add_postings(postings_to_add):
-    await _free_rows_over_limit(len(postings_to_add))
-    await database.execute_many(postings.insert(), postings_to_add)
+INGEST_COLUMNS = [c.name for c in posting_columns if c.name != "id"] + [
+    "postcode",
+    "lat",
+    "lon",
+]
+# Transaction-local table that incoming postings are loaded into before upserting
+postings_staging = sa.table(
+    "postings_staging", *[sa.column(name) for name in INGEST_COLUMNS]
+)
 
 
-async def get_corrections():
-    corrected_ids = await database.fetch_all(
-        sa.select(sa.distinct(corrections.c.posting_id))
+def _within_radius(lat, lon, radius_km):
+    # The bounding box is answered by the coordinates index, the exact
+    # distance is only computed for the postings inside of it
+    delta_lat = math.degrees(radius_km / EARTH_RADIUS_KM)
+    delta_lon = delta_lat / max(math.cos(math.radians(lat)), 0.01)
+    bounding_box = sa.func.box(
+        sa.func.point(lon - delta_lon, lat - delta_lat),
+        sa.func.point(lon + delta_lon, lat + delta_lat),
     )
-    corrected_postings = await database.fetch_all(
-        postings.select(postings.c.id.in_([c["posting_id"] for c in corrected_ids]))
+    in_box = sa.func.point(postings.c.lon, postings.c.lat).op("<@")(bounding_box)
+    haversine = sa.func.power(
+        sa.func.sin(sa.func.radians(postings.c.lat - lat) / 2), 2
+    ) + math.cos(math.radians(lat)) * sa.func.cos(
+        sa.func.radians(postings.c.lat)
+    ) * sa.func.power(
+        sa.func.sin(sa.func.radians(postings.c.lon - lon) / 2), 2
     )
-    for i, posting in enumerate(corrected_postings):
-        corr = await database.fetch_all(
-            corrections.select(corrections.c.posting_id == posting["id"])
+    distance_km = 2 * EARTH_RADIUS_KM * sa.func.asin(sa.func.sqrt(haversine))
+
+    return [in_box, distance_km <= radius_km]
+
+
+@metrics.db_query_duration.time("add_postings")
+async def add_postings(postings_to_add) -> IngestReport:
+    await _ensure_partitions(postings_to_add)
+    postings_to_add = await _encode_labels(postings_to_add, register=True)
+    postings_to_add = [_with_postcode(p) for p in postings_to_add]
+    async with database.connection() as connection, connection.transaction():
+        await _lock_row_counts(connection)
+        await _create_staging_table(connection)
+        for i in range(0, len(postings_to_add), INSERT_CHUNK_SIZE):
+            chunk = postings_to_add[i : i + INSERT_CHUNK_SIZE]
+            await connection.execute(postings_staging.insert().values(chunk))
+        report, inserted_ids = await _upsert_staged_postings(connection)
+    _count_ingested(report)
+    await _publish_new_postings(inserted_ids)
+
+    return report
+
+
+@metrics.db_query_duration.time("bulk_add_postings")
+async def bulk_add_postings(postings_to_add) -> IngestReport:
+    await _ensure_partitions(postings_to_add)
+    postings_to_add = await _encode_labels(postings_to_add, register=True)
+    records = [
+        tuple(p[c] for c in INGEST_COLUMNS)
+        for p in map(_with_postcode, postings_to_add)
+    ]
+    async with database.connection() as connection, connection.transaction():
+        await _lock_row_counts(connection)
+        await _create_staging_table(connection)
+        await connection.raw_connection.copy_records_to_table(
+            postings_staging.name, records=records, columns=INGEST_COLUMNS
         )
-        corrected_postings[i] = CorrectedPosting(
-            **{**posting, "prediction": {**posting}, "corrections": corr}
+        report, inserted_ids = await _upsert_staged_postings(connection)
+    _count_ingested(report)
+    await _publish_new_postings(inserted_ids)
+
+    return report
+
+
+async def _ensure_partitions(postings_to_add):
+    # Outside of the ingest transaction, so that creating a partition only
+    # locks the table briefly. Only the weeks of the batch get one, and a date
+    # outside of the window raises a ValueError before any is created.
+    if not postings_to_add:
+        return
+    date_type = postgresql.ARRAY(sa.DateTime)
+    dates = sa.func.unnest(
+        sa.cast([p["date"] for p in postings_to_add], date_type)
+    ).column_valued("date")
+    batch = await database.fetch_one(
+        sa.select(
+            sa.func.min(dates).label("first_date"),
+            sa.func.max(dates).label("last_date"),
+            sa.func.array_agg(sa.distinct(sa.func.date_trunc("week", dates))).label(
+                "weeks"
+            ),
         )
+    )
+    now = datetime.now()
+    if batch["first_date"] < now - MAX_POSTING_AGE:
+        raise ValueError(f"Posting date {batch['first_date']} is too far in the past")
+    if batch["last_date"] > now + MAX_POSTING_LEAD:
+        raise ValueError(f"Posting date {batch['last_date']} is too far in the future")
+    weeks = sa.func.unnest(sa.cast(batch["weeks"], date_type)).column_valued("week")
+    await database.execute(
+        sa.select(sa.func.sum(sa.func.create_postings_partitions(weeks, weeks)))
+    )
+
+
+def _with_postcode(posting: dict) -> dict:
+    postcode = parse_postcode(posting["location"])
+    lat, lon = _postcode_coordinates().get(postcode, (None, None))
+
+    return {**posting, "postcode": postcode, "lat": lat, "lon": lon}
+
+
+async def _create_staging_table(connection):
+    await connection.execute(
+        f"CREATE TEMPORARY TABLE {postings_staging.name} ON COMMIT DROP AS "
+        f"SELECT {', '.join(INGEST_COLUMNS)} FROM {postings.name} WITH NO DATA"
+    )
+
+
+async def _upsert_staged_postings(connection) -> tuple[IngestReport, list[int]]:
+    already_stored = sa.exists().where(postings.c.url == postings_staging.c.url)
+    num_new = await connection.execute(
+        sa.select(sa.func.count(sa.distinct(postings_staging.c.url))).where(
+            ~already_stored
+        )
+    )
+    num_evicted = await _free_rows_over_limit(num_new * ROWS_PER_POSTING, connection)
+
+    # A posting scraped again refreshes its date and prediction
+    newest_staged = (
+        sa.select(postings_staging)
+        .distinct(postings_staging.c.url)
+        .order_by(postings_staging.c.url, postings_staging.c.date.desc())
+        .cte("newest_staged")
+    )
+    updated = (
+        postings.update()
+        .where(postings.c.url == newest_staged.c.url)
+        .values({c: newest_staged.c[c] for c in ("date", "bike", "frame", "color")})
+        .returning(postings.c.id)
+        .cte("updated")
+    )
+    inserted = (
+        postings.insert()
+        .from_select(
+            INGEST_COLUMNS,
+            sa.select(newest_staged).where(
+                ~sa.exists().where(postings.c.url == newest_staged.c.url)
+            ),
+        )
+        .returning(postings.c.id)
+        .cte("inserted")
+    )
+    num_inserted = (
+        sa.select(
+            sa.func.count().label("inserted"),
+            sa.func.array_agg(inserted.c.id).label("inserted_ids"),
+        )
+        .select_from(inserted)
+        .subquery()
+    )
+    num_updated = sa.select(sa.func.count().label("updated")).select_from(updated)
+    counts = await connection.fetch_one(
+        sa.select(
+            num_inserted.c.inserted,
+            num_inserted.c.inserted_ids,
+            num_updated.subquery().c.updated,
+        )
+    )
+    # New label combinations took facet counts, and evicted postings that were
+    # part of this batch came back as new rows
+    num_evicted += await _free_rows_over_limit(0, connection)
+    await connection.execute(f"DROP TABLE {postings_staging.name}")
+    inserted_ids = sorted(counts["inserted_ids"] or [])
+    await _notify_new_postings(inserted_ids, connection)
+    report = IngestReport(
+        inserted=counts["inserted"], updated=counts["updated"], evicted=num_evicted
+    )
+
+    return report, inserted_ids
+
+
+async def _notify_new_postings(posting_ids: list[int], connection):
+    # Delivered to the listeners of all workers once the transaction commits
+    for i in range(0, len(posting_ids), NOTIFY_CHUNK_SIZE):
+        payload = {"worker": WORKER_ID, "ids": posting_ids[i : i + NOTIFY_CHUNK_SIZE]}
+        await connection.execute(
+            sa.select(sa.func.pg_notify(NEW_POSTINGS_CHANNEL, json.dumps(payload)))
+        )
+
+
+async def _publish_new_postings(posting_ids: list[int]):
+    if not posting_ids or not len(new_postings):
+        return
+    # Read from the primary, a replica may not have replayed the inserts yet
+    query = (
+        sa.select(*posting_columns, *consensus_columns)
+        .where(postings.c.id.in_(posting_ids))
+        .order_by(postings.c.id)
+    )
+    fetched_postings = await database.fetch_all(query)
+    new_postings.publish(
+        await _decode_labels(
+            [r._mapping for r in fetched_postings], LABEL_ASPECTS + CONSENSUS_LABELS
+        )
+    )
+
+
+def _count_ingested(report: IngestReport):
+    metrics.rows_written.labels("postings", "insert").inc(report.inserted)
+    metrics.rows_written.labels("postings", "update").inc(report.updated)
+    metrics.rows_written.labels("postings", "evict").inc(report.evicted)
+
+
+async def get_corrections():
+    corrected_postings = await query_corrections()
+    corrected_postings = [
+        CorrectedPosting(
+            **{**posting, "prediction": {**posting}},
+            consensus=parse_consensus(posting),
+            corrections=[
+                Prediction(bike=bike, frame=frame, color=color)
+                for bike, frame, color in zip(
+                    posting["corrected_bike"],
+                    posting["corrected_frame"],
+                    posting["corrected_color"],
+                )
+            ],
+        )
+        for posting in corrected_postings
+    ]
 
     return corrected_postings
 
 
-async def add_corrections(correction_to_add):
-    corrected_posting = await database.fetch_one(
-        postings.select(postings.c.id == correction_to_add["posting_id"])
+@metrics.db_query_duration.time("query_corrections")
+async def query_corrections():
+    return await _corrections_flight.do(read_from_primary.get(), _query_corrections)
+
+
+async def _query_corrections():
+    reader = _reader()
+    corrected_postings = await reader.fetch_all(_corrected_postings_query())
+
+    return await _decode_corrected_postings(corrected_postings)
+
+
+async def _decode_corrected_postings(records) -> list[dict]:
+    return await _decode_labels(
+        [r._mapping for r in records],
+        LABEL_ASPECTS + CONSENSUS_LABELS,
+        CORRECTED_LABELS,
+    )
+
+
+def _corrected_postings_query(since: int = 0, until: Optional[int] = None):
+    # One row per corrected posting with its corrections as corrected_* arrays
+    aggregated_columns = [
+        sa.func.array_agg(
+            aggregate_order_by(corrections.c[aspect], corrections.c.id)
+        ).label(f"corrected_{aspect}")
+        for aspect in LABEL_ASPECTS
+    ]
+    query = (
+        sa.select(*posting_columns, *consensus_columns, *aggregated_columns)
+        .join_from(postings, corrections, postings.c.id == corrections.c.posting_id)
+        .where(corrections.c.id > since)
+        .group_by(postings.c.id, postings.c.date)
+        .order_by(postings.c.id)
+    )
+    if until is not None:
+        query = query.where(corrections.c.id <= until)
+
+    return query
+
+
+@metrics.db_query_duration.time("query_correction_feed")
+async def query_correction_feed(since: int, limit: int):
+    # Corrections and tombstones are read in watermark order. Writers take the
+    # row budget lock before drawing ids, so ids become visible in order and no
+    # event can appear below a watermark that was already handed out.
+    events = sa.union_all(
+        sa.select(
+            corrections.c.id,
+            corrections.c.posting_id,
+            sa.false().label("deleted"),
+        ).where(corrections.c.id > since),
+        sa.select(
+            correction_tombstones.c.id,
+            correction_tombstones.c.posting_id,
+            sa.true().label("deleted"),
+        ).where(correction_tombstones.c.id > since),
+    ).subquery()
+    query = sa.select(events).order_by(events.c.id).limit(limit)
+    reader = _reader()
+    fetched_events = await reader.fetch_all(query)
+    watermark = fetched_events[-1]["id"] if fetched_events else since
+    # Postings deleted after reading the events get a tombstone above watermark
+    corrected_postings = await _decode_corrected_postings(
+        await reader.fetch_all(_corrected_postings_query(since, watermark))
+    )
+    stale = await _is_stale_watermark(since, reader)
+    deleted_ids = sorted({e["posting_id"] for e in fetched_events if e["deleted"]})
+
+    return corrected_postings, deleted_ids, watermark, stale
+
+
+async def _is_stale_watermark(since: int, reader: databases.Database) -> bool:
+    # Tombstones below the oldest kept one may have been pruned, so a reader
+    # behind it cannot catch up incrementally
+    if since == 0:
+        return False
+    query = sa.select(
+        sa.func.count().label("num_tombstones"),
+        sa.func.min(correction_tombstones.c.id).label("oldest_id"),
+    )
+    tombstones = await reader.fetch_one(query)
+
+    return (
+        tombstones["num_tombstones"] >= MAX_TOMBSTONES
+        and since < tombstones["oldest_id"] - 1
+    )
+
+
+async def iter_corrections():
+    # One row per correction, streamed from a server-side cursor so that memory
+    # does not grow with the table. Plain asyncpg records are several times
+    # cheaper to read than the ones wrapped by databases.
+    query = (
+        sa.select(
+            corrections.c.id.label("correction_id"),
+            corrections.c.posting_id,
+            *[c for c in posting_columns if c.name != "id"],
+            *[
+                corrections.c[aspect].label(f"corrected_{aspect}")
+                for aspect in LABEL_ASPECTS
+            ],
+        )
+        .join_from(corrections, postings, corrections.c.posting_id == postings.c.id)
+        .order_by(corrections.c.id)
     )
-    if corrected_posting is None:
-        raise RuntimeError(
-            f"Posting with ID {correction_to_add['posting_id']} not found"
+    query = str(
+        query.compile(
+            dialect=postgresql.dialect(), compile_kwargs={"literal_binds": True}
         )
-    else:
-        await _free_rows_over_limit(1)
-        await database.execute(corrections.insert(), correction_to_add)
+    )
+    reader = _reader()
+    async with reader.connection() as connection, connection.transaction():
+        cursor = await connection.raw_connection.cursor(query)
+        while records := await cursor.fetch(EXPORT_PREFETCH):
+            for record in await _decode_labels(
+                records, LABEL_ASPECTS + CORRECTED_LABELS
+            ):
+                yield record
+
+
+async def add_corrections(correction_to_add) -> int:
+    unknown_ids, lsn = await add_correction_batch([correction_to_add])
+    if unknown_ids:
+        raise RuntimeError(f"Posting with ID {unknown_ids[0]} not found")
 
+    return lsn
 
-async def _free_rows_over_limit(num_rows_added: int):
-    free_rows = await _get_free_rows()
+
+@metrics.db_query_duration.time("add_corrections")
+async def add_correction_batch(corrections_to_add: list[dict]) -> tuple[list[int], int]:
+    # Corrections of postings that do not exist are skipped and their posting
+    # ids returned, together with the position for reading the others back.
+    # Unknown labels raise a ValueError, users cannot extend the dictionary.
+    corrections_to_add = await _encode_labels(corrections_to_add)
+    posting_ids = {c["posting_id"] for c in corrections_to_add}
+    async with database.connection() as connection, connection.transaction():
+        # No other writer evicts while the counters are locked
+        await _lock_row_counts(connection)
+        known_ids = await _existing_posting_ids(posting_ids, connection)
+        num_known = sum(c["posting_id"] in known_ids for c in corrections_to_add)
+        num_evicted = await _free_rows_over_limit(num_known, connection)
+        if num_evicted:
+            # The oldest postings may have been among them
+            known_ids = await _existing_posting_ids(known_ids, connection)
+        known_corrections = [
+            c for c in corrections_to_add if c["posting_id"] in known_ids
+        ]
+        if known_corrections:
+            await connection.execute(corrections.insert().values(known_corrections))
+    metrics.rows_written.labels("corrections", "insert").inc(len(known_corrections))
+    if num_evicted:
+        metrics.rows_written.labels("postings", "evict").inc(num_evicted)
+
+    return sorted(posting_ids - known_ids), await _write_lsn()
+
+
+async def _existing_posting_ids(posting_ids: set[int], connection) -> set[int]:
+    return {
+        r["id"]
+        for r in await connection.fetch_all(
+            sa.select(postings.c.id).where(postings.c.id.in_(posting_ids))
+        )
+    }
+
+
+@metrics.db_query_duration.time("get_facets")
+async def get_facets(bike, color, frame) -> dict[str, dict[str, int]]:
+    names = {"bike": bike, "frame": frame, "color": color}
+    filters = {
+        aspect: await _label_code(name)
+        for aspect, name in names.items()
+        if name is not None
+    }
+    facets = {aspect: {} for aspect in names}
+    facet_queries = []
+    for aspect in names:
+        # Each facet is restricted by the filters on the other aspects only. An
+        # unknown label matches nothing, so its facet is not queried.
+        other_filters = {o: code for o, code in filters.items() if o != aspect}
+        if None in other_filters.values():
+            continue
+        where_clauses = [
+            facet_counts.c[other] == code for other, code in other_filters.items()
+        ]
+        facet_queries.append(
+            sa.select(
+                sa.literal(aspect).label("aspect"),
+                facet_counts.c[aspect].label("value"),
+                sa.func.sum(facet_counts.c.posting_count).label("posting_count"),
+            )
+            .where(*where_clauses)
+            .group_by(facet_counts.c[aspect])
+        )
+    if not facet_queries:
+        return facets
+    reader = _reader()
+    counts = await _decode_labels(
+        [r._mapping for r in await reader.fetch_all(sa.union_all(*facet_queries))],
+        ["value"],
+    )
+    for count in counts:
+        facets[count["aspect"]][count["value"]] = count["posting_count"]
+
+    return facets
+
+
+@metrics.db_query_duration.time("get_write_generation")
+async def get_write_generation(*tables: sa.Table) -> int:
+    # The sum grows with every write to any of the tables, it is read where the
+    # rows are read so that it describes the same state
+    reader = _reader()
+    generation = await reader.execute(_write_generation_query(*tables))
+
+    return generation
+
+
+def _write_generation_query(*tables: sa.Table):
+    return sa.select(sa.func.sum(row_counts.c.generation).label("generation")).where(
+        row_counts.c.table_name.in_([t.name for t in tables])
+    )
+
+
+@metrics.db_query_duration.time("evict_over_high_water")
+async def evict_over_high_water(chunk_size: int) -> tuple[int, int]:
+    # Drops the oldest partition, or deletes at most one chunk of the oldest
+    # postings if only the current week is left, while above the high-water
+    # mark. Returns how many postings were evicted and how many rows are still
+    # above the mark.
+    backlog = await _high_water_backlog()
+    if not backlog:
+        return 0, 0
+    num_evicted = 0
+    while num_evicted == 0:  # Empty partitions are dropped on the way
+        try:
+            num_evicted = await drop_oldest_postings_partition()
+        except asyncpg.exceptions.LockNotAvailableError:
+            # Readers or writers kept the table busy, the janitor tries later
+            return 0, backlog
+    if num_evicted is None:
+        async with database.connection() as connection, connection.transaction():
+            backlog = await _high_water_backlog(connection, for_update=True)
+            num_evicted = 0
+            if backlog:
+                num_evicted = await clear_old_postings(
+                    min(chunk_size, _postings_for_rows(backlog)), connection
+                )
+    if num_evicted:
+        metrics.rows_written.labels("postings", "evict").inc(num_evicted)
+
+    return num_evicted, await _high_water_backlog()
+
+
+async def _high_water_backlog(connection=None, for_update: bool = False) -> int:
+    free_rows = await _get_free_rows(connection, for_update)
+    row_limit = int(os.environ["ROW_LIMIT"])
+    high_water = int(row_limit * float(os.getenv("EVICTION_HIGH_WATER", 0.9)))
+
+    return max(row_limit - free_rows - high_water, 0)
+
+
+async def _free_rows_over_limit(num_rows_added: int, connection) -> int:
+    # Must run inside a transaction on the connection that adds the rows. The
+    # janitor keeps the tables below the high-water mark, so this only deletes
+    # when a write would exceed the hard limit before it caught up.
+    free_rows = await _get_free_rows(connection, for_update=True)
     free_after_add = free_rows - num_rows_added
     if free_after_add < 0:
-        await clear_old_postings(-free_after_add)
+        return await clear_old_postings(_postings_for_rows(-free_after_add), connection)
+    else:
+        return 0
 
 
-async def _get_free_rows():
-    posting_count = await _get_row_count(postings)
-    correction_count = await _get_row_count(corrections)
-    row_limit = int(os.environ["ROW_LIMIT"])
-    free_rows = row_limit - (posting_count + correction_count + 1)  # one for alembic
+def _postings_for_rows(num_rows: int) -> int:
+    # How many postings to evict to free the rows, not counting their corrections
+    return -(-num_rows // ROWS_PER_POSTING)
 
-    return free_rows
+
+async def _lock_row_counts(connection):
+    # Writers take it before touching postings, so that they and the partition
+    # dropper queue for the tables in the same order
+    await connection.fetch_all(
+        sa.select(row_counts.c.table_name)
+        .order_by(row_counts.c.table_name)
+        .with_for_update()
+    )
 
 
-async def _get_row_count(table):
-    return await database.execute(sa.select(sa.func.count()).select_from(table))
+@metrics.db_query_duration.time("row_counts")
+async def _get_free_rows(connection=None, for_update: bool = False):
+    connection = connection or database
+    query = sa.select(row_counts.c.row_count).order_by(row_counts.c.table_name)
+    if for_update:
+        # Locking the counters serializes concurrent writers until they commit
+        query = query.with_for_update()
+    counts = await connection.fetch_all(query)
+    # The counters take a row each, too, and one more is alembic's
+    row_count = sum(r["row_count"] for r in counts) + len(counts) + 1
+    free_rows = int(os.environ["ROW_LIMIT"]) - row_count
+
+    return free_rows
@@ -1,13 +1,93 @@
+import csv
+import hashlib
+import hmac
+import math
 import os
+import time
+from typing import Optional
 
 from fastapi import Security, HTTPException
 from fastapi.security import APIKeyQuery, APIKeyHeader, APIKeyCookie
-from starlette.status import HTTP_403_FORBIDDEN
+from starlette.status import HTTP_403_FORBIDDEN, HTTP_429_TOO_MANY_REQUESTS
+
+from backend.app import metrics
 
 API_KEY = os.environ["API_KEY"]
 ADMIN_KEY = os.environ["ADMIN_KEY"]
 API_KEY_NAME = "access_token"
 COOKIE_DOMAIN = os.environ["COOKIE_DOMAIN"]
+# Requests per second and burst of the keys in API_KEYS_FILE without limits of
+# their own. Every worker process keeps its own buckets.
+API_KEY_RATE = float(os.getenv("API_KEY_RATE", 10))
+API_KEY_BURST = float(os.getenv("API_KEY_BURST", 50))
+# Signs the read-after tokens, so that clients cannot send their reads to the
+# primary at will. Every worker process needs the same one.
+READ_AFTER_SECRET = os.getenv("READ_AFTER_SECRET", ADMIN_KEY)
+
+
+class TokenBucket:
+    __slots__ = ("rate", "burst", "tokens", "updated")
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def take(self) -> bool:
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+    def retry_after(self) -> float:
+        return (1 - self.tokens) / self.rate
+
+
+class Credential:
+    __slots__ = ("name", "bucket", "allowed", "limited")
+
+    def __init__(
+        self, name: str, rate: Optional[float] = None, burst: Optional[float] = None
+    ):
+        # Without a rate the key is not limited
+        if rate is not None and (rate <= 0 or burst < 1):
+            raise ValueError(
+                f"API key {name} needs a positive rate and a burst of at least 1"
+            )
+        self.name = name
+        self.bucket = None if rate is None else TokenBucket(rate, burst)
+        self.allowed = metrics.api_key_requests.labels(name, "allowed")
+        self.limited = metrics.api_key_requests.labels(name, "limited")
+
+
+def load_credentials() -> dict[str, Credential]:
+    # Keys are looked up by their SHA-256 digest, so that the file of further
+    # keys does not need to contain them in plain text. Its columns are name,
+    # sha256, rate and burst, empty limits fall back to the defaults. API_KEY is
+    # shared by all visitors of the frontend, so it is not limited unless the
+    # file lists its digest with a budget for the whole site.
+    credentials = {_digest(API_KEY): Credential("default")}
+    if "API_KEYS_FILE" in os.environ:
+        with open(os.environ["API_KEYS_FILE"], newline="") as f:
+            for row in csv.DictReader(f):
+                credentials[row["sha256"].lower()] = Credential(
+                    row["name"],
+                    float(row.get("rate") or API_KEY_RATE),
+                    float(row.get("burst") or API_KEY_BURST),
+                )
+
+    return credentials
+
+
+def _digest(key: str) -> str:
+    return hashlib.sha256(key.encode()).hexdigest()
+
+
+credentials = load_credentials()
 
 
 api_key_query = APIKeyQuery(name=API_KEY_NAME, auto_error=False)
@@ -20,16 +100,46 @@ async def get_api_key(
     header_key: str = Security(api_key_header),
     cookie_key: str = Security(api_key_cookie),
 ) -> str:
-    if query_key == API_KEY:
-        return query_key
-    elif header_key == API_KEY:
-        return header_key
-    elif cookie_key == API_KEY:
-        return cookie_key
+    return authorize(query_key, header_key, cookie_key)
+
+
+def authorize(*keys: Optional[str]) -> str:
+    # Runs as a dependency, so requests over budget never reach the database
+    for key in keys:
+        if key is not None:
+            credential = credentials.get(_digest(key))
+            if credential is not None:
+                break
     else:
         raise HTTPException(
             status_code=HTTP_403_FORBIDDEN, detail="Credential invalid or not available"
         )
+    if credential.bucket is not None and not credential.bucket.take():
+        credential.limited.inc()
+        raise HTTPException(
+            status_code=HTTP_429_TOO_MANY_REQUESTS,
+            detail="Rate limit exceeded",
+            headers={"Retry-After": str(math.ceil(credential.bucket.retry_after()))},
+        )
+    credential.allowed.inc()
+
+    return key
+
+
+def sign_read_after(lsn: int) -> str:
+    return f"{lsn}.{_read_after_signature(str(lsn))}"
+
+
+def verify_read_after(token: str) -> int:
+    lsn, _, signature = token.partition(".")
+    if not hmac.compare_digest(signature, _read_after_signature(lsn)):
+        raise ValueError("Invalid read-after token")
+
+    return int(lsn)
+
+
+def _read_after_signature(lsn: str) -> str:
+    return hmac.new(READ_AFTER_SECRET.encode(), lsn.encode(), "sha256").hexdigest()
 
 
 admin_key = APIKeyHeader(name=API_KEY_NAME, auto_error=True)
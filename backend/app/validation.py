@@ -1,6 +1,34 @@
+import base64
+import binascii
+import csv
 import datetime
+import io
+import json
+import re
+from typing import Iterable, Mapping, Optional, Union
 
-from pydantic import BaseModel
+from pydantic import BaseModel, conlist
+
+MAX_CORRECTION_BATCH = 100
+POSTCODE_PATTERN = re.compile(r"\b(\d{5})\b")
+# Flat layout of an exported correction, one row per correction
+EXPORT_FIELDS = [
+    "correction_id",
+    "posting_id",
+    "title",
+    "url",
+    "image_url",
+    "location",
+    "query",
+    "loc_query",
+    "date",
+    "bike",
+    "frame",
+    "color",
+    "corrected_bike",
+    "corrected_frame",
+    "corrected_color",
+]
 
 
 class Prediction(BaseModel):
@@ -24,12 +52,46 @@ class IncomingPostingList(BaseModel):
     data: list[IncomingPosting]
 
 
+class IngestReport(BaseModel):
+    inserted: int = 0
+    updated: int = 0
+    evicted: int = 0
+
+
+class CacheStats(BaseModel):
+    entries: int
+    size: int
+    max_bytes: int
+    hits: int
+    misses: int
+    evictions: int
+
+
+class Votes(BaseModel):
+    bike: int
+    frame: int
+    color: int
+
+
+class Consensus(Prediction):
+    votes: Votes
+    num_corrections: int
+
+
 class Posting(IncomingPosting):
     id: str
+    consensus: Optional[Consensus] = None  # Only for corrected postings
 
 
 class PostingList(BaseModel):
     data: list[Posting]
+    cursor: Optional[str] = None
+
+
+class Facets(BaseModel):
+    bike: dict[str, int]
+    frame: dict[str, int]
+    color: dict[str, int]
 
 
 class IncomingCorrection(BaseModel):
@@ -37,6 +99,15 @@ class IncomingCorrection(BaseModel):
     correction: Prediction
 
 
+class IncomingCorrectionList(BaseModel):
+    data: conlist(IncomingCorrection, min_items=1, max_items=MAX_CORRECTION_BATCH)
+
+
+class CorrectionReport(BaseModel):
+    inserted: int = 0
+    unknown: list[int] = []  # Posting ids of corrections that were skipped
+
+
 class Correction(IncomingCorrection):
     id: int
 
@@ -49,8 +120,155 @@ class CorrectedPostingList(BaseModel):
     data: list[CorrectedPosting]
 
 
+class CorrectionFeed(CorrectedPostingList):
+    deleted: list[str]
+    watermark: int
+    stale: bool
+
+
 def flatten(entity: BaseModel, nested: str) -> dict:
     entity_dict = entity.dict(exclude={nested})
     entity_dict.update(getattr(entity, nested).dict())
 
     return entity_dict
+
+
+def parse_postcode(location: Optional[str]) -> Optional[str]:
+    match = POSTCODE_PATTERN.search(location or "")
+
+    return match.group(1) if match else None
+
+
+def parse_consensus(record: Mapping) -> Optional[dict]:
+    if not record["num_corrections"]:
+        return None
+    aspects = ("bike", "frame", "color")
+    return {
+        **{aspect: record[f"consensus_{aspect}"] for aspect in aspects},
+        "votes": {aspect: record[f"consensus_{aspect}_votes"] for aspect in aspects},
+        "num_corrections": record["num_corrections"],
+    }
+
+
+def dump_posting_list(
+    records: Iterable[Mapping], cursor: Optional[str] = None
+) -> bytes:
+    # Fast path for rows read from our own tables: same wire format as
+    # PostingList.json() but without validating every row again
+    data = [_posting_to_dict(r) for r in records]
+
+    return json.dumps({"data": data, "cursor": cursor}).encode()
+
+
+def dump_posting_events(records: Iterable[Mapping]) -> bytes:
+    # Server-sent events, one per posting with the same fields as PostingList
+    events = [
+        f"id: {r['id']}\nevent: posting\ndata: {json.dumps(_posting_to_dict(r))}\n\n"
+        for r in records
+    ]
+
+    return "".join(events).encode()
+
+
+def dump_corrected_posting_list(records: Iterable[Mapping]) -> bytes:
+    return json.dumps({"data": _corrected_postings_to_dicts(records)}).encode()
+
+
+def dump_correction_feed(
+    records: Iterable[Mapping], deleted: Iterable[int], watermark: int, stale: bool
+) -> bytes:
+    feed = {
+        "data": _corrected_postings_to_dicts(records),
+        "deleted": [str(posting_id) for posting_id in deleted],
+        "watermark": watermark,
+        "stale": stale,
+    }
+
+    return json.dumps(feed).encode()
+
+
+def _corrected_postings_to_dicts(records: Iterable[Mapping]) -> list[dict]:
+    # Records carry the corrections as parallel corrected_* arrays
+    data = []
+    for record in records:
+        posting = _posting_to_dict(record)
+        posting["corrections"] = [
+            {"bike": bike, "frame": frame, "color": color}
+            for bike, frame, color in zip(
+                record["corrected_bike"],
+                record["corrected_frame"],
+                record["corrected_color"],
+            )
+        ]
+        data.append(posting)
+
+    return data
+
+
+def dump_export_ndjson(records: Iterable[Mapping]) -> bytes:
+    lines = [json.dumps(_export_row(r)) for r in records]
+
+    return ("\n".join(lines) + "\n").encode() if lines else b""
+
+
+def dump_export_csv(records: Iterable[Mapping], header: bool = False) -> bytes:
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, EXPORT_FIELDS, lineterminator="\n")
+    if header:
+        writer.writeheader()
+    writer.writerows(_export_row(r) for r in records)
+
+    return buffer.getvalue().encode()
+
+
+def _export_row(record: Mapping) -> dict:
+    row = {field: record[field] for field in EXPORT_FIELDS}
+    if row["date"] is not None:
+        row["date"] = row["date"].isoformat()
+
+    return row
+
+
+def _posting_to_dict(record: Mapping) -> dict:
+    date = record["date"]
+    return {
+        "title": record["title"],
+        "url": record["url"],
+        "image_url": record["image_url"],
+        "location": record["location"],
+        "query": record["query"],
+        "loc_query": record["loc_query"],
+        "date": date.isoformat() if date is not None else None,
+        "prediction": {
+            "bike": record["bike"],
+            "frame": record["frame"],
+            "color": record["color"],
+        },
+        "id": str(record["id"]),
+        "consensus": parse_consensus(record),
+    }
+
+
+def encode_cursor(sort_key: Union[datetime.datetime, float], posting_id: int) -> str:
+    if isinstance(sort_key, datetime.datetime):
+        sort_key = sort_key.isoformat()
+    raw_cursor = f"{sort_key}|{posting_id}".encode()
+
+    return base64.urlsafe_b64encode(raw_cursor).decode()
+
+
+def decode_cursor(cursor: str) -> tuple[Union[datetime.datetime, float], int]:
+    try:
+        raw_cursor = base64.urlsafe_b64decode(cursor.encode()).decode()
+        sort_key, posting_id = raw_cursor.split("|")
+        return _decode_sort_key(sort_key), int(posting_id)
+    except (binascii.Error, UnicodeDecodeError, ValueError):
+        raise ValueError(f"Malformed cursor {cursor!r}")
+
+
+def _decode_sort_key(sort_key: str) -> Union[datetime.datetime, float]:
+    # Search ranks are floats, dates in ISO format never parse as one
+    try:
+        return float(sort_key)
+    except ValueError:
+        return datetime.datetime.fromisoformat(sort_key)
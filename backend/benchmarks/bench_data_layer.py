@@ -0,0 +1,198 @@
+"""Measure latency and throughput of the data layer at realistic sizes.
+
+Run from the repository root against the local test database:
+
+    python -m backend.benchmarks.bench_data_layer --sizes 10000 100000 1000000
+
+Results are written as JSON, by default to benchmark-<commit>.json, and two
+runs can be compared with backend.benchmarks.compare.
+"""
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import statistics
+import subprocess
+import time
+from datetime import datetime, timedelta
+
+import sqlalchemy as sa
+
+from backend.app import models
+from backend.benchmarks import data
+
+DATABASE_URL = "postgresql://backend@/test-my-bike"
+SIZES = [10_000, 100_000, 1_000_000]
+REPEAT = 20
+WARMUP = 3
+INGEST_BATCH_SIZE = 100
+EVICTION_BATCH_SIZE = 10
+RADIUS_KM = 25
+
+
+def _operations(rng: random.Random, posting_ids: list[int], postcodes: list[dict]):
+    # Name, callable returning an awaitable, rows handled per call. Operations
+    # that write come last, so that reads see the generated data set.
+    words = data.BRANDS + data.KINDS
+    batch_counter = iter(range(10**9))
+
+    def query_filtered():
+        # Keywords, the positional order of query_postings is bike, color, frame
+        return models.query_postings(**data.random_prediction(rng), limit=10, skip=0)
+
+    def query_cursor():
+        date = datetime.now() - timedelta(days=rng.uniform(0, data.DAYS))
+        return models.query_postings(None, None, None, 10, 0, (date, 0))
+
+    def query_radius():
+        postcode = rng.choice(postcodes)
+        return models.query_postings(
+            None,
+            None,
+            None,
+            10,
+            0,
+            lat=postcode["lat"],
+            lon=postcode["lon"],
+            radius_km=RADIUS_KM,
+        )
+
+    def add_postings():
+        batch = next(
+            data.generate_postings(
+                INGEST_BATCH_SIZE, postcodes, seed=next(batch_counter) + 1
+            )
+        )
+        return models.add_postings(batch)
+
+    def add_corrections():
+        correction = {
+            "posting_id": rng.choice(posting_ids),
+            **data.random_prediction(rng),
+        }
+        return models.add_corrections(correction)
+
+    return [
+        ("query_postings", lambda: models.query_postings(None, None, None, 10, 0), 10),
+        ("query_postings_filtered", query_filtered, 10),
+        ("query_postings_cursor", query_cursor, 10),
+        (
+            "query_postings_search",
+            lambda: models.query_postings(None, None, None, 10, 0, q=rng.choice(words)),
+            10,
+        ),
+        ("query_postings_radius", query_radius, 10),
+        ("get_facets", lambda: models.get_facets(None, None, None), 1),
+        ("get_corrections", models.get_corrections, 1),
+        ("add_postings", add_postings, INGEST_BATCH_SIZE),
+        ("add_corrections", add_corrections, 1),
+        (
+            "clear_old_postings",
+            lambda: models.clear_old_postings(EVICTION_BATCH_SIZE),
+            EVICTION_BATCH_SIZE,
+        ),
+    ]
+
+
+async def _measure(operation, rows: int, repeat: int) -> dict:
+    for _ in range(WARMUP):
+        await operation()
+    latencies = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        await operation()
+        latencies.append(time.perf_counter() - start)
+    total = sum(latencies)
+    percentiles = statistics.quantiles(latencies, n=100, method="inclusive")
+
+    return {
+        "repeat": repeat,
+        "p50_ms": percentiles[49] * 1000,
+        "p90_ms": percentiles[89] * 1000,
+        "p99_ms": percentiles[98] * 1000,
+        "max_ms": max(latencies) * 1000,
+        "ops_per_s": repeat / total,
+        "rows_per_s": repeat * rows / total,
+    }
+
+
+async def _bench_size(size: int, repeat: int, seed: int) -> list[dict]:
+    engine = sa.create_engine(DATABASE_URL)
+    models.metadata.drop_all(engine)
+    models.metadata.create_all(engine)
+    # Leave room for everything the write operations add
+    os.environ["ROW_LIMIT"] = str((models.ROWS_PER_POSTING + 1) * size + 100_000)
+    await models.connect()
+    try:
+        start = time.perf_counter()
+        posting_ids = await data.populate(size, seed)
+        print(f"populated {size} postings in {time.perf_counter() - start:.1f}s")
+        rng = random.Random(seed)
+        results = []
+        for name, operation, rows in _operations(
+            rng, posting_ids, data.load_postcodes()
+        ):
+            result = {
+                "size": size,
+                "operation": name,
+                **await _measure(operation, rows, repeat),
+            }
+            print(
+                f"{size:>8} {name:<24} p50 {result['p50_ms']:>9.2f}ms "
+                f"p99 {result['p99_ms']:>9.2f}ms {result['ops_per_s']:>9.1f} ops/s"
+            )
+            results.append(result)
+    finally:
+        await models.disconnect()
+        models.metadata.drop_all(engine)
+
+    return results
+
+
+def _git_commit() -> str:
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+        dirty = subprocess.run(["git", "diff", "--quiet", "HEAD"]).returncode != 0
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+    return f"{commit}-dirty" if dirty else commit
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=SIZES)
+    parser.add_argument("--repeat", type=int, default=REPEAT)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="defaults to benchmark-<commit>.json")
+    args = parser.parse_args()
+
+    os.environ.setdefault("DATABASE_URL", DATABASE_URL)
+    os.environ.setdefault("MIN_DATABASE_CONNECTIONS", "1")
+    commit = _git_commit()
+    results = []
+    for size in args.sizes:
+        results.extend(await _bench_size(size, args.repeat, args.seed))
+
+    report = {
+        "commit": commit,
+        "created": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "seed": args.seed,
+        "results": results,
+    }
+    output = args.output or f"benchmark-{commit}.json"
+    with open(output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"wrote {output}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
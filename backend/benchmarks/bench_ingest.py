@@ -0,0 +1,82 @@
+"""Compare loading postings with multi-row INSERTs and with COPY.
+
+Both ingest paths fill a staging table and then upsert the staged postings by
+URL, they differ in how the staging table is loaded.
+
+Run from the repository root against the local test database:
+
+    python -m backend.benchmarks.bench_ingest
+"""
+import asyncio
+import os
+import time
+from datetime import datetime, timedelta
+
+import sqlalchemy as sa
+
+from backend.app import models
+
+DATABASE_URL = "postgresql://backend@/test-my-bike"
+SIZES = [1_000, 10_000, 100_000]
+CHUNK_SIZE = 5000
+
+
+def _make_postings(num: int) -> list[dict]:
+    start = datetime.now()
+    return [
+        {
+            "title": f"Bench Bike {i}",
+            "url": f"https://foo.bar/{i}",
+            "image_url": "https://foo.bar/img",
+            "location": "12345, Berlin",
+            "query": "Fahrrad",
+            "loc_query": "Berlin",
+            "date": start + timedelta(seconds=i),
+            "bike": "road",
+            "frame": "diamond",
+            "color": "black",
+        }
+        for i in range(num)
+    ]
+
+
+async def _insert(postings_to_add):
+    await models.add_postings(postings_to_add)
+
+
+async def _copy(postings_to_add):
+    for i in range(0, len(postings_to_add), CHUNK_SIZE):
+        await models.bulk_add_postings(postings_to_add[i : i + CHUNK_SIZE])
+
+
+async def _time_ingest(ingest, postings_to_add) -> float:
+    engine = sa.create_engine(DATABASE_URL)
+    models.metadata.drop_all(engine)
+    models.metadata.create_all(engine)
+    await models.connect()
+    try:
+        start = time.perf_counter()
+        await ingest(postings_to_add)
+        return time.perf_counter() - start
+    finally:
+        await models.disconnect()
+        models.metadata.drop_all(engine)
+
+
+async def main():
+    os.environ.setdefault("DATABASE_URL", DATABASE_URL)
+    os.environ.setdefault("MIN_DATABASE_CONNECTIONS", "1")
+    # Room for all postings, so that no eviction is timed
+    os.environ["ROW_LIMIT"] = str(models.ROWS_PER_POSTING * max(SIZES) + 1000)
+
+    print(f"{'rows':>8} {'insert [s]':>11} {'copy [s]':>9} {'speedup':>8}")
+    for size in SIZES:
+        postings_to_add = _make_postings(size)
+        insert_time = await _time_ingest(_insert, postings_to_add)
+        copy_time = await _time_ingest(_copy, postings_to_add)
+        speedup = insert_time / copy_time
+        print(f"{size:>8} {insert_time:>11.3f} {copy_time:>9.3f} {speedup:>7.1f}x")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,31 @@
+"""Measure the overhead of recording metrics on the request path.
+
+Run from the repository root, no database is needed:
+
+    python -m backend.benchmarks.bench_metrics
+"""
+import timeit
+
+from backend.app import metrics
+
+NUMBER = 100_000
+REPEAT = 5
+
+
+def main():
+    registry = []
+    histogram = metrics.Histogram(
+        "bench_seconds", "Bench", ["route"], registry=registry
+    )
+    counter = metrics.Counter("bench_total", "Bench", ["route"], registry=registry)
+    operations = {
+        "histogram observe": lambda: histogram.labels("/posting").observe(0.003),
+        "counter inc": lambda: counter.labels("/posting").inc(),
+    }
+    for name, operation in operations.items():
+        duration = min(timeit.repeat(operation, number=NUMBER, repeat=REPEAT))
+        print(f"{name:<18} {1e6 * duration / NUMBER:>6.2f} us per call")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,35 @@
+"""Measure the overhead of authorizing a request by its API key.
+
+Run from the repository root with the settings of the API, no database is
+needed:
+
+    API_KEY=a ADMIN_KEY=b COOKIE_DOMAIN=localhost \
+        python -m backend.benchmarks.bench_security
+"""
+import timeit
+
+from backend.app import security
+
+NUMBER = 100_000
+REPEAT = 5
+
+
+def main():
+    security.credentials = {
+        security._digest("unlimited"): security.Credential("unlimited"),
+        # A budget that never runs out, so that every call takes a token
+        security._digest("limited"): security.Credential("limited", 1e9, 1e9),
+    }
+    for key in ("unlimited", "limited"):
+        duration = min(
+            timeit.repeat(
+                lambda: security.authorize(None, key, None),
+                number=NUMBER,
+                repeat=REPEAT,
+            )
+        )
+        print(f"{key:<10} {1e6 * duration / NUMBER:>6.2f} us per authorization")
+
+
+if __name__ == "__main__":
+    main()
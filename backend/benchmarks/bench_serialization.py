@@ -0,0 +1,83 @@
+"""Compare serializing posting listings with and without pydantic.
+
+Run from the repository root, no database is needed:
+
+    python -m backend.benchmarks.bench_serialization
+"""
+import random
+import timeit
+from datetime import datetime, timedelta
+
+from backend.app import validation
+from backend.benchmarks import data
+
+PAGE_SIZES = [10, 100, 1000]
+ROWS_PER_RUN = 1000
+REPEAT = 5
+
+
+def _make_records(num: int, rng: random.Random) -> list[dict]:
+    start = datetime.now()
+    records = []
+    for i in range(num):
+        corrected = i % 10 == 0
+        consensus = data.random_prediction(rng)
+        records.append(
+            {
+                "id": i,
+                "title": f"Bench Bike {i}",
+                "url": f"https://bench.example/{i}",
+                "image_url": f"https://bench.example/{i}.jpg",
+                "location": "12345 Berlin",
+                "query": "Fahrrad",
+                "loc_query": "Berlin",
+                "date": start - timedelta(minutes=i),
+                **data.random_prediction(rng),
+                **{f"consensus_{a}": consensus[a] for a in consensus},
+                **{f"consensus_{a}_votes": 1 for a in consensus},
+                "num_corrections": 1 if corrected else 0,
+            }
+        )
+
+    return records
+
+
+def _validated(records: list[dict]) -> bytes:
+    # The path the responses took before, for comparison
+    postings = [
+        validation.Posting(
+            **{**p, "prediction": {**p}}, consensus=validation.parse_consensus(p)
+        )
+        for p in records
+    ]
+
+    return validation.PostingList(data=postings, cursor=None).json().encode()
+
+
+def main():
+    rng = random.Random(0)
+    print(
+        f"{'rows':>6} {'validated [us/row]':>19} {'dumped [us/row]':>16} {'speedup':>8}"
+    )
+    for page_size in PAGE_SIZES:
+        records = _make_records(page_size, rng)
+        number = max(1, ROWS_PER_RUN // page_size)
+        per_row = 1e6 / (number * page_size)
+        validated = min(
+            timeit.repeat(lambda: _validated(records), number=number, repeat=REPEAT)
+        )
+        dumped = min(
+            timeit.repeat(
+                lambda: validation.dump_posting_list(records, None),
+                number=number,
+                repeat=REPEAT,
+            )
+        )
+        print(
+            f"{page_size:>6} {validated * per_row:>19.1f} {dumped * per_row:>16.1f} "
+            f"{validated / dumped:>7.1f}x"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,53 @@
+"""Compare two data layer benchmark runs and flag regressions.
+
+    python -m backend.benchmarks.compare benchmark-old.json benchmark-new.json
+
+Exits with status 1 if the median latency of any operation grew by more
+than the threshold.
+"""
+import argparse
+import json
+import sys
+
+THRESHOLD = 1.2
+
+
+def _load(path: str) -> tuple[str, dict]:
+    with open(path) as f:
+        report = json.load(f)
+    results = {(r["size"], r["operation"]): r for r in report["results"]}
+
+    return report["commit"], results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("baseline")
+    parser.add_argument("candidate")
+    parser.add_argument("--threshold", type=float, default=THRESHOLD)
+    args = parser.parse_args()
+
+    baseline_commit, baseline = _load(args.baseline)
+    candidate_commit, candidate = _load(args.candidate)
+    print(f"{baseline_commit} -> {candidate_commit}")
+    print(
+        f"{'rows':>8} {'operation':<24} {'p50 before':>11} {'p50 after':>10} {'ratio':>6}"
+    )
+    regressions = 0
+    for key in sorted(baseline.keys() & candidate.keys()):
+        before, after = baseline[key]["p50_ms"], candidate[key]["p50_ms"]
+        ratio = after / before
+        flag = ""
+        if ratio > args.threshold:
+            flag = "  REGRESSION"
+            regressions += 1
+        size, operation = key
+        print(
+            f"{size:>8} {operation:<24} {before:>9.2f}ms {after:>8.2f}ms {ratio:>5.2f}x{flag}"
+        )
+
+    sys.exit(1 if regressions else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,126 @@
+"""Synthetic postings and corrections for benchmarking the data layer."""
+import csv
+import random
+from datetime import datetime, timedelta
+from typing import Iterator
+
+import sqlalchemy as sa
+
+from backend.app import models
+
+# Label frequencies roughly as seen on the classifieds pages we scrape
+BIKES = {"bike": 0.86, "children": 0.1, "cargo": 0.04}
+FRAMES = {
+    "diamond": 0.55,
+    "trapeze": 0.2,
+    "low_entry": 0.12,
+    "swan_neck": 0.08,
+    "y": 0.03,
+    "x": 0.02,
+}
+COLORS = {
+    "black": 0.34,
+    "white": 0.16,
+    "gray": 0.15,
+    "blue": 0.13,
+    "red": 0.1,
+    "green": 0.07,
+    "yellow": 0.05,
+}
+BRANDS = ["Cube", "Kalkhoff", "Gazelle", "Canyon", "Giant", "Hercules", "Puky", "KTM"]
+KINDS = ["Fahrrad", "Rennrad", "Mountainbike", "Trekkingrad", "Citybike", "Kinderrad"]
+DETAILS = ["28 Zoll", "26 Zoll", "Shimano", "Nabenschaltung", "neuwertig", "Damen"]
+CORRECTION_RATIO = 0.02  # Share of postings that receive corrections
+MAX_CORRECTIONS = 3  # Corrections per corrected posting, uniformly from 1
+DAYS = 60  # Postings are spread over the last DAYS days
+
+
+def load_postcodes() -> list[dict]:
+    with open(models.POSTCODES_CSV, newline="") as f:
+        return [
+            {"postcode": r["postcode"], "lat": float(r["lat"]), "lon": float(r["lon"])}
+            for r in csv.DictReader(f)
+        ]
+
+
+def generate_postings(
+    num: int, postcodes: list[dict], seed: int = 0, chunk_size: int = 10_000
+) -> Iterator[list[dict]]:
+    rng = random.Random(seed)
+    now = datetime.now()
+    for start in range(0, num, chunk_size):
+        chunk = []
+        for i in range(start, min(start + chunk_size, num)):
+            postcode = rng.choice(postcodes)["postcode"]
+            chunk.append(
+                {
+                    "title": " ".join(
+                        [rng.choice(BRANDS), rng.choice(KINDS), rng.choice(DETAILS)]
+                    ),
+                    "url": f"https://bench.example/{seed}/{i}",
+                    "image_url": f"https://bench.example/{seed}/{i}.jpg",
+                    "location": f"{postcode} Ort",
+                    "query": "Fahrrad",
+                    "loc_query": "Deutschland",
+                    "date": now - timedelta(seconds=rng.uniform(0, DAYS * 86400)),
+                    "bike": _sample(rng, BIKES),
+                    "frame": _sample(rng, FRAMES),
+                    "color": _sample(rng, COLORS),
+                }
+            )
+        yield chunk
+
+
+def generate_corrections(posting_ids: list[int], seed: int = 0) -> list[tuple]:
+    rng = random.Random(seed)
+    num_corrected = int(len(posting_ids) * CORRECTION_RATIO)
+    corrections = []
+    for posting_id in rng.sample(posting_ids, num_corrected):
+        for _ in range(rng.randint(1, MAX_CORRECTIONS)):
+            corrections.append(
+                (
+                    posting_id,
+                    _sample(rng, BIKES),
+                    _sample(rng, FRAMES),
+                    _sample(rng, COLORS),
+                )
+            )
+
+    return corrections
+
+
+def random_prediction(rng: random.Random) -> dict:
+    return {
+        "bike": _sample(rng, BIKES),
+        "frame": _sample(rng, FRAMES),
+        "color": _sample(rng, COLORS),
+    }
+
+
+async def populate(num_postings: int, seed: int = 0) -> list[int]:
+    postcodes = load_postcodes()
+    for chunk in generate_postings(num_postings, postcodes, seed):
+        await models.bulk_add_postings(chunk)
+    posting_ids = [
+        r["id"]
+        for r in await models.database.fetch_all(sa.select(models.postings.c.id))
+    ]
+    # Copied past the data layer, so the labels are encoded here
+    await models.load_labels()
+    corrections = [
+        (posting_id, *(models.label_codes[label] for label in labels))
+        for posting_id, *labels in generate_corrections(posting_ids, seed)
+    ]
+    async with models.database.connection() as connection:
+        await connection.raw_connection.copy_records_to_table(
+            models.corrections.name,
+            records=corrections,
+            columns=["posting_id", "bike", "frame", "color"],
+        )
+    await models.database.execute("ANALYZE")
+
+    return posting_ids
+
+
+def _sample(rng: random.Random, weights: dict[str, float]) -> str:
+    return rng.choices(list(weights), weights=list(weights.values()))[0]
@@ -1,4 +1,6 @@
 import os
+import pathlib
+import tempfile
 
 import uvicorn
 
@@ -6,7 +8,23 @@ if __name__ == "__main__":
     if "PORT" in os.environ:
         port = int(os.environ["PORT"])
         reload = False
+        workers = int(os.getenv("WEB_CONCURRENCY", os.cpu_count() or 1))
     else:
         port = 8000
         reload = True
-    uvicorn.run("backend.app.api:app", host="0.0.0.0", port=port, reload=reload)
+        workers = 1
+    # The workers split the database connection budget by this count
+    os.environ["WEB_CONCURRENCY"] = str(workers)
+    # Every worker dumps its metrics there, so that any of them serves all
+    if workers > 1:
+        metrics_dir = os.environ.setdefault("METRICS_DIR", tempfile.mkdtemp())
+        for dump in pathlib.Path(metrics_dir).glob("*.json"):
+            dump.unlink()
+    uvicorn.run(
+        "backend.app.api:app",
+        host="0.0.0.0",
+        port=port,
+        reload=reload,
+        workers=workers,
+        root_path=os.getenv("ROOT_PATH", ""),
+    )
@@ -0,0 +1,159 @@
+import json
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+
+import pytest
+import sqlalchemy as sa
+from fastapi.testclient import TestClient
+
+from backend.app import api, models, security
+
+DATABASE_URL = "postgresql://backend@/test-my-bike"
+USER = {"access_token": os.environ["API_KEY"]}
+ADMIN = {"access_token": os.environ["ADMIN_KEY"]}
+
+
+@pytest.fixture(autouse=True, scope="function")
+def create_test_database():
+    engine = sa.create_engine(DATABASE_URL)
+    models.metadata.create_all(engine)
+    yield
+    models.metadata.drop_all(engine)
+
+
+@pytest.fixture
+def client(monkeypatch):
+    monkeypatch.setenv("ROW_LIMIT", "1000")
+    monkeypatch.setenv("DATABASE_URL", DATABASE_URL)
+    monkeypatch.setenv("MIN_DATABASE_CONNECTIONS", "1")
+    api.posting_cache.clear()
+    # Entering runs the startup and shutdown handlers
+    with TestClient(api.app) as client:
+        yield client
+
+
+def _postings(num: int, start: int = 0) -> list[dict]:
+    return [
+        {
+            "title": f"Test Bike {i}",
+            "url": f"https://foo.bar/{i}",
+            "image_url": "https://foo.bar/img",
+            "location": "12345, Berlin",
+            "query": "Fahrrad",
+            "loc_query": "Berlin",
+            "date": (datetime.now() + timedelta(minutes=i)).isoformat(),
+            "prediction": {"bike": "bike", "frame": "diamond", "color": "red"},
+        }
+        for i in range(start, start + num)
+    ]
+
+
+def test_get_postings_not_modified(client):
+    response = client.post("/posting", json={"data": _postings(3)}, headers=ADMIN)
+    assert response.status_code == 201
+
+    response = client.get("/posting", headers=USER)
+    assert response.status_code == 200
+    assert len(response.json()["data"]) == 3
+    etag = response.headers["ETag"]
+
+    response = client.get("/posting", headers={**USER, "If-None-Match": etag})
+    assert response.status_code == 304
+    assert response.headers["ETag"] == etag
+    assert response.content == b""
+
+    # Other listings and later writes have other tags
+    response = client.get("/posting?limit=2", headers={**USER, "If-None-Match": etag})
+    assert response.status_code == 200
+    client.post("/posting", json={"data": _postings(1, start=3)}, headers=ADMIN)
+    response = client.get("/posting", headers={**USER, "If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.headers["ETag"] != etag
+    assert len(response.json()["data"]) == 4
+
+
+def test_get_postings_from_cache(client):
+    client.post("/posting", json={"data": _postings(3)}, headers=ADMIN)
+    hits = client.get("/posting/cache", headers=ADMIN).json()["hits"]
+
+    first = client.get("/posting?bike=bike", headers=USER)
+    second = client.get("/posting?bike=bike", headers=USER)
+    assert first.status_code == second.status_code == 200
+    assert first.content == second.content
+    assert first.headers["ETag"] == second.headers["ETag"]
+    stats = client.get("/posting/cache", headers=ADMIN).json()
+    assert stats["entries"] == 1
+    assert stats["hits"] == hits + 1
+
+    # A write invalidates the entry
+    client.post("/posting", json={"data": _postings(1, start=3)}, headers=ADMIN)
+    third = client.get("/posting?bike=bike", headers=USER)
+    assert len(third.json()["data"]) == 4
+    assert client.get("/posting/cache", headers=ADMIN).json()["hits"] == hits + 1
+
+
+def test_get_live_postings(client, monkeypatch):
+    # TestClient returns once the stream ends, so the feed is read in another
+    # thread and ends by cutting the client off
+    monkeypatch.setattr(models.new_postings, "max_queue_size", 1)
+    responses = []
+    reader = threading.Thread(
+        target=lambda: responses.append(
+            client.get("/posting/live?frame=diamond", headers=USER)
+        )
+    )
+    reader.start()
+    deadline = time.monotonic() + 5
+    while not len(models.new_postings) and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+    client.post("/posting", json={"data": _postings(1)}, headers=ADMIN)
+    client.post("/posting", json={"data": _postings(2, start=1)}, headers=ADMIN)
+    reader.join(timeout=5)
+
+    response = responses[0]
+    assert response.status_code == 200
+    assert response.headers["Content-Type"].startswith("text/event-stream")
+    assert response.headers["Cache-Control"] == "no-cache"
+    assert response.text.startswith("id: 1\nevent: posting\ndata: ")
+    assert response.text.endswith("event: cut_off\ndata: {}\n\n")
+    assert len(models.new_postings) == 0
+
+
+def test_bulk_add_postings(client):
+    lines = [json.dumps(p) for p in _postings(3)]
+    body = "\n".join(lines[:2]) + "\n\n" + lines[2]  # Blank lines are skipped
+    response = client.post(
+        "/posting/bulk",
+        data=body,
+        headers={**ADMIN, "Content-Type": "application/x-ndjson"},
+    )
+    assert response.status_code == 201
+    assert response.json() == {"inserted": 3, "updated": 0, "evicted": 0}
+
+    # The same URLs again update the postings
+    response = client.post("/posting/bulk", data=body, headers=ADMIN)
+    assert response.json() == {"inserted": 0, "updated": 3, "evicted": 0}
+
+    response = client.post("/posting/bulk", data=lines[0] + "\n{", headers=ADMIN)
+    assert response.status_code == 422
+    assert "line 2" in response.json()["detail"]
+    response = client.post("/posting/bulk", data=body, headers=USER)
+    assert response.status_code == 403
+
+
+def test_rate_limit(client, monkeypatch):
+    frontend = security.Credential("frontend", rate=0.01, burst=2)
+    monkeypatch.setitem(
+        security.credentials, security._digest(USER["access_token"]), frontend
+    )
+
+    assert client.get("/posting", headers=USER).status_code == 200
+    assert client.get("/posting/facets", headers=USER).status_code == 200
+    response = client.get("/posting", headers=USER)
+    assert response.status_code == 429
+    assert int(response.headers["Retry-After"]) > 0
+    # Admin endpoints are not limited
+    assert client.get("/posting/cache", headers=ADMIN).status_code == 200
@@ -0,0 +1,51 @@
+import asyncio
+
+import pytest
+
+from backend.app import metrics
+from backend.app.broadcast import Broadcaster
+
+
+@pytest.mark.asyncio
+async def test_publish_to_filtered_subscribers():
+    broadcaster = Broadcaster(max_queue_size=10)
+    everything = broadcaster.subscribe()
+    even = broadcaster.subscribe(lambda item: item % 2 == 0)
+
+    broadcaster.publish([1, 2, 3])
+    broadcaster.publish([4])
+
+    # Everything that is queued is read at once
+    assert await everything.get() == [1, 2, 3, 4]
+    assert await even.get() == [2, 4]
+
+
+@pytest.mark.asyncio
+async def test_unsubscribe():
+    broadcaster = Broadcaster(max_queue_size=10)
+    subscription = broadcaster.subscribe()
+    assert len(broadcaster) == 1
+
+    broadcaster.unsubscribe(subscription)
+    broadcaster.publish([1])
+    assert len(broadcaster) == 0
+    with pytest.raises(asyncio.TimeoutError):
+        await asyncio.wait_for(subscription.get(), 0.01)
+
+
+@pytest.mark.asyncio
+async def test_slow_subscriber_is_cut_off():
+    counter = metrics.Counter("cut_off_total", "Cut off", registry=[])
+    broadcaster = Broadcaster(max_queue_size=3, counter=counter)
+    slow = broadcaster.subscribe()
+    fast = broadcaster.subscribe()
+
+    broadcaster.publish(range(3))
+    assert await fast.get() == [0, 1, 2]
+    # Publishing does not wait for the slow subscriber to catch up
+    broadcaster.publish(range(3, 5))
+
+    assert await slow.get() is None
+    assert await fast.get() == [3, 4]
+    assert len(broadcaster) == 1
+    assert counter.labels().value == 1
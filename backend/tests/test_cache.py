@@ -0,0 +1,124 @@
+import asyncio
+
+import pytest
+
+from backend.app import metrics
+from backend.app.cache import CachedResponse, ResponseCache, SingleFlight
+
+
+def test_get_put():
+    cache = ResponseCache(max_bytes=100, ttl=60)
+    assert cache.get("key", generation=0) is None
+
+    cache.put("key", generation=0, response=CachedResponse(b"body", etag="body"))
+    assert cache.get("key", generation=0) == (b"body", "body")
+    assert cache.stats()["hits"] == 1
+    assert cache.stats()["misses"] == 1
+
+
+def test_stale_generation():
+    cache = ResponseCache(max_bytes=100, ttl=60)
+    cache.put("key", generation=0, response=CachedResponse(b"body", etag="body"))
+
+    # A write happened after caching, so the entry is dropped
+    assert cache.get("key", generation=1) is None
+    assert cache.stats()["evictions"] == 1
+    assert cache.stats()["size"] == 0
+
+
+def test_newer_generation_is_kept():
+    cache = ResponseCache(max_bytes=100, ttl=60)
+    cache.put("key", generation=2, response=CachedResponse(b"new", etag="new"))
+
+    # Read from a server that has not seen the newest write yet
+    assert cache.get("key", generation=1) is None
+    cache.put("key", generation=1, response=CachedResponse(b"old", etag="old"))
+    assert cache.stats()["evictions"] == 0
+    assert cache.get("key", generation=2) == (b"new", "new")
+
+
+def test_expired():
+    cache = ResponseCache(max_bytes=100, ttl=-1)
+    cache.put("key", generation=0, response=CachedResponse(b"body", etag="body"))
+
+    assert cache.get("key", generation=0) is None
+    assert cache.stats()["evictions"] == 1
+
+
+def test_evicts_least_recently_used():
+    cache = ResponseCache(max_bytes=10, ttl=60)
+    cache.put("a", generation=0, response=CachedResponse(b"aaaa", etag="aaaa"))
+    cache.put("b", generation=0, response=CachedResponse(b"bbbb", etag="bbbb"))
+    cache.get("a", generation=0)
+    cache.put("c", generation=0, response=CachedResponse(b"cccc", etag="cccc"))
+
+    assert cache.get("a", generation=0) == (b"aaaa", "aaaa")
+    assert cache.get("b", generation=0) is None
+    assert cache.get("c", generation=0) == (b"cccc", "cccc")
+    assert cache.stats()["size"] == 8
+    assert cache.stats()["evictions"] == 1
+
+
+def test_body_over_budget_not_cached():
+    cache = ResponseCache(max_bytes=3, ttl=60)
+    cache.put("key", generation=0, response=CachedResponse(b"body", etag="body"))
+
+    assert cache.get("key", generation=0) is None
+    assert cache.stats()["entries"] == 0
+
+
+@pytest.mark.asyncio
+async def test_single_flight_shares_result():
+    counter = metrics.Counter("coalesced_total", "Coalesced", registry=[])
+    flight = SingleFlight(counter)
+    calls = []
+
+    async def query(value):
+        calls.append(value)
+        await asyncio.sleep(0.01)
+        return value
+
+    results = await asyncio.gather(
+        *[flight.do("a", lambda: query("a")) for _ in range(5)],
+        flight.do("b", lambda: query("b")),
+    )
+
+    assert results == ["a"] * 5 + ["b"]
+    assert calls == ["a", "b"]
+    assert counter.labels().value == 4
+    # Nothing is shared once the call finished
+    assert await flight.do("a", lambda: query("a")) == "a"
+    assert calls == ["a", "b", "a"]
+
+
+@pytest.mark.asyncio
+async def test_single_flight_propagates_errors():
+    flight = SingleFlight()
+
+    async def query():
+        await asyncio.sleep(0.01)
+        raise RuntimeError("connection lost")
+
+    results = await asyncio.gather(
+        *[flight.do("a", query) for _ in range(3)], return_exceptions=True
+    )
+
+    assert all(isinstance(r, RuntimeError) for r in results)
+    assert len({id(r) for r in results}) == 1
+
+
+@pytest.mark.asyncio
+async def test_single_flight_survives_cancelled_caller():
+    flight = SingleFlight()
+
+    async def query():
+        await asyncio.sleep(0.01)
+        return "result"
+
+    first = asyncio.ensure_future(flight.do("a", query))
+    second = asyncio.ensure_future(flight.do("a", query))
+    await asyncio.sleep(0)
+    first.cancel()
+
+    assert await second == "result"
+    assert first.cancelled()
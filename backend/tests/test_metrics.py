@@ -0,0 +1,119 @@
+import asyncio
+import os
+
+import pytest
+
+from backend.app import metrics
+
+
+def test_counter():
+    registry = []
+    counter = metrics.Counter("rows_total", "Rows", ["table"], registry=registry)
+    counter.labels("postings").inc(3)
+    counter.labels("postings").inc()
+
+    rendered = metrics.render(registry)
+    assert "# TYPE rows_total counter" in rendered
+    assert 'rows_total{table="postings"} 4.0' in rendered
+
+
+def test_histogram():
+    registry = []
+    histogram = metrics.Histogram(
+        "latency_seconds", "Latency", ["route"], buckets=(0.1, 1), registry=registry
+    )
+    for value in (0.05, 0.1, 0.5, 2):
+        histogram.labels("/posting").observe(value)
+
+    lines = metrics.render(registry).splitlines()
+    assert 'latency_seconds_bucket{route="/posting",le="0.1"} 2' in lines
+    assert 'latency_seconds_bucket{route="/posting",le="1"} 3' in lines
+    assert 'latency_seconds_bucket{route="/posting",le="+Inf"} 4' in lines
+    assert 'latency_seconds_sum{route="/posting"} 2.65' in lines
+    assert 'latency_seconds_count{route="/posting"} 4' in lines
+
+
+def test_histogram_times_coroutines():
+    registry = []
+    histogram = metrics.Histogram(
+        "query_seconds", "Query", ["query"], registry=registry
+    )
+
+    @histogram.time("sleep")
+    async def sleep():
+        await asyncio.sleep(0.01)
+        return "done"
+
+    assert asyncio.run(sleep()) == "done"
+    assert histogram.labels("sleep").counts[-1] == 0
+    assert sum(histogram.labels("sleep").counts) == 1
+    assert histogram.labels("sleep").sum >= 0.01
+
+
+def test_gauge_reads_callback():
+    registry = []
+    gauge = metrics.Gauge("pool_idle", "Idle", registry=registry)
+    gauge.set_function(lambda: 3)
+    assert "pool_idle 3" in metrics.render(registry).splitlines()
+
+    # Nothing is reported while there is no value, e.g. before connecting
+    gauge.set_function(lambda: None)
+    lines = metrics.render(registry).splitlines()
+    assert not [line for line in lines if line.startswith("pool_idle")]
+
+
+def test_gauge_with_labels():
+    registry = []
+    gauge = metrics.Gauge("pool_size", "Size", ["pool"], registry=registry)
+    gauge.labels("primary").set(3)
+    gauge.labels("primary").inc(2)
+    gauge.labels("replica").dec()
+    gauge.set_function(lambda: 7, "spare")
+
+    lines = metrics.render(registry).splitlines()
+    assert 'pool_size{pool="primary"} 5' in lines
+    assert 'pool_size{pool="replica"} -1.0' in lines
+    assert 'pool_size{pool="spare"} 7' in lines
+
+
+def test_render_all_workers(tmp_path):
+    registry = []
+    counter = metrics.Counter("rows_total", "Rows", ["table"], registry=registry)
+    histogram = metrics.Histogram(
+        "latency_seconds", "Latency", buckets=(0.1, 1), registry=registry
+    )
+    gauge = metrics.Gauge("backlog_rows", "Backlog", registry=registry)
+    counter.labels("postings").inc(3)
+    histogram.labels().observe(0.05)
+    gauge.set(7)
+    metrics.write_dump(str(tmp_path), registry)
+    # Another worker that dumped its samples a moment ago
+    (tmp_path / f"{os.getpid()}.json").rename(tmp_path / "other.json")
+    counter.labels("postings").inc()
+    gauge.set(2)
+
+    lines = metrics.render_all_workers(str(tmp_path), registry).splitlines()
+    assert 'rows_total{table="postings"} 7.0' in lines
+    assert 'latency_seconds_bucket{le="0.1"} 2' in lines
+    assert "latency_seconds_count 2" in lines
+    assert 'backlog_rows{worker="other"} 7' in lines
+    assert f'backlog_rows{{worker="{os.getpid()}"}} 2' in lines
+
+    # Counts of a worker that exited still count, its gauges do not
+    metrics.write_dump(str(tmp_path), registry, final=True)
+    (tmp_path / f"{os.getpid()}.json").replace(tmp_path / "other.json")
+    lines = metrics.render_all_workers(str(tmp_path), registry).splitlines()
+    assert 'rows_total{table="postings"} 8.0' in lines
+    assert 'backlog_rows{worker="other"} 2' not in lines
+
+
+def test_metric_needs_a_kind():
+    with pytest.raises(TypeError):
+        metrics._Metric("base", "Base", registry=[])
+
+
+def test_label_values_are_escaped():
+    registry = []
+    counter = metrics.Counter("odd_total", "Odd", ["value"], registry=registry)
+    counter.labels('a"b\\c\n').inc()
+    assert 'odd_total{value="a\\"b\\\\c\\n"} 1.0' in metrics.render(registry)
@@ -1,14 +1,19 @@
+import asyncio
 import logging
+import os
 from datetime import timedelta, datetime
 
+import asyncpg
 import databases
 import pytest
 import pytest_asyncio
 import sqlalchemy as sa
 
-from backend.app import models, validation
+from backend.app import metrics, models, validation
+from backend.app.janitor import EvictionJanitor
 
 DATABASE_URL = "postgresql://backend@/test-my-bike"
+REPLICA_URL = "postgresql://backend@/test-my-bike-replica"
 
 
 @pytest.fixture(autouse=True, scope="function")
@@ -53,15 +58,15 @@ def _insert_postings(conn):
     for i in range(10):
         stmt = models.postings.insert().values(
             title=f"Test Bike {i}",
-            url="https://foo.bar",
+            url=f"https://foo.bar/{i}",
             image_url="https://foo.bar/img",
             location="12345, Berlin",
             query="Fahrrad",
             loc_query="Berlin",
             date=datetime.now() + timedelta(days=i),
-            bike="",
-            frame="",
-            color="",
+            bike=models.EMPTY_LABEL,
+            frame=models.EMPTY_LABEL,
+            color=models.EMPTY_LABEL,
         )
         result = conn.execute(stmt)
         primary_keys.append(result.inserted_primary_key[0])
@@ -73,22 +78,52 @@ def _insert_corrections(conn):
     for _ in range(3):
         stmt = models.corrections.insert().values(
             posting_id=1,
-            bike="",
-            frame="",
-            color="",
+            bike=models.EMPTY_LABEL,
+            frame=models.EMPTY_LABEL,
+            color=models.EMPTY_LABEL,
         )
         conn.execute(stmt)
 
     for _ in range(2):
         stmt = models.corrections.insert().values(
             posting_id=5,
-            bike="",
-            frame="",
-            color="",
+            bike=models.EMPTY_LABEL,
+            frame=models.EMPTY_LABEL,
+            color=models.EMPTY_LABEL,
         )
         conn.execute(stmt)
 
 
+@pytest.fixture
+def statement_counter(connect_db, monkeypatch):
+    counter = {"statements": 0}
+
+    def _count(func):
+        async def _counted(*args, **kwargs):
+            counter["statements"] += 1
+            return await func(*args, **kwargs)
+
+        return _counted
+
+    for method in ("execute", "execute_many", "fetch_one", "fetch_all", "fetch_val"):
+        monkeypatch.setattr(
+            models.database, method, _count(getattr(models.database, method))
+        )
+
+    return counter
+
+
+@pytest.fixture
+def replica(monkeypatch):
+    # A second database stands in for a streaming replica, so it never
+    # receives the writes made through the primary
+    engine = sa.create_engine(REPLICA_URL)
+    models.metadata.create_all(engine)
+    monkeypatch.setenv("READ_DATABASE_URL", REPLICA_URL)
+    yield engine
+    models.metadata.drop_all(engine)
+
+
 @pytest_asyncio.fixture
 async def connect_db():
     await models.connect()
@@ -110,15 +145,207 @@ async def test_connect_disconnect():
     assert models.database is None
 
 
+@pytest.mark.asyncio
+async def test_connect_within_connection_budget(monkeypatch):
+    monkeypatch.setenv("MIN_DATABASE_CONNECTIONS", "4")
+    monkeypatch.setenv("DATABASE_CONNECTION_BUDGET", "10")
+    monkeypatch.setenv("WEB_CONCURRENCY", "3")
+    await models.connect()
+    try:
+        await models.warm_up()
+        stats = models.pool_stats(models.database)
+    finally:
+        await models.disconnect()
+
+    assert stats == {"in_use": 0, "idle": 3, "max": 3}
+
+
+@pytest.mark.asyncio
+async def test_connect_over_connection_budget(monkeypatch):
+    monkeypatch.setenv("DATABASE_CONNECTION_BUDGET", "3")
+    monkeypatch.setenv("WEB_CONCURRENCY", "4")
+    with pytest.raises(RuntimeError):
+        await models.connect()
+    assert models.database is None
+
+
+@pytest.mark.asyncio
+async def test_connect_replica(replica):
+    await models.connect()
+    assert models.read_database.url == REPLICA_URL
+    assert models.read_database.is_connected
+
+    await models.disconnect()
+    assert models.read_database is None
+
+
+@pytest.mark.asyncio
+async def test_reads_go_to_replica(dummy_data, replica):
+    with replica.connect() as conn:
+        _insert_postings(conn)
+        conn.execute(models.postings.delete().where(models.postings.c.id > 1))
+    await models.connect()
+    try:
+        postings = await models.query_postings(None, None, None, 100, 0)
+        lsn = await models.add_corrections(
+            {"posting_id": 2, "bike": "", "frame": "", "color": ""}
+        )
+        num_corrections = await _count_rows(models.corrections)
+    finally:
+        await models.disconnect()
+
+    assert len(postings) == 1
+    assert lsn > 0
+    assert num_corrections == 6
+
+
+@pytest.mark.asyncio
+async def test_read_your_writes(dummy_data, replica, monkeypatch):
+    async def _lagging_replay_lsn():
+        return 0
+
+    monkeypatch.setattr(models, "_replay_lsn", _lagging_replay_lsn)
+    await models.connect()
+    try:
+        lsn = await models.add_corrections(
+            {"posting_id": 2, "bike": "", "frame": "", "color": ""}
+        )
+        from_replica = await models.query_corrections()
+        assert await models.read_after(lsn)
+        from_primary = await models.query_corrections()
+    finally:
+        await models.disconnect()
+
+    assert from_replica == []
+    assert len(from_primary) == 3
+
+
+@pytest.mark.asyncio
+async def test_listing_generation_matches_its_rows(dummy_data, replica, monkeypatch):
+    async def _lagging_replay_lsn():
+        return 0
+
+    monkeypatch.setattr(models, "_replay_lsn", _lagging_replay_lsn)
+    with replica.connect() as conn:
+        _insert_postings(conn)
+    await models.connect()
+    try:
+        _, replica_generation = await models.query_postings_with_generation(
+            None, None, None, 10, 0
+        )
+        lsn = await models.add_corrections(
+            {"posting_id": 2, "bike": "", "frame": "", "color": ""}
+        )
+        # Without the token the replica answers, which has not seen the write
+        assert await models.get_write_generation(models.postings) == replica_generation
+        assert await models.read_after(lsn)
+        found, primary_generation = await models.query_postings_with_generation(
+            None, None, None, 10, 0
+        )
+        current_generation = await models.get_write_generation(models.postings)
+        # Nothing matches, but the listing still has a generation
+        _, empty_generation = await models.query_postings_with_generation(
+            "unicycle", None, None, 10, 0
+        )
+    finally:
+        await models.disconnect()
+
+    assert next(p for p in found if p["id"] == 2)["num_corrections"] == 1
+    assert primary_generation > replica_generation
+    assert current_generation == primary_generation == empty_generation
+
+
 @pytest.mark.asyncio
 async def test_row_limit(connect_db, dummy_data):
     count = await models._get_free_rows()
-    assert count == 984
+    assert count == 950
 
 
 @pytest.mark.asyncio
-async def test_clear_old_postings(connect_db, dummy_data):
+async def test_row_counts_follow_writes(connect_db, dummy_data):
     await models.clear_old_postings(3)
+    await models.add_corrections(
+        {"posting_id": 10, "bike": "", "frame": "", "color": ""}
+    )
+
+    row_counts = await models.database.fetch_all(models.row_counts.select())
+    row_counts = {r["table_name"]: r["row_count"] for r in row_counts}
+    assert row_counts["postings"] == await _count_rows(models.postings)
+    assert row_counts["posting_urls"] == await _count_rows(models.posting_urls)
+    assert row_counts["corrections"] == await _count_rows(models.corrections)
+
+
+async def _count_rows(table):
+    return await models.database.fetch_val(
+        sa.select(sa.func.count()).select_from(table)
+    )
+
+
+async def _count_all_rows():
+    # Every row the host counts against the limit, one is alembic's
+    num_rows = 1
+    for table in models.metadata.sorted_tables:
+        num_rows += await _count_rows(table)
+
+    return num_rows
+
+
+@pytest.mark.asyncio
+async def test_row_limit_covers_all_rows(connect_db, dummy_data, monkeypatch):
+    monkeypatch.setenv("ROW_LIMIT", "60")
+    posting = {
+        "title": "",
+        "url": "",
+        "image_url": "",
+        "location": "",
+        "query": "",
+        "loc_query": "",
+        "date": datetime.now(),
+        "bike": "",
+        "frame": "",
+        "color": "",
+    }
+    for i in range(3):
+        # Each batch adds a label and a label combination, too
+        await models.bulk_add_postings(
+            [
+                {**posting, "url": f"https://foo.baz/{i}/{j}", "frame": f"frame {i}"}
+                for j in range(4)
+            ]
+        )
+        await models.add_correction_batch(
+            [{"posting_id": 10, "bike": "", "frame": "", "color": ""}] * 3
+        )
+
+        assert await _count_all_rows() == 60 - await models._get_free_rows()
+        assert await _count_all_rows() <= 60
+
+
+@pytest.mark.asyncio
+async def test_write_generation(connect_db, dummy_data):
+    posting_generation = await models.get_write_generation(models.postings)
+    generation = await models.get_write_generation(models.postings, models.corrections)
+
+    await models.database.execute(
+        models.postings.update()
+        .values(bike=models.EMPTY_LABEL)
+        .where(models.postings.c.id == 2)
+    )
+    assert await models.get_write_generation(models.postings) > posting_generation
+
+    await models.add_corrections(
+        {"posting_id": 2, "bike": "", "frame": "", "color": ""}
+    )
+    assert (
+        await models.get_write_generation(models.postings, models.corrections)
+        > generation + 1
+    )
+
+
+@pytest.mark.asyncio
+async def test_clear_old_postings(connect_db, dummy_data):
+    num_deleted = await models.clear_old_postings(3)
+    assert num_deleted == 3
 
     # Oldest three postings (with the lowest ids) were deleted
     remaining_postings = await models.database.fetch_all(models.postings.select())
@@ -132,7 +359,7 @@ async def test_clear_old_postings(connect_db, dummy_data):
 
 @pytest.mark.asyncio
 async def test_add_postings_over_limit(connect_db, dummy_data, monkeypatch):
-    monkeypatch.setenv("ROW_LIMIT", "16")
+    monkeypatch.setenv("ROW_LIMIT", "50")
     await models.add_postings(
         [
             {
@@ -193,9 +420,342 @@ async def test_add_postings_under_limit(connect_db, dummy_data):
     assert len(postings) == len(dummy_data) + 1
 
 
+@pytest.mark.asyncio
+async def test_new_postings_are_published(connect_db, dummy_data):
+    models.start_listening()
+    subscription = models.new_postings.subscribe(lambda p: p["bike"] == "road")
+    try:
+        scraped = {
+            "title": "Test Bike",
+            "image_url": "https://foo.bar/img",
+            "location": "12345, Berlin",
+            "query": "Rennrad",
+            "loc_query": "Berlin",
+            "date": datetime.now(),
+            "bike": "road",
+            "frame": "diamond",
+            "color": "red",
+        }
+        await models.add_postings(
+            [
+                {**scraped, "url": "https://foo.bar/2"},  # Only updated
+                {**scraped, "url": "https://foo.bar/new"},
+                {**scraped, "url": "https://foo.bar/mtb", "bike": "mtb"},
+            ]
+        )
+        published = await asyncio.wait_for(subscription.get(), 5)
+        assert [p["url"] for p in published] == ["https://foo.bar/new"]
+        assert published[0]["bike"] == "road"
+
+        # Postings of other workers arrive as notifications, own ones are not
+        # published a second time
+        await models.database.execute(
+            sa.select(
+                sa.func.pg_notify(
+                    models.NEW_POSTINGS_CHANNEL,
+                    f'{{"worker": "other", "ids": [{published[0]["id"]}]}}',
+                )
+            )
+        )
+        published = await asyncio.wait_for(subscription.get(), 5)
+        assert [p["url"] for p in published] == ["https://foo.bar/new"]
+        with pytest.raises(asyncio.TimeoutError):
+            await asyncio.wait_for(subscription.get(), 0.1)
+    finally:
+        models.new_postings.unsubscribe(subscription)
+        await models.stop_listening()
+
+
+@pytest.mark.asyncio
+async def test_listener_resubscribes(connect_db, dummy_data, monkeypatch):
+    monkeypatch.setattr(models, "LISTEN_RETRY_DELAYS", (0.01, 0.1))
+    listener_pids = sa.text(
+        "SELECT pid FROM pg_stat_activity "
+        "WHERE datname = current_database() AND query LIKE 'LISTEN%'"
+    )
+    models.start_listening()
+    subscription = models.new_postings.subscribe(lambda p: True)
+    try:
+        for _ in range(2):  # Before and after the database dropped the listener
+            pids = []
+            while not pids:
+                await asyncio.sleep(0.01)
+                pids = await models.database.fetch_all(listener_pids)
+            await models.database.execute(
+                sa.select(
+                    sa.func.pg_notify(
+                        models.NEW_POSTINGS_CHANNEL, '{"worker": "other", "ids": [3]}'
+                    )
+                )
+            )
+            published = await asyncio.wait_for(subscription.get(), 5)
+            assert [p["id"] for p in published] == [3]
+            await models.database.execute(
+                sa.select(sa.func.pg_terminate_backend(pids[0]["pid"]))
+            )
+    finally:
+        models.new_postings.unsubscribe(subscription)
+        await models.stop_listening()
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("add_func", ["add_postings", "bulk_add_postings"])
+async def test_add_postings_upserts_by_url(connect_db, dummy_data, add_func):
+    scraped_again = {
+        "title": "Test Bike 2",
+        "url": "https://foo.bar/2",
+        "image_url": "https://foo.bar/img",
+        "location": "12345, Berlin",
+        "query": "Rennrad",
+        "loc_query": "Berlin",
+        "date": datetime.now() + timedelta(days=30),
+        "bike": "road",
+        "frame": "diamond",
+        "color": "red",
+    }
+    older_duplicate = {**scraped_again, "date": datetime.now(), "bike": "mtb"}
+    report = await getattr(models, add_func)([scraped_again, older_duplicate])
+    assert report.inserted == 0
+    assert report.updated == 1
+    assert report.evicted == 0
+
+    # The existing row was refreshed with the newest scrape instead of duplicated
+    postings = await models.database.fetch_all(
+        models.postings.select(models.postings.c.url == "https://foo.bar/2")
+    )
+    assert len(postings) == 1
+    assert postings[0]["id"] == dummy_data[2]
+    assert postings[0]["date"] == scraped_again["date"]
+    assert postings[0]["bike"] == models.label_codes["road"]
+    assert postings[0]["query"] == "Fahrrad"
+    # Moving to the partition of its new date kept its unique URL
+    posting_urls = await models.database.fetch_all(models.posting_urls.select())
+    assert len(posting_urls) == len(dummy_data)
+    assert {"posting_id": dummy_data[2], "url": "https://foo.bar/2"} in [
+        dict(p._mapping) for p in posting_urls
+    ]
+
+    # Refreshed predictions move the posting to its new facets
+    facets = await models.get_facets(None, None, None)
+    assert facets["bike"] == {"road": 1, "": len(dummy_data) - 1}
+
+
+@pytest.mark.asyncio
+async def test_bulk_add_postings_over_limit(connect_db, dummy_data, monkeypatch):
+    monkeypatch.setenv("ROW_LIMIT", "54")
+    posting = {
+        "title": "",
+        "url": "",
+        "image_url": "",
+        "location": "",
+        "query": "",
+        "loc_query": "",
+        "date": datetime.now(),
+        "bike": "",
+        "frame": "",
+        "color": "",
+    }
+    report = await models.bulk_add_postings(
+        [{**posting, "url": f"https://foo.baz/{i}"} for i in range(3)]
+    )
+    assert report.inserted == 3
+    assert report.evicted == 1
+
+    # Copied postings are counted, the evicted one freed its corrections, too,
+    # but left a tombstone behind
+    postings = await models.database.fetch_all(models.postings.select())
+    assert len(postings) == len(dummy_data) + 2
+    assert await models._get_free_rows() == 2
+
+
+@pytest.mark.asyncio
+async def test_evict_over_high_water(connect_db, dummy_data, monkeypatch):
+    monkeypatch.setenv("ROW_LIMIT", "80")
+    monkeypatch.setenv("EVICTION_HIGH_WATER", "0.5")
+    free_rows = await models._get_free_rows()
+    assert free_rows == 30  # 50 rows, well below the hard limit
+
+    # Only the current and coming weeks hold postings, so rows are deleted
+    num_evicted, backlog = await models.evict_over_high_water(chunk_size=1)
+    assert num_evicted == 1
+    # Its url and three corrections went with it, one tombstone came
+    assert backlog == 6
+    assert await _count_rows(models.postings) == 9
+
+    janitor = EvictionJanitor(interval=1, chunk_size=1)
+    num_evicted = await janitor.evict()
+    assert num_evicted > 0
+    assert janitor.backlog == 0
+    assert janitor.lag() == 0
+
+
+@pytest.mark.asyncio
+async def test_background_task_has_own_connection(connect_db):
+    async def current_connection():
+        return models.database.connection()
+
+    await models.database.execute("SELECT 1")
+    task_connection = await models.start_background_task(current_connection())
+    assert task_connection is not models.database.connection()
+
+
+@pytest.mark.asyncio
+async def test_janitor_lock_is_exclusive(connect_db):
+    other = databases.Database(DATABASE_URL)
+    await other.connect()
+    try:
+        async with models.janitor_lock() as acquired:
+            assert acquired
+            async with other.connection() as connection:
+                held = await connection.fetch_val(
+                    sa.select(
+                        sa.func.pg_try_advisory_lock(
+                            sa.func.hashtext(models.JANITOR_LOCK)
+                        )
+                    )
+                )
+                assert not held
+    finally:
+        await other.disconnect()
+    # Released on leaving, so the next janitor gets it
+    async with models.janitor_lock() as acquired:
+        assert acquired
+
+
+@pytest.mark.asyncio
+async def test_evict_drops_oldest_partition(connect_db, dummy_data, monkeypatch):
+    monkeypatch.setenv("ROW_LIMIT", "90")
+    monkeypatch.setenv("EVICTION_HIGH_WATER", "0.5")
+    old_date = datetime.now() - timedelta(weeks=3)
+    await models.add_postings(
+        [
+            {
+                "title": f"Old Bike {i}",
+                "url": f"https://foo.bar/old/{i}",
+                "image_url": "https://foo.bar/img",
+                "location": "12345, Berlin",
+                "query": "Fahrrad",
+                "loc_query": "Berlin",
+                "date": old_date + timedelta(minutes=i),
+                "bike": "bike",
+                "frame": "diamond",
+                "color": "red",
+            }
+            for i in range(2)
+        ]
+    )
+    old_ids = [p["id"] for p in await models.query_postings("bike", None, None, 2, 0)]
+    await models.add_corrections(
+        {"posting_id": old_ids[0], "bike": "", "frame": "", "color": ""}
+    )
+
+    num_evicted, backlog = await models.evict_over_high_water(chunk_size=1)
+
+    assert num_evicted == 2
+    assert backlog == 6  # The current week is left to row deletes
+    partitions = await models.database.fetch_all(models.POSTINGS_PARTITIONS_QUERY)
+    partitions = [p["relname"] for p in partitions]
+    assert old_date.strftime("postings_%Gw%V") not in partitions
+    assert datetime.now().strftime("postings_%Gw%V") in partitions
+    assert await _count_rows(models.postings) == 10
+    assert await _count_rows(models.corrections) == 5
+    assert await _count_rows(models.posting_urls) == 10
+    row_counts = await models.database.fetch_all(models.row_counts.select())
+    assert {r["table_name"]: r["row_count"] for r in row_counts} == {
+        "labels": len(models.INITIAL_LABELS) + 1,
+        "postings": 10,
+        "posting_urls": 10,
+        "corrections": 5,
+        "correction_tombstones": 1,
+        "facet_counts": 1,
+    }
+    assert await models.get_facets(None, None, None) == {
+        "bike": {"": 10},
+        "frame": {"": 10},
+        "color": {"": 10},
+    }
+    tombstones = await models.database.fetch_all(models.correction_tombstones.select())
+    assert [t["posting_id"] for t in tombstones] == [old_ids[0]]
+
+
+@pytest.mark.asyncio
+async def test_outlier_date_creates_no_partitions(connect_db, dummy_data):
+    partitions = await models.database.fetch_all(models.POSTINGS_PARTITIONS_QUERY)
+    posting = {
+        "title": "",
+        "image_url": "",
+        "location": "",
+        "query": "",
+        "loc_query": "",
+        "bike": "",
+        "frame": "",
+        "color": "",
+    }
+    old_date = datetime.now() - timedelta(weeks=20)
+    await models.add_postings(
+        [
+            {**posting, "url": "https://foo.baz/new", "date": datetime.now()},
+            {**posting, "url": "https://foo.baz/old", "date": old_date},
+        ]
+    )
+    # Only the week of the old posting is added, not the ones in between
+    added = await models.database.fetch_all(models.POSTINGS_PARTITIONS_QUERY)
+    assert {p["relname"] for p in added} - {p["relname"] for p in partitions} == {
+        old_date.strftime("postings_%Gw%V")
+    }
+
+    with pytest.raises(ValueError):
+        await models.bulk_add_postings(
+            [{**posting, "url": "https://foo.baz/y2k", "date": datetime(2000, 1, 1)}]
+        )
+    assert len(
+        await models.database.fetch_all(models.POSTINGS_PARTITIONS_QUERY)
+    ) == len(added)
+    assert await _count_rows(models.postings) == len(dummy_data) + 2
+
+
+@pytest.mark.asyncio
+async def test_posting_urls_are_unique(connect_db, dummy_data):
+    # Even for writes that skip the upsert and its lock
+    duplicate = {
+        "title": "Test Bike 3",
+        "url": "https://foo.bar/3",
+        "date": datetime.now() - timedelta(weeks=1),
+    }
+    with pytest.raises(asyncpg.exceptions.UniqueViolationError):
+        await models.database.execute(models.postings.insert().values(duplicate))
+    with pytest.raises(asyncpg.exceptions.UniqueViolationError):
+        await models.database.execute(
+            models.postings.update()
+            .where(models.postings.c.id == dummy_data[4])
+            .values(url="https://foo.bar/3")
+        )
+    assert await _count_rows(models.postings) == len(dummy_data)
+
+
+@pytest.mark.asyncio
+async def test_corrections_reference_postings(connect_db, dummy_data):
+    with pytest.raises(asyncpg.exceptions.ForeignKeyViolationError):
+        await models.database.execute(
+            models.corrections.insert().values(
+                posting_id=404,
+                bike=models.EMPTY_LABEL,
+                frame=models.EMPTY_LABEL,
+                color=models.EMPTY_LABEL,
+            )
+        )
+
+    # Deleting a posting deletes its corrections
+    await models.database.execute(
+        models.postings.delete().where(models.postings.c.id == 1)
+    )
+    assert await _count_rows(models.corrections) == 2
+    assert await _count_rows(models.posting_urls) == len(dummy_data) - 1
+
+
 @pytest.mark.asyncio
 async def test_add_correction_over_limit(connect_db, dummy_data, monkeypatch):
-    monkeypatch.setenv("ROW_LIMIT", "16")
+    monkeypatch.setenv("ROW_LIMIT", "50")
     await models.add_corrections(
         {
             "posting_id": 10,
@@ -217,6 +777,185 @@ async def test_add_correction_over_limit(connect_db, dummy_data, monkeypatch):
     assert any(c["posting_id"] == 10 for c in corrections)
 
 
+@pytest.mark.asyncio
+async def test_add_correction_batch(connect_db, dummy_data):
+    batch = [
+        {"posting_id": posting_id, "bike": "bike", "frame": "x", "color": "red"}
+        for posting_id in (3, 404, 4, 3, 405)
+    ]
+    unknown_ids, _ = await models.add_correction_batch(batch)
+
+    assert unknown_ids == [404, 405]
+    corrections = await models.database.fetch_all(
+        models.corrections.select(
+            models.corrections.c.bike == models.label_codes["bike"]
+        )
+    )
+    assert sorted(c["posting_id"] for c in corrections) == [3, 3, 4]
+
+
+@pytest.mark.asyncio
+async def test_add_correction_batch_of_unknown_postings(
+    connect_db, dummy_data, monkeypatch
+):
+    monkeypatch.setenv("ROW_LIMIT", "50")  # No row left
+    batch = [
+        {"posting_id": posting_id, "bike": "", "frame": "", "color": ""}
+        for posting_id in (404, 405)
+    ]
+    unknown_ids, _ = await models.add_correction_batch(batch)
+
+    assert unknown_ids == [404, 405]
+    assert await _count_rows(models.postings) == len(dummy_data)
+    assert await _count_rows(models.corrections) == 5
+
+
+@pytest.mark.asyncio
+async def test_add_corrections_unknown_posting(connect_db, dummy_data):
+    with pytest.raises(RuntimeError):
+        await models.add_corrections(
+            {"posting_id": 404, "bike": "", "frame": "", "color": ""}
+        )
+    assert await _count_rows(models.corrections) == 5
+
+
+@pytest.mark.asyncio
+async def test_consensus_follows_corrections(connect_db, dummy_data):
+    def correction(bike, frame, color):
+        return {"posting_id": 3, "bike": bike, "frame": frame, "color": color}
+
+    await models.add_correction_batch(
+        [correction("cargo", "x", "red"), correction("bike", "y", "red")]
+    )
+    await models.add_corrections(correction("cargo", "trapeze", "blue"))
+    found = await models.query_postings(
+        None, None, None, 10, 0, consensus_bike="cargo", consensus_frame="trapeze"
+    )
+    assert [p["id"] for p in found] == [3]
+    # Ties go to the newest correction
+    assert validation.parse_consensus(found[0]) == {
+        "bike": "cargo",
+        "frame": "trapeze",
+        "color": "red",
+        "votes": {"bike": 2, "frame": 1, "color": 2},
+        "num_corrections": 3,
+    }
+    assert not await models.query_postings(
+        None, None, None, 10, 0, consensus_bike="bike"
+    )
+
+    # Evicting the corrections resets the consensus
+    await models.database.execute(
+        models.corrections.delete(models.corrections.c.posting_id == 3)
+    )
+    assert not await models.query_postings(
+        None, None, None, 10, 0, consensus_bike="cargo"
+    )
+
+
+@pytest.mark.asyncio
+async def test_labels_are_dictionary_encoded(connect_db, dummy_data):
+    posting = {
+        "title": "Lastenrad",
+        "url": "https://foo.bar/new",
+        "image_url": "https://foo.bar/img",
+        "location": "12345, Berlin",
+        "query": "Fahrrad",
+        "loc_query": "Berlin",
+        "date": datetime.now(),
+        "bike": "longtail",
+        "frame": "diamond",
+        "color": "red",
+    }
+    await models.add_postings([posting])
+
+    # Labels of a new classifier version are added on ingest
+    stored = await models.database.fetch_one(
+        models.postings.select(models.postings.c.url == posting["url"])
+    )
+    assert stored["bike"] == models.label_codes["longtail"]
+    found = await models.query_postings("longtail", None, None, 10, 0)
+    assert [(p["bike"], p["frame"], p["color"]) for p in found] == [
+        ("longtail", "diamond", "red")
+    ]
+    assert not await models.query_postings("unicycle", None, None, 10, 0)
+
+    # Corrections have to use known labels
+    with pytest.raises(ValueError):
+        await models.add_corrections(
+            {"posting_id": 1, "bike": "unicycle", "frame": "", "color": ""}
+        )
+    assert "unicycle" not in models.label_codes
+
+
+@pytest.mark.asyncio
+async def test_unknown_filter_labels(dummy_data, statement_counter):
+    await models.load_labels()
+    statement_counter["statements"] = 0
+
+    # Neither the dictionary nor the postings are read for them
+    for _ in range(3):
+        found, generation = await models.query_postings_with_generation(
+            "unicycle", None, None, 10, 0
+        )
+        assert found == []
+        assert generation == await models.get_write_generation(models.postings)
+    facets = await models.get_facets("unicycle", None, None)
+    assert statement_counter["statements"] == 7
+    assert facets["frame"] == facets["color"] == {}
+    assert facets["bike"] == {"": len(dummy_data)}
+    assert await models.get_facets("unicycle", "purple", None) == {
+        "bike": {},
+        "frame": {},
+        "color": {},
+    }
+    assert statement_counter["statements"] == 7
+
+
+@pytest.mark.asyncio
+async def test_add_corrections_concurrently(dummy_data, monkeypatch):
+    monkeypatch.setenv("ROW_LIMIT", "50")
+    await models.connect()
+    try:
+        # Each task gets its own pooled connection, so the writers really race
+        await asyncio.gather(
+            *[
+                models.add_corrections(
+                    {"posting_id": 10, "bike": "", "frame": "", "color": ""}
+                )
+                for _ in range(10)
+            ]
+        )
+        num_rows = await _count_all_rows()
+        corrections = await models.database.fetch_all(
+            models.corrections.select(models.corrections.c.posting_id == 10)
+        )
+    finally:
+        await models.disconnect()
+
+    assert len(corrections) == 10
+    assert num_rows <= 50
+
+
+@pytest.mark.asyncio
+async def test_concurrent_queries_are_coalesced(dummy_data, statement_counter):
+    coalesced = metrics.coalesced_calls.labels("query_postings")
+    before = coalesced.value
+    await models.load_labels()
+    statement_counter["statements"] = 0
+
+    results = await asyncio.gather(
+        *[models.query_postings(None, None, None, 5, 0) for _ in range(10)],
+        models.query_postings(None, None, None, 3, 0),
+    )
+
+    assert statement_counter["statements"] == 2
+    assert coalesced.value - before == 9
+    assert all(r == results[0] for r in results[:10])
+    assert len(results[0]) == 5
+    assert len(results[10]) == 3
+
+
 @pytest.mark.asyncio
 async def test_get_corrections(connect_db, dummy_data):
     corrections = await models.get_corrections()
@@ -225,3 +964,232 @@ async def test_get_corrections(connect_db, dummy_data):
     assert all(isinstance(c, validation.CorrectedPosting) for c in corrections)
     assert len(corrections[0].corrections) == 3
     assert len(corrections[1].corrections) == 2
+
+
+@pytest.mark.asyncio
+async def test_query_correction_feed(connect_db, dummy_data, monkeypatch):
+    corrected, deleted, watermark, stale = await models.query_correction_feed(0, 100)
+    assert [p["id"] for p in corrected] == [dummy_data[0], dummy_data[4]]
+    assert (deleted, watermark, stale) == ([], 5, False)
+
+    # Pages end at the watermark, even in the middle of a posting
+    corrected, _, watermark, _ = await models.query_correction_feed(0, 2)
+    assert len(corrected[0]["corrected_bike"]) == 2
+    assert watermark == 2
+    corrected, _, watermark, _ = await models.query_correction_feed(2, 100)
+    assert [len(p["corrected_bike"]) for p in corrected] == [1, 2]
+    assert watermark == 5
+
+    # Evicting a corrected posting leaves a tombstone after the watermark
+    await models.clear_old_postings(1)
+    corrected, deleted, watermark, stale = await models.query_correction_feed(5, 100)
+    assert (corrected, deleted, watermark, stale) == ([], [dummy_data[0]], 6, False)
+    _, _, watermark, _ = await models.query_correction_feed(6, 100)
+    assert watermark == 6
+
+    # Readers behind pruned tombstones are told to reload
+    monkeypatch.setattr(models, "MAX_TOMBSTONES", 1)
+    assert (await models.query_correction_feed(4, 100))[3]
+    assert not (await models.query_correction_feed(5, 100))[3]
+    assert not (await models.query_correction_feed(0, 100))[3]
+
+
+@pytest.mark.asyncio
+async def test_query_postings_search(connect_db, dummy_data):
+    titles = {
+        2: "Rennrad Shimano 105",
+        4: "Rennrad Rahmen 56",
+        6: "Shimano Ultegra Rennrad, Rennrad-Pedale inklusive",
+        8: "Mountainbike Shimano",
+    }
+    for posting_id, title in titles.items():
+        await models.database.execute(
+            models.postings.update()
+            .values(title=title)
+            .where(models.postings.c.id == posting_id)
+        )
+
+    found = await models.query_postings(None, None, None, 10, 0, q="Rennrad Shimano")
+    assert [p["id"] for p in found] == [6, 2]
+
+    # Title and location are searched and can be combined with filters
+    found = await models.query_postings(None, None, None, 10, 0, q="berlin")
+    assert len(found) == len(dummy_data)
+    found = await models.query_postings("mtb", None, None, 10, 0, q="berlin")
+    assert len(found) == 0
+
+    # Ranked results page with a cursor of (rank, id)
+    first_page = await models.query_postings(
+        None, None, None, 1, 0, q="rennrad", order="rank"
+    )
+    assert [p["id"] for p in first_page] == [6]
+    cursor = (first_page[-1]["sort_key"], first_page[-1]["id"])
+    second_page = await models.query_postings(
+        None, None, None, 10, 0, cursor, q="rennrad", order="rank"
+    )
+    assert [p["id"] for p in second_page] == [4, 2]
+
+
+@pytest.mark.asyncio
+async def test_query_postings_within_radius(connect_db, dummy_data):
+    scraped = [
+        {
+            "title": f"Test Bike {location}",
+            "url": f"https://foo.bar/{location}",
+            "image_url": "https://foo.bar/img",
+            "location": location,
+            "query": "Fahrrad",
+            "loc_query": "Berlin",
+            "date": datetime.now() + timedelta(days=30 + i),
+            "bike": "",
+            "frame": "",
+            "color": "",
+        }
+        for i, location in enumerate(
+            ["10115 Berlin", "14467, Potsdam", "80331 München"]
+        )
+    ]
+    await models.add_postings(scraped)
+
+    # Postcodes are resolved at ingest, fixture rows bypassed it
+    rows = await models.database.fetch_all(
+        sa.select(models.postings.c.postcode, models.postings.c.lat)
+    )
+    resolved = {r["postcode"]: r["lat"] for r in rows}
+    assert resolved == {
+        None: None,
+        "10115": 52.5337,
+        "14467": 52.4055,
+        "80331": 48.1379,
+    }
+
+    berlin = {"lat": 52.52, "lon": 13.405}
+    found = await models.query_postings(None, None, None, 10, 0, radius_km=5, **berlin)
+    assert [p["location"] for p in found] == ["10115 Berlin"]
+    found = await models.query_postings(None, None, None, 10, 0, radius_km=30, **berlin)
+    assert [p["location"] for p in found] == ["14467, Potsdam", "10115 Berlin"]
+    found = await models.query_postings(
+        None, None, None, 10, 0, radius_km=600, **berlin
+    )
+    assert len(found) == 3
+
+
+@pytest.mark.asyncio
+async def test_iter_corrections_streams_in_bounded_memory(connect_db, dummy_data):
+    await models.database.execute(
+        sa.text(
+            "INSERT INTO corrections (posting_id, bike, frame, color) "
+            "SELECT id, :label, :label, :label FROM postings "
+            "CROSS JOIN generate_series(1, :per_posting)"
+        ).bindparams(label=models.EMPTY_LABEL, per_posting=500_000 // len(dummy_data))
+    )
+    num_expected = await _count_rows(models.corrections)
+    baseline_rss = peak_rss = _current_rss()
+    num_streamed = 0
+    chunk = []
+    async for record in models.iter_corrections():
+        chunk.append(record)
+        if len(chunk) == 1000:
+            num_streamed += len(validation.dump_export_ndjson(chunk).splitlines())
+            peak_rss = max(peak_rss, _current_rss())
+            chunk = []
+    num_streamed += len(chunk)
+
+    assert num_streamed == num_expected
+    # Materializing all rows would take hundreds of megabytes
+    assert peak_rss - baseline_rss < 32 * 1024 * 1024
+
+
+def _current_rss():
+    with open("/proc/self/statm") as f:
+        return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+
+
+@pytest.mark.asyncio
+async def test_get_corrections_statement_count(
+    connect_db, dummy_data, statement_counter
+):
+    # Loading the label dictionary once takes another
+    await models.get_corrections()
+    assert statement_counter["statements"] == 2
+
+    for posting_id in dummy_data:
+        await models.database.execute(
+            models.corrections.insert().values(
+                posting_id=posting_id,
+                bike=models.EMPTY_LABEL,
+                frame=models.EMPTY_LABEL,
+                color=models.EMPTY_LABEL,
+            )
+        )
+    statement_counter["statements"] = 0
+    corrections = await models.get_corrections()
+    assert len(corrections) == len(dummy_data)
+    assert statement_counter["statements"] == 1
+
+
+@pytest.mark.asyncio
+async def test_query_postings_with_cursor(connect_db, dummy_data):
+    first_page = await models.query_postings(None, None, None, 4, 0)
+    assert [p["id"] for p in first_page] == [10, 9, 8, 7]
+
+    cursor = (first_page[-1]["date"], first_page[-1]["id"])
+    second_page = await models.query_postings(None, None, None, 4, 0, cursor)
+    assert [p["id"] for p in second_page] == [6, 5, 4, 3]
+
+
+@pytest.mark.asyncio
+async def test_writes_bump_postings_generation(connect_db, dummy_data):
+    generation = await models.get_write_generation(models.postings)
+    await models.clear_old_postings(1)
+    assert await models.get_write_generation(models.postings) > generation
+
+    generation = await models.get_write_generation(models.postings)
+    await models.add_postings(
+        [
+            {
+                "title": "",
+                "url": "",
+                "image_url": "",
+                "location": "",
+                "query": "",
+                "loc_query": "",
+                "date": datetime.now(),
+                "bike": "",
+                "frame": "",
+                "color": "",
+            }
+        ]
+    )
+    assert await models.get_write_generation(models.postings) > generation
+
+
+@pytest.mark.asyncio
+async def test_get_facets(connect_db, dummy_data):
+    await models.load_labels()
+    labels = [("bike", "diamond", "red")] * 3 + [("cargo", "diamond", "black")] * 2
+    for posting_id, (bike, frame, color) in zip(dummy_data, labels):
+        await models.database.execute(
+            models.postings.update()
+            .values(
+                bike=models.label_codes[bike],
+                frame=models.label_codes[frame],
+                color=models.label_codes[color],
+            )
+            .where(models.postings.c.id == posting_id)
+        )
+
+    facets = await models.get_facets(None, None, None)
+    assert facets["bike"] == {"bike": 3, "cargo": 2, "": 5}
+    assert facets["frame"] == {"diamond": 5, "": 5}
+
+    # Facets are restricted by the filters on the other aspects
+    facets = await models.get_facets("cargo", None, "diamond")
+    assert facets["bike"] == {"bike": 3, "cargo": 2}
+    assert facets["frame"] == {"diamond": 2}
+    assert facets["color"] == {"black": 2}
+
+    # Evicted postings are no longer counted
+    await models.clear_old_postings(4)
+    facets = await models.get_facets(None, None, None)
+    assert facets["bike"] == {"cargo": 1, "": 5}
@@ -0,0 +1,95 @@
+import hashlib
+import os
+
+import pytest
+from fastapi import HTTPException
+
+from backend.app import security
+
+
+@pytest.fixture
+def credentials(monkeypatch, tmp_path):
+    keys_file = tmp_path / "keys.csv"
+    digest = hashlib.sha256(b"scraper-key").hexdigest()
+    keys_file.write_text(f"name,sha256,rate,burst\nscraper,{digest},1,2\n")
+    monkeypatch.setenv("API_KEYS_FILE", str(keys_file))
+    credentials = security.load_credentials()
+    monkeypatch.setattr(security, "credentials", credentials)
+
+    return credentials
+
+
+def test_token_bucket():
+    bucket = security.TokenBucket(rate=1, burst=2)
+    assert bucket.take()
+    assert bucket.take()
+    assert not bucket.take()
+    assert 0 < bucket.retry_after() <= 1
+
+    bucket.updated -= 1  # One second passes
+    assert bucket.take()
+    assert not bucket.take()
+
+
+def test_load_credentials(credentials):
+    assert {c.name for c in credentials.values()} == {"default", "scraper"}
+    scraper = credentials[hashlib.sha256(b"scraper-key").hexdigest()]
+    assert scraper.bucket.rate == 1
+    assert scraper.bucket.burst == 2
+    # The key of the frontend is shared by all its visitors
+    default = credentials[hashlib.sha256(os.environ["API_KEY"].encode()).hexdigest()]
+    assert default.bucket is None
+
+
+def test_load_credentials_limits_frontend(monkeypatch, tmp_path):
+    keys_file = tmp_path / "keys.csv"
+    digest = hashlib.sha256(os.environ["API_KEY"].encode()).hexdigest()
+    keys_file.write_text(f"name,sha256,rate,burst\nfrontend,{digest},,\n")
+    monkeypatch.setenv("API_KEYS_FILE", str(keys_file))
+
+    frontend = security.load_credentials()[digest]
+    assert frontend.name == "frontend"
+    assert frontend.bucket.rate == security.API_KEY_RATE
+    assert frontend.bucket.burst == security.API_KEY_BURST
+
+
+@pytest.mark.parametrize("rate,burst", [("0", "2"), ("-1", "2"), ("1", "0.5")])
+def test_load_credentials_rejects_limits(monkeypatch, tmp_path, rate, burst):
+    keys_file = tmp_path / "keys.csv"
+    keys_file.write_text(f"name,sha256,rate,burst\nscraper,abc,{rate},{burst}\n")
+    monkeypatch.setenv("API_KEYS_FILE", str(keys_file))
+    with pytest.raises(ValueError):
+        security.load_credentials()
+
+
+def test_authorize(credentials):
+    assert security.authorize(None, "scraper-key", None) == "scraper-key"
+    assert security.authorize("wrong", os.environ["API_KEY"]) == os.environ["API_KEY"]
+    with pytest.raises(HTTPException) as exc_info:
+        security.authorize("wrong", None, None)
+    assert exc_info.value.status_code == 403
+
+
+def test_authorize_over_budget(credentials):
+    limited = security.metrics.api_key_requests.labels("scraper", "limited")
+    limited_before = limited.value
+    security.authorize("scraper-key")
+    security.authorize("scraper-key")
+    with pytest.raises(HTTPException) as exc_info:
+        security.authorize("scraper-key")
+
+    assert exc_info.value.status_code == 429
+    assert exc_info.value.headers["Retry-After"] == "1"
+    assert limited.value == limited_before + 1
+    # Other keys have budgets of their own
+    for _ in range(100):
+        assert security.authorize(os.environ["API_KEY"])
+
+
+def test_read_after_token():
+    token = security.sign_read_after(123456)
+    assert security.verify_read_after(token) == 123456
+
+    for forged in ("123456", "999999" + token[6:], token + "0", "x.y"):
+        with pytest.raises(ValueError):
+            security.verify_read_after(forged)
@@ -1,3 +1,11 @@
+import csv
+import datetime
+import io
+import json
+
+import pydantic
+import pytest
+
 from backend.app import validation
 
 
@@ -8,3 +16,149 @@ def test_flatten():
     flattened_posting = validation.flatten(posting, nested="correction")
     expected = {"posting_id": 0, "bike": "", "frame": "", "color": ""}
     assert flattened_posting == expected
+
+
+@pytest.mark.parametrize(
+    "location, expected",
+    [
+        ("12345, Berlin", "12345"),
+        ("Berlin 10115", "10115"),
+        ("Mitte, Berlin", None),
+        ("123456 Berlin", None),
+    ],
+)
+def test_parse_postcode(location, expected):
+    assert validation.parse_postcode(location) == expected
+
+
+def test_correction_batch_size():
+    correction = {"posting_id": 1, "correction": {"bike": "", "frame": "", "color": ""}}
+    batch = validation.IncomingCorrectionList(data=[correction])
+    assert batch.data[0].posting_id == 1
+
+    for size in (0, validation.MAX_CORRECTION_BATCH + 1):
+        with pytest.raises(pydantic.ValidationError):
+            validation.IncomingCorrectionList(data=[correction] * size)
+
+
+def test_cursor_round_trip():
+    date = datetime.datetime(2022, 4, 7, 19, 56, 16)
+    cursor = validation.encode_cursor(date, 42)
+    assert validation.decode_cursor(cursor) == (date, 42)
+
+
+def test_rank_cursor_round_trip():
+    cursor = validation.encode_cursor(0.0607927, 42)
+    assert validation.decode_cursor(cursor) == (0.0607927, 42)
+
+
+def test_decode_malformed_cursor():
+    with pytest.raises(ValueError):
+        validation.decode_cursor("not-a-cursor")
+
+
+def _posting_record(posting_id):
+    return {
+        "id": posting_id,
+        "title": f"Test Bike {posting_id}",
+        "url": f"https://foo.bar/{posting_id}",
+        "image_url": "https://foo.bar/img",
+        "location": "12345, Berlin",
+        "query": "Fahrrad",
+        "loc_query": "Berlin",
+        "date": datetime.datetime(2022, 4, 7, 19, 56, 16, 123),
+        "bike": "road",
+        "frame": "diamond",
+        "color": "black",
+        "corrected_bike": ["mtb", "road"],
+        "corrected_frame": ["diamond", "step-through"],
+        "corrected_color": ["red", "black"],
+        "consensus_bike": "mtb",
+        "consensus_bike_votes": 1,
+        "consensus_frame": "step-through",
+        "consensus_frame_votes": 1,
+        "consensus_color": "black",
+        "consensus_color_votes": 1,
+        "num_corrections": 2 if posting_id % 2 else 0,
+    }
+
+
+def _validated_posting_list(records, cursor=None):
+    postings = [
+        validation.Posting(
+            **{**p, "prediction": {**p}}, consensus=validation.parse_consensus(p)
+        )
+        for p in records
+    ]
+
+    return validation.PostingList(data=postings, cursor=cursor).json().encode()
+
+
+def test_dump_posting_list():
+    records = [_posting_record(i) for i in range(3)]
+    expected = _validated_posting_list(records, cursor="abc")
+    assert validation.dump_posting_list(records, cursor="abc") == expected
+
+
+def test_dump_posting_events():
+    records = [_posting_record(i) for i in range(2)]
+    events = validation.dump_posting_events(records).decode().split("\n\n")
+
+    assert events[-1] == ""
+    for record, event in zip(records, events):
+        event_id, event_type, data = event.split("\n")
+        assert event_id == f"id: {record['id']}"
+        assert event_type == "event: posting"
+        posting = validation.Posting.parse_raw(data.removeprefix("data: "))
+        assert posting.prediction.bike == "road"
+
+
+def test_dump_corrected_posting_list():
+    records = [_posting_record(i) for i in range(3)]
+    corrected_postings = [
+        validation.CorrectedPosting(
+            **{**p, "prediction": {**p}},
+            consensus=validation.parse_consensus(p),
+            corrections=[
+                validation.Prediction(bike=b, frame=f, color=c)
+                for b, f, c in zip(
+                    p["corrected_bike"], p["corrected_frame"], p["corrected_color"]
+                )
+            ],
+        )
+        for p in records
+    ]
+    expected = validation.CorrectedPostingList(data=corrected_postings).json()
+    assert validation.dump_corrected_posting_list(records) == expected.encode()
+
+
+def _export_record(correction_id):
+    return {
+        **_posting_record(7),
+        "correction_id": correction_id,
+        "posting_id": 7,
+        "location": "12345, Berlin",
+        "corrected_bike": "mtb",
+        "corrected_frame": "diamond",
+        "corrected_color": 'red "ish"',
+    }
+
+
+def test_dump_export_ndjson():
+    records = [_export_record(i) for i in range(3)]
+    lines = validation.dump_export_ndjson(records).decode().splitlines()
+    rows = [json.loads(line) for line in lines]
+    assert [r["correction_id"] for r in rows] == [0, 1, 2]
+    assert rows[0]["date"] == "2022-04-07T19:56:16.000123"
+    assert rows[0]["corrected_color"] == 'red "ish"'
+    assert validation.dump_export_ndjson([]) == b""
+
+
+def test_dump_export_csv():
+    records = [_export_record(i) for i in range(3)]
+    dumped = validation.dump_export_csv(records, header=True).decode()
+    rows = list(csv.DictReader(io.StringIO(dumped)))
+    assert list(rows[0]) == validation.EXPORT_FIELDS
+    assert [r["correction_id"] for r in rows] == ["0", "1", "2"]
+    assert rows[0]["location"] == "12345, Berlin"
+    assert rows[0]["corrected_color"] == 'red "ish"'
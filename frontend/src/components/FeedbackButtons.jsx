@@ -13,7 +13,7 @@ import {
     Stack,
     useDisclosure
 } from "@chakra-ui/react";
-import {apiPost} from "../utils";
+import {queueCorrection} from "../utils";
 import {AspectSelects} from "./AspectSelects";
 
 const FeedbackButtons = ({posting_id, image_url}) => {
@@ -30,8 +30,7 @@ const FeedbackButtons = ({posting_id, image_url}) => {
 
     const submitCorrection = async (correction) => {
         if (correction !== undefined) {
-            const payload = {posting_id: posting_id, correction: correction}
-            await apiPost("correction", payload)
+            queueCorrection({posting_id: posting_id, correction: correction})
         }
         onClose()
     }
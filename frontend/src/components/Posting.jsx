@@ -13,7 +13,7 @@ import {
 import InfiniteScroll from "react-infinite-scroll-component";
 import moment from "moment";
 import {PostingsContext, QueryContext} from "./Contexts";
-import {apiGet} from "../utils";
+import {apiEventSource, apiGet} from "../utils";
 import FeedbackButtons from "./FeedbackButtons";
 import SearchBar from "./SearchBar";
 import Prediction from "./Prediction";
@@ -74,34 +74,49 @@ const Loading = () => {
 
 const Postings = ({marginTop}) => {
     const [postings, setPostings] = useState([])
+    const [cursor, setCursor] = useState(null)
     const [query, setQuery] = React.useState({bike: "", frame: "", color: ""})
     const fetchPostings = async (query, skip = null, limit = null) => {
         const extendedQuery = {...query, skip: skip, limit: limit}
         const response = await apiGet("posting", extendedQuery)
         const fetched = await response.json()
         setPostings(fetched.data)
+        setCursor(fetched.cursor)
     }
 
     const fetchMorePostings = async () => {
-        const extendedQuery = {...query, skip: postings.length, limit: null}
+        const extendedQuery = {...query, cursor: cursor, limit: null}
         const response = await apiGet("posting", extendedQuery)
         const fetched = await response.json()
         setPostings(postings.concat(fetched.data))
+        setCursor(fetched.cursor)
     }
 
     useEffect(() => {
         fetchPostings({bike: "", frame: "", color: ""})
     }, [])
+
+    // New postings matching the query are pushed by the backend
+    useEffect(() => {
+        const source = apiEventSource("posting/live", query)
+        source.addEventListener("posting", (event) => {
+            const posting = JSON.parse(event.data)
+            setPostings((current) => current.some(p => p.id === posting.id)
+                ? current : [posting, ...current])
+        })
+        return () => source.close()
+    }, [query.bike, query.frame, query.color])
     return (
         <QueryContext.Provider value={[query, setQuery]}>
             <PostingsContext.Provider value={[postings, fetchPostings]}>
                 <SearchBar/>
                 <InfiniteScroll dataLength={postings.length} next={fetchMorePostings}
-                                hasMore={true} loader={<Loading/>}>
+                                hasMore={cursor !== null} loader={<Loading/>}>
                     <Stack spacing="0.5rem" pl="0.5rem" pr="0.5rem">
                         {postings.map((posting, index) => (
                             <Posting key={posting.id} posting={posting}
-                                     prediction={posting.prediction} lazy={index === 0}/>
+                                     prediction={posting.consensus || posting.prediction}
+                                     lazy={index === 0}/>
                         ))}
                     </Stack>
                 </InfiniteScroll>
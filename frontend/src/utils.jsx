@@ -4,24 +4,80 @@ const toQueryString = (obj) => {
     const color = obj.color ? `&color=${obj.color}` : "";
     const skip = obj.skip ? `&skip=${obj.skip}` : "";
     const limit = obj.limit ? `&limit=${obj.limit}` : "";
-    return bike + frame + color + skip + limit
+    const cursor = obj.cursor ? `&cursor=${obj.cursor}` : "";
+    return bike + frame + color + skip + limit + cursor
+}
+
+
+// Reads that follow a correction send its token, so that they are not answered
+// by a replica that has not caught up with it. Tokens expire like the cookie.
+const READ_AFTER_MAX_AGE = 60000
+let readAfter = null
+
+const rememberReadAfter = (response) => {
+    const token = response.headers.get("Read-After")
+    if (token !== null) {
+        readAfter = {token: token, expires: Date.now() + READ_AFTER_MAX_AGE}
+    }
 }
 
 
 export const apiGet = async (endpoint, query) => {
     const headers = {access_token: process.env.REACT_APP_API_KEY}
+    if (readAfter !== null && readAfter.expires > Date.now()) {
+        headers["Read-After"] = readAfter.token
+    }
     const queryString = toQueryString(query)
     const backendUrl = `${process.env.REACT_APP_BACKEND_URL}/${endpoint}?${queryString}`
     return await fetch(backendUrl, {headers})
 }
 
 
-export const apiPost = async (endpoint, payload) => {
+// EventSource cannot send headers, so the key goes into the query string
+export const apiEventSource = (endpoint, query) => {
+    const queryString = toQueryString(query)
+    const apiKey = `access_token=${process.env.REACT_APP_API_KEY}`
+    const backendUrl = `${process.env.REACT_APP_BACKEND_URL}/${endpoint}?${apiKey}&${queryString}`
+    return new EventSource(backendUrl)
+}
+
+
+export const apiPost = async (endpoint, payload, keepalive = false) => {
     const headers = {
         access_token: process.env.REACT_APP_API_KEY, "Content-Type": "application/json"
     }
     const backendUrl = `${process.env.REACT_APP_BACKEND_URL}/${endpoint}`
-    return await fetch(backendUrl, {
-        method: "POST", headers: headers, body: JSON.stringify(payload)
+    const response = await fetch(backendUrl, {
+        method: "POST", headers: headers, body: JSON.stringify(payload), keepalive
     })
-}
\ No newline at end of file
+    rememberReadAfter(response)
+    return response
+}
+
+
+// Corrections are collected for a moment and sent together
+const CORRECTION_BATCH_DELAY = 2000
+const MAX_CORRECTION_BATCH = 100
+let pendingCorrections = []
+let flushTimeout = null
+
+export const queueCorrection = (correction) => {
+    pendingCorrections.push(correction)
+    if (flushTimeout === null) {
+        flushTimeout = setTimeout(flushCorrections, CORRECTION_BATCH_DELAY)
+    }
+}
+
+const flushCorrections = async () => {
+    clearTimeout(flushTimeout)
+    flushTimeout = null
+    const requests = []
+    while (pendingCorrections.length > 0) {
+        const batch = pendingCorrections.splice(0, MAX_CORRECTION_BATCH)
+        // keepalive lets the requests finish when the page is being closed
+        requests.push(apiPost("correction/batch", {data: batch}, true))
+    }
+    await Promise.all(requests)
+}
+
+window.addEventListener("pagehide", flushCorrections)
\ No newline at end of file